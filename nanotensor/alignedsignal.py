@@ -11,18 +11,25 @@
 import sys
 import os
 import subprocess
+import h5py
 import numpy as np
 from timeit import default_timer as timer
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
 from py3helpers.utils import check_numpy_table
 from py3helpers.seq_tools import ReferenceHandler, initialize_pysam_wrapper, ReverseComplement, get_minimap_alignment
 
 from nanotensor.fast5 import Fast5
 from nanotensor.mea_algorithm import maximum_expected_accuracy_alignment, mea_slow, \
-    mea_slower, create_random_prob_matrix, get_mea_params_from_events, match_events_with_signalalign
-from nanotensor.event_detection import time_to_index
+    mea_slower, create_random_prob_matrix, get_mea_params_from_events, match_events_with_signalalign, \
+    transform_kmers
+from nanotensor.event_detection import time_to_index, model_state_bytes
 from itertools import islice
 
+# fields kept for labels, predictions and guides, kmers are widened to the longest kmer added
+LABEL_DTYPE = [('raw_start', np.int64), ('raw_length', np.int64), ('reference_index', np.int64),
+               ('posterior_probability', np.float64), ('kmer', 'S5')]
+LABEL_TYPES = ('label', 'prediction', 'guide')
+
 
 class AlignedSignal(object):
     """Labeled nanopore signal data"""
@@ -37,6 +44,9 @@ class AlignedSignal(object):
         self._add_scaled_signal(scaled_signal)
         self.signal_length = len(self.scaled_signal)
         self.minus_strand = None
+        # every label, prediction and guide in one array and the (start, end) of each (label_type, name) in it
+        self.labels = np.zeros(0, dtype=LABEL_DTYPE)
+        self.label_offsets = OrderedDict()
         # label can be used for neural network training with all signal continuously labelled
         self.label = defaultdict()
         # predictions can have multiple labels for different sections of current
@@ -52,28 +62,62 @@ class AlignedSignal(object):
         assert int(signal[0]) == signal[0], "Raw signal are always integers"
         assert len(signal) == len(self.scaled_signal) and len(signal) == self.signal_length, \
             "Raw signal must be same size as scaled signal input:{} != scale:{}".format(signal, self.scaled_signal)
-        self.raw_signal = signal
+        self.raw_signal = np.asarray(signal).astype(np.int16, copy=False)
 
     def _add_scaled_signal(self, signal):
         """Add scaled signal to class
 
         :param signal: normalized current signal to pA
         """
-        if type(signal) is np.ndarray:
-            signal = signal.tolist()
-        assert type(signal[0]) == float, "scaled signal must be a float"
-        self.scaled_signal = signal
+        if type(signal) is not np.ndarray:
+            assert type(signal[0]) == float, "scaled signal must be a float"
+            signal = np.asarray(signal)
+        assert signal.dtype.kind == 'f', "scaled signal must be a float"
+        self.scaled_signal = signal.astype(np.float32, copy=False)
 
-    def add_label(self, label, name, label_type):
-        """Add labels to class.
+    def _set_labels(self, labels, label_offsets):
+        """Set the concatenated labels and point each label, prediction and guide at its part of them
+
+        :param labels: structured array of labels with LABEL_DTYPE fields
+        :param label_offsets: dict of (label_type, name) to (start, end) in labels
+        """
+        self.labels = labels
+        self.label_offsets = OrderedDict(label_offsets)
+        self.label = defaultdict()
+        self.prediction = defaultdict()
+        self.guide = defaultdict()
+        for (label_type, name), (start, end) in self.label_offsets.items():
+            getattr(self, label_type)[name] = labels[start:end]
+
+    def _store_labels(self, new_labels):
+        """Add labels to the concatenated labels in one copy, replacing labels with the same type and name
+
+        :param new_labels: list of ((label_type, name), label) with LABEL_DTYPE fields in each label
+        """
+        new_keys = set(key for key, _ in new_labels)
+        segments = [(key, self.labels[start:end]) for key, (start, end) in self.label_offsets.items()
+                    if key not in new_keys]
+        segments.extend(OrderedDict(new_labels).items())
+        kmer_size = max(segment["kmer"].dtype.itemsize // (4 if segment["kmer"].dtype.kind == 'U' else 1)
+                        for _, segment in segments)
+        dtype = [(field, 'S{}'.format(max(kmer_size, 1)) if field == 'kmer' else field_type)
+                 for field, field_type in LABEL_DTYPE]
+        labels = np.zeros(sum(len(segment) for _, segment in segments), dtype=dtype)
+        label_offsets = OrderedDict()
+        start = 0
+        for key, segment in segments:
+            for field, _ in LABEL_DTYPE:
+                labels[field][start:start + len(segment)] = segment[field]
+            label_offsets[key] = (start, start + len(segment))
+            start += len(segment)
+        self._set_labels(labels, label_offsets)
+
+    def _check_label(self, label):
+        """Check a label indexes the signal and has the strand of the previous labels
 
         :param label: label numpy array with required fields ['raw_start', 'raw_length', 'reference_index',
                                                               'kmer', 'posterior_probability']
-        :param name: name of the label for signal
-        :param label_type: type of label  :['label', 'prediction', 'guide']
         """
-        assert label_type in ['label', 'prediction', 'guide'], \
-            "{} not in ['label', 'prediction', 'guide']: Must select an acceptable type".format(label_type)
         check_numpy_table(label, req_fields=('raw_start', 'raw_length', 'reference_index',
                                             'kmer', 'posterior_probability'))
 
@@ -81,7 +125,7 @@ class AlignedSignal(object):
         # check the labels are in the correct format
         assert min(label["raw_start"]) >= 0, "Raw start cannot be less than 0"
         assert 0 <= max(label["posterior_probability"]) <= 1, \
-            "posterior_probability must be between zero and one {}".format(row["posterior_probability"])
+            "posterior_probability must be between zero and one {}".format(max(label["posterior_probability"]))
 
         # make sure last label can actually index the signal correctly
         try:
@@ -102,35 +146,130 @@ class AlignedSignal(object):
         else:
             self.minus_strand = minus_strand
 
-        # set label with the specified name
-        if label_type == 'label':
-            self.label[name] = label
-        elif label_type == 'prediction':
-            self.prediction[name] = label
-        elif label_type == 'guide':
-            self.guide[name] = label
+    def add_label(self, label, name, label_type):
+        """Add labels to class.
+
+        Only the LABEL_DTYPE fields of label are kept, any other fields are dropped. Each call copies every
+        stored label, use add_labels to add many labels at once.
+
+        :param label: label numpy array with required fields ['raw_start', 'raw_length', 'reference_index',
+                                                              'kmer', 'posterior_probability']
+        :param name: name of the label for signal
+        :param label_type: type of label  :['label', 'prediction', 'guide']
+        """
+        self.add_labels([(name, label)], label_type)
+
+    def add_labels(self, labels, label_type):
+        """Add several labels of one type with a single copy of the stored labels
+
+        Only the LABEL_DTYPE fields of each label are kept, any other fields are dropped.
+
+        :param labels: list of (name, label numpy array) with the fields add_label requires
+        :param label_type: type of label  :['label', 'prediction', 'guide']
+        """
+        assert label_type in LABEL_TYPES, \
+            "{} not in ['label', 'prediction', 'guide']: Must select an acceptable type".format(label_type)
+        if len(labels) == 0:
+            return
+        for _, label in labels:
+            self._check_label(label)
+        self._store_labels([((label_type, name), label) for name, label in labels])
 
     def generate_label_mapping(self, name, scaled=True):
         """Create a generator of the mapping between the signal and the label
 
         :param name: name of mapping to create label mapping
         :param scaled: boolean option for returning scaled or unscaled signal
+        :return: views of the signal with the kmer, posterior probability and reference index of each label
         """
         assert name in self.label.keys(), "{} is not in labels dataset: {}".format(name, self.label.keys())
         label = self.label[name]
-        len_label = len(label)
         if scaled:
             signal = self.scaled_signal
         else:
             assert self.raw_signal is not None, "Must set raw signal in order to generate raw signal alignments"
             signal = self.raw_signal
-        for i, segment in enumerate(label):
-            start = segment["raw_start"]
-            if i < len_label - 1:
-                end = label[i + 1]["raw_start"]
-            else:
-                end = segment["raw_start"] + segment["raw_length"]
-            yield signal[start:end], segment['kmer'], segment['posterior_probability'], segment['reference_index']
+        # each label ends where the next one starts
+        starts = label["raw_start"]
+        ends = np.append(starts[1:], starts[-1:] + label["raw_length"][-1:])
+        for start, end, kmer, probability, reference_index in zip(starts.tolist(), ends.tolist(), label['kmer'],
+                                                                 label['posterior_probability'],
+                                                                 label['reference_index']):
+            yield signal[start:end], kmer, probability, reference_index
+
+    def to_arrays(self):
+        """Columns of the signal, labels and label offsets for saving
+
+        :return: dict of name to numpy array
+        """
+        arrays = {"scaled_signal": self.scaled_signal, "labels": self.labels,
+                  "label_types": np.array([key[0] for key in self.label_offsets], dtype='S10'),
+                  "label_names": np.array([key[1].encode() for key in self.label_offsets], dtype=bytes),
+                  "label_offsets": np.array(list(self.label_offsets.values()), dtype=np.int64).reshape(-1, 2),
+                  "minus_strand": np.array(-1 if self.minus_strand is None else int(self.minus_strand))}
+        if self.raw_signal is not None:
+            arrays["raw_signal"] = self.raw_signal
+        return arrays
+
+
+def aligned_signal_from_arrays(arrays):
+    """Create an AlignedSignal from the columns of AlignedSignal.to_arrays
+
+    :param arrays: dict like of name to array, eg. an open npz file or hdf5 group
+    """
+    aligned_signal = AlignedSignal(arrays["scaled_signal"][()])
+    if "raw_signal" in arrays:
+        aligned_signal.add_raw_signal(arrays["raw_signal"][()])
+    minus_strand = int(arrays["minus_strand"][()])
+    aligned_signal.minus_strand = None if minus_strand == -1 else bool(minus_strand)
+    keys = [(bytes.decode(label_type), bytes.decode(name)) for label_type, name in
+            zip(arrays["label_types"][()].tolist(), arrays["label_names"][()].tolist())]
+    offsets = [tuple(offset) for offset in arrays["label_offsets"][()].tolist()]
+    aligned_signal._set_labels(arrays["labels"][()], zip(keys, offsets))
+    return aligned_signal
+
+
+def _write_aligned_signal_group(parent, group_name, arrays):
+    """Replace a hdf5 group with a dataset for each array"""
+    if group_name in parent:
+        del parent[group_name]
+    group = parent.create_group(group_name)
+    for name, array in arrays.items():
+        group.create_dataset(name, data=array)
+
+
+def save_aligned_signal(aligned_signal, path, group_name="AlignedSignal"):
+    """Save an AlignedSignal to a npz file or to a group of a hdf5 file
+
+    :param aligned_signal: AlignedSignal object
+    :param path: path to npz file, path to hdf5 file or an open h5py group, eg. a Fast5 object
+    :param group_name: name of the hdf5 group, an existing group is replaced
+    """
+    arrays = aligned_signal.to_arrays()
+    if isinstance(path, h5py.Group):
+        _write_aligned_signal_group(path, group_name, arrays)
+    elif path.endswith(".npz"):
+        with open(path, "wb") as fh:
+            np.savez(fh, **arrays)
+    else:
+        with h5py.File(path, 'a') as h5_handle:
+            _write_aligned_signal_group(h5_handle, group_name, arrays)
+    return path
+
+
+def load_aligned_signal(path, group_name="AlignedSignal"):
+    """Load an AlignedSignal saved with save_aligned_signal
+
+    :param path: path to npz file, path to hdf5 file or an open h5py group
+    :param group_name: name of the hdf5 group
+    """
+    if isinstance(path, h5py.Group):
+        return aligned_signal_from_arrays(path[group_name])
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return aligned_signal_from_arrays(data)
+    with h5py.File(path, 'r') as h5_handle:
+        return aligned_signal_from_arrays(h5_handle[group_name])
 
 
 class CreateLabels(Fast5):
@@ -151,11 +290,11 @@ class CreateLabels(Fast5):
 
         :param fast5_path: path to fast5 file
         """
-        scaled_signal = self.get_read(raw=True, scale=True)
-        raw_signal = self.get_read(raw=True, scale=False)
+        # read the signal once and scale it from the raw signal
+        signal = self.get_raw_signal()
         # add raw signal information to AlignedSignal
-        aligned_signal = AlignedSignal(scaled_signal)
-        aligned_signal.add_raw_signal(raw_signal)
+        aligned_signal = AlignedSignal(signal.scaled)
+        aligned_signal.add_raw_signal(signal.raw)
         return aligned_signal
 
     def add_mea_labels(self):
@@ -193,9 +332,9 @@ class CreateLabels(Fast5):
         events = self.get_resegment_basecall()
         cigar_labels = create_labels_from_guide_alignment(events=events, sam_string=test_sam,
                                                           kmer_index=self.kmer_index)
-        for i, block in enumerate(cigar_labels):
-            # print(block)
-            self.aligned_signal.add_label(block, name="guide_alignment{}".format(i), label_type='guide')
+        # every cigar block is stored with one copy of the labels
+        self.aligned_signal.add_labels([("guide_alignment{}".format(i), block) for i, block in enumerate(cigar_labels)],
+                                       label_type='guide')
         return True
 
     def add_nanoraw_labels(self, reference):
@@ -329,37 +468,29 @@ def index_bases_from_events(events, kmer_index=2):
 
     :param kmer_index: index of kmer to create map
     :param events: original base-called events with required fields
+    :return: arrays of bases, raw starts, raw lengths and probabilities indexed by position in the sequence
     """
 
     check_numpy_table(events, req_fields=('raw_start', 'model_state', 'p_model_state', 'raw_length', 'move'))
     assert len(events[0]['model_state']) > kmer_index, \
         "Selected too big of a kmer_index len(kmer) !> kmer_index, {} !> {} ".format(len(events[0]['model_state']),
                                                                                      kmer_index)
-    probs = []
-    base_raw_starts = []
-    bases = []
-    base_raw_lengths = []
-    for i, event in enumerate(events):
-        if i == 0:
-            # initialize with first kmer
-            base_raw_starts.extend([event['raw_start'] for _ in event['model_state'][:kmer_index + 1]])
-            probs.extend([event['p_model_state'] for _ in event['model_state'][:kmer_index + 1]])
-            bases.extend([chr(x) for x in event['model_state'][:kmer_index + 1]])
-            base_raw_lengths.extend([event['raw_length'] for _ in event['model_state'][:kmer_index + 1]])
-        else:
-            # if there was a move, gather the information for each base by index
-            if event['move'] > 0:
-                char_moves = bytes.decode(event['model_state'][kmer_index:kmer_index + event['move']])
-                for x in range(event['move']):
-                    base_raw_starts.append(event['raw_start'])
-                    probs.append(event['p_model_state'])
-                    bases.append(char_moves[x])
-                    base_raw_lengths.append(event['raw_length'])
-    # gather last bases for the last event
-    base_raw_starts.extend([event['raw_start'] for _ in event['model_state'][kmer_index + 1:]])
-    probs.extend([event['p_model_state'] for _ in event['model_state'][kmer_index + 1:]])
-    bases.extend([chr(x) for x in event['model_state'][kmer_index + 1:]])
-    base_raw_lengths.extend([event['raw_length'] for _ in event['model_state'][kmer_index + 1:]])
+    kmers = model_state_bytes(events)
+    kmer_length = kmers.shape[1]
+    moves = np.maximum(events['move'], 0)
+    assert np.all(moves[1:] <= kmer_length - kmer_index), \
+        "Moves can not be larger than len(kmer) - kmer_index: {}".format(kmer_length - kmer_index)
+    # first kmer up to kmer_index, 'move' bases from kmer_index for each other event and the end of the last kmer
+    columns = np.arange(kmer_length)
+    selected = (columns >= kmer_index) & (columns < kmer_index + moves[:, None])
+    selected[0] = columns <= kmer_index
+    bases_per_event = selected.sum(axis=1)
+    bases_per_event[-1] += kmer_length - kmer_index - 1
+    bases = np.concatenate((kmers[selected], kmers[-1, kmer_index + 1:]))
+    bases = bases.view('S1').astype('U1')
+    base_raw_starts = np.repeat(events['raw_start'], bases_per_event)
+    base_raw_lengths = np.repeat(events['raw_length'], bases_per_event)
+    probs = np.repeat(events['p_model_state'], bases_per_event)
 
     # the index of each corresponds to the index of the final sequence
     return bases, base_raw_starts, base_raw_lengths, probs
@@ -445,8 +576,9 @@ def embed_eventalign_events(fast5_dir, reference, output_dir, threads=1, overwri
         print(fast5path)
         print("template", template)
         if template or complement:
-            handle = Fast5(fast5path, read='r+')
-            handle.set_eventalign_table(template=template, complement=complement, meta=attributes, overwrite=True)
+            with Fast5(fast5path, read='r+') as handle, handle.write_batch():
+                handle.set_eventalign_table(template=template, complement=complement, meta=attributes,
+                                            overwrite=True)
         else:
             print("{} did not align".format(fast5path))
     return True
@@ -480,26 +612,18 @@ def match_events_with_eventalign(events=None, event_detections=None, minus=False
     label = np.zeros(len(events), dtype=[('raw_start', int), ('raw_length', int), ('reference_index', int),
                                             ('posterior_probability', float), ('kmer', 'S6')])
 
-    label['raw_start'] = [event_detections[x]["start"] for x in events["event_index"]]
-    label['raw_length'] = [event_detections[x]["length"] for x in events["event_index"]]
+    label['raw_start'] = np.asarray(event_detections["start"])[events["event_index"]]
+    label['raw_length'] = np.asarray(event_detections["length"])[events["event_index"]]
     label['reference_index'] = events["position"]
 
-    def convert_to_str(string):
-        """Helper function to catch bytes as strings"""
-        if type(string) is str:
-            return string
-        else:
-            return bytes.decode(string)
-
-    flip = ReverseComplement()
     if minus:
         if rna:
-            kmers = [flip.complement(convert_to_str(x)) for x in events["reference_kmer"]]
+            kmers = transform_kmers(events["reference_kmer"], complement=True)
         else:
-            kmers = [flip.reverse_complement(convert_to_str(x)) for x in events["reference_kmer"]]
+            kmers = transform_kmers(events["reference_kmer"], reverse=True, complement=True)
     else:
         if rna:
-            kmers = [flip.reverse(convert_to_str(x)) for x in events["reference_kmer"]]
+            kmers = transform_kmers(events["reference_kmer"], reverse=True)
         else:
             kmers = events["reference_kmer"]
     label['kmer'] = kmers
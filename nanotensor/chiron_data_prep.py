@@ -17,6 +17,7 @@ import re
 from timeit import default_timer as timer
 from nanonet.fast5 import Fast5
 from nanotensor.utils import list_dir, DotDict
+from nanotensor.read_catalog import get_catalog_paths
 
 alignment_stats = collections.namedtuple('alignment_stats', ['total_reads', 'unaligned_reads', 'deletion_rate',
                                                              'insertion_rate', 'mismatch_rate', 'identity_rate'])
@@ -135,11 +136,17 @@ def label_chiron_data(fast5_path, output_dir, name):
     return signal_path, label_path
 
 
-def create_label_chiron_data_args(fast5dir, output_dir, output_name, verbose=False):
-    """Create arguments for label_chiron_data function"""
-    assert os.path.isdir(fast5dir) is True, "fast5 directory does not exist"
+def create_label_chiron_data_args(fast5dir, output_dir, output_name, verbose=False, catalog=None):
+    """Create arguments for label_chiron_data function
+
+    :param catalog: use the files of a read catalog (see read_catalog.query_read_catalog) instead of listing fast5dir
+    """
     assert os.path.isdir(output_dir) is True, "output directory does not exist"
-    fast5files = list_dir(fast5dir, ext="fast5")
+    if catalog is not None:
+        fast5files = get_catalog_paths(catalog)
+    else:
+        assert os.path.isdir(fast5dir) is True, "fast5 directory does not exist"
+        fast5files = list_dir(fast5dir, ext="fast5")
     counter = 0
     for read in fast5files:
         name = output_name + str(counter)
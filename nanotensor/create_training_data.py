@@ -19,6 +19,7 @@ from nanotensor.data_preparation import TrainingData
 from nanotensor.error import Usage
 from nanotensor.utils import merge_two_dicts, load_json, DotDict, multiprocess_data, create_time_directory, \
     save_config_file, tarball_files, list_dir, upload_file_to_s3
+from nanotensor.read_catalog import get_catalog_paths
 from nanotensor.chiron_data_prep import create_label_chiron_data_args, label_chiron_data_multiprocess_wrapper, \
     call_nanoraw
 
@@ -194,10 +195,14 @@ def create_training_data(args):
     return output_file_path
 
 
-def create_training_data_args(log_file, prefix, args, exception=AssertionError):
-    """Create generator of specific arguments for create_training_data"""
+def create_training_data_args(log_file, prefix, args, exception=AssertionError, catalog=None):
+    """Create generator of specific arguments for create_training_data
+
+    :param catalog: only use fast5 files in a read catalog (see read_catalog.query_read_catalog)
+    """
     assert os.path.exists(log_file), "Log file does not exist: {}".format(log_file)
     assert type(prefix) is str or type(prefix) is unicode
+    catalog_paths = None if catalog is None else set(get_catalog_paths(catalog))
     counter = 0
     with open(log_file, 'r') as log:
         for line in log:
@@ -205,6 +210,8 @@ def create_training_data_args(log_file, prefix, args, exception=AssertionError):
                 line = line.rstrip().split('\t')
                 # get file paths
                 fast5 = os.path.abspath(line[0])
+                if catalog_paths is not None and fast5 not in catalog_paths:
+                    continue
                 tsv = os.path.abspath(line[1])
                 assert os.path.exists(fast5), "Fast5 file does not exist: {}".format(fast5)
                 assert os.path.exists(tsv), "alignment file does not exist: {}".format(tsv)
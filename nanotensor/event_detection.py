@@ -15,16 +15,82 @@ import re
 import numpy as np
 import traceback
 from collections import defaultdict
-from timeit import default_timer as timer
-from PyPore.parsers import SpeedyStatSplit
+from operator import attrgetter
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
 from nanotensor.fast5 import Fast5
-from nanonet.eventdetection.filters import minknow_event_detect
-from nanonet.segment import segment
-from nanonet.features import make_basecall_input_multi
-from py3helpers.utils import check_numpy_table, list_dir, TimeStamp, change_np_field_type, merge_dicts
+from py3helpers.utils import check_numpy_table, TimeStamp, merge_dicts
 from py3helpers.seq_tools import create_fastq_line, check_fastq_line, ReverseComplement, pairwise_alignment_accuracy
 
 
+# event table written by the event detection functions. raw_start and raw_length are the event bounds, start and
+# length in seconds are derived from them by event_seconds because fast5 event tables need them
+EVENT_TABLE_DTYPE = [('start', float), ('length', float), ('mean', float), ('stdv', float), ('model_state', 'S5'),
+                     ('move', '<i4'), ('raw_start', int), ('raw_length', int), ('p_model_state', float)]
+
+
+def event_seconds(raw_starts, raw_lengths, sampling_freq, start_time):
+    """Start and length in seconds of events given as raw signal indices
+
+    :param raw_starts: start index of each event in the raw signal
+    :param raw_lengths: number of samples of each event
+    :param sampling_freq: sampling frequency of ADC in Hz
+    :param start_time: start time from fast5 file (time in seconds * sampling frequency)
+    :return: float64 arrays of start times from the start of the experiment and lengths
+    """
+    starts = np.asarray(raw_starts) / sampling_freq + (start_time / sampling_freq)
+    lengths = np.asarray(raw_lengths) / float(sampling_freq)
+    return starts, lengths
+
+
+def create_event_table(raw_starts, raw_lengths, means, stdvs, sampling_freq, start_time):
+    """Create an event table column by column
+
+    :param raw_starts: start index of each event in the raw signal
+    :param raw_lengths: number of samples of each event
+    :param means: mean current of each event
+    :param stdvs: standard deviation of the current of each event
+    :param sampling_freq: sampling frequency of ADC in Hz
+    :param start_time: start time from fast5 file (time in seconds * sampling frequency)
+    :return: Table of events without model state or move information
+    """
+    event_table = np.zeros(len(raw_starts), dtype=EVENT_TABLE_DTYPE)
+    event_table['start'], event_table['length'] = event_seconds(raw_starts, raw_lengths, sampling_freq, start_time)
+    event_table['mean'] = means
+    event_table['stdv'] = stdvs
+    event_table['raw_start'] = raw_starts
+    event_table['raw_length'] = raw_lengths
+    return event_table
+
+
+def speedy_events_to_table(events, sampling_freq, start_time):
+    """Convert SpeedyStatSplit segments to an event table
+
+    :param events: segments from SpeedyStatSplit.parse with start and duration in samples
+    :param sampling_freq: sampling frequency of ADC in Hz
+    :param start_time: start time from fast5 file (time in seconds * sampling frequency)
+    """
+    # segments are python objects, each field is gathered into an array without a python loop
+    fields = [np.fromiter(map(attrgetter(name), events), dtype=np.float64, count=len(events))
+              for name in ("start", "duration", "mean", "std")]
+    return create_event_table(raw_starts=fields[0], raw_lengths=fields[1], means=fields[2], stdvs=fields[3],
+                              sampling_freq=sampling_freq, start_time=start_time)
+
+
+def minknow_events_to_table(events, sampling_freq, start_time):
+    """Convert the events from minknow_event_detect to an event table
+
+    Event times are rounded to the nearest sample and the seconds are derived from the samples.
+
+    :param events: event array with start and length in seconds, mean and stdv
+    :param sampling_freq: sampling frequency of ADC in Hz
+    :param start_time: start time from fast5 file (time in seconds * sampling frequency)
+    """
+    return create_event_table(raw_starts=np.round(events["start"] * sampling_freq),
+                              raw_lengths=np.round(events["length"] * sampling_freq),
+                              means=events["mean"], stdvs=events["stdv"], sampling_freq=sampling_freq,
+                              start_time=start_time)
+
+
 def create_speedy_event_table(signal, sampling_freq, start_time, min_width=5, max_width=80, min_gain_per_sample=0.008,
                               window_width=800):
     """Create new event table using SpeedyStatSplit Event detection
@@ -41,29 +107,15 @@ def create_speedy_event_table(signal, sampling_freq, start_time, min_width=5, ma
     assert np.sign(start_time) == 1, "Start time has to be positive: {}".format(start_time)
     assert type(signal[0]) is np.float64, "Signal needs to be in pA. Not ADC counts"
 
+    # PyPore is slow to import and only needed by this detector
+    from PyPore.parsers import SpeedyStatSplit
     # define speedy stat split
     parser = SpeedyStatSplit(min_width=min_width, max_width=max_width,
                              min_gain_per_sample=min_gain_per_sample,
                              window_width=window_width, sampling_freq=sampling_freq)
     # parse events
     events = parser.parse(np.asarray(signal, dtype=np.float64))
-    num_events = len(events)
-    # create empty event table
-    event_table = np.empty(num_events, dtype=[('start', float), ('length', float),
-                                              ('mean', float), ('stdv', float),
-                                              ('model_state', 'S5'), ('move', '<i4'),
-                                              ('raw_start', int), ('raw_length', int),
-                                              ('p_model_state', float)])
-    # set events into event table
-    for i, event in enumerate(events):
-        event_table['start'][i] = event.start / sampling_freq + (start_time / sampling_freq)
-        event_table['raw_start'][i] = event.start
-        event_table['length'][i] = event.duration / sampling_freq
-        event_table['raw_length'][i] = event.duration
-        event_table['mean'][i] = event.mean
-        event_table['stdv'][i] = event.std
-
-    return event_table
+    return speedy_events_to_table(events, sampling_freq, start_time)
 
 
 def create_minknow_event_table(signal, sampling_freq, start_time,
@@ -80,178 +132,440 @@ def create_minknow_event_table(signal, sampling_freq, start_time,
     """
     assert np.sign(start_time) == 1, "Start time has to be positive: {}".format(start_time)
     assert type(signal[0]) is np.float64, "Signal needs to be in pA. Not ADC counts"
+    from nanonet.eventdetection.filters import minknow_event_detect
     events = minknow_event_detect(np.asarray(signal, dtype=float), sample_rate=sampling_freq,
                                   get_peaks=False, window_lengths=window_lengths,
                                   thresholds=thresholds, peak_height=peak_height)
-    num_events = len(events)
-    event_table = np.empty(num_events, dtype=[('start', float), ('length', float),
-                                              ('mean', float), ('stdv', float),
-                                              ('model_state', 'S5'), ('move', '<i4'),
-                                              ('raw_start', int), ('raw_length', int),
-                                              ('p_model_state', float)])
-    for i, event in enumerate(events):
-        event_table['start'][i] = event["start"] + (start_time / sampling_freq)
-        event_table['length'][i] = event["length"]
-        event_table['mean'][i] = event["mean"]
-        event_table['stdv'][i] = event["stdv"]
-        event_table['raw_start'][i] = np.round(event["start"] * sampling_freq)
-        event_table['raw_length'][i] = np.round(event["length"] * sampling_freq)
+    return minknow_events_to_table(events, sampling_freq, start_time)
 
-    return event_table
 
+def compute_tstat(sums, sumsqs, window_length):
+    """t-statistic between the window before and the window after each sample
 
-def create_anchor_kmers(new_events, old_events):
+    :param sums: cumulative sum of the signal with a leading zero
+    :param sumsqs: cumulative sum of the squared signal with a leading zero
+    :param window_length: number of samples in each window
+    :return: float32 t-statistic per sample, zero where a window does not fit
+    """
+    num_samples = len(sums) - 1
+    tstat = np.zeros(num_samples, dtype=np.float32)
+    if num_samples < 2 * window_length or window_length < 2:
+        return tstat
+    end = num_samples - window_length + 1
+    # window before sample i is [i - window_length, i), window after is [i, i + window_length)
+    mean1 = (sums[window_length:end] - sums[:end - window_length]) / window_length
+    mean2 = (sums[2 * window_length:] - sums[window_length:end]) / window_length
+    combined_var = (sumsqs[window_length:end] - sumsqs[:end - window_length]) / window_length - mean1 ** 2
+    combined_var += (sumsqs[2 * window_length:] - sumsqs[window_length:end]) / window_length - mean2 ** 2
+    np.maximum(combined_var, np.finfo(np.float64).tiny, out=combined_var)
+    tstat[window_length:end] = np.abs(mean2 - mean1) / np.sqrt(combined_var / window_length)
+    return tstat
+
+
+def find_tstat_peaks(tstat, threshold, window_length, peak_height):
+    """Find peaks of a t-statistic
+
+    A peak is the largest value within half a window on each side, is above threshold and rises more than
+    peak_height above the lowest value within a window on each side.
+
+    :param tstat: t-statistic from compute_tstat
+    :param threshold: minimum t-statistic of a peak
+    :param window_length: t-test window length
+    :param peak_height: minimum height of a peak above its surroundings
+    :return: sorted sample indices of the peaks
+    """
+    num_samples = len(tstat)
+    half_window = max(1, window_length // 2)
+    local_max = maximum_filter1d(tstat, size=2 * half_window + 1, mode='constant', cval=0)
+    peaks = np.flatnonzero((tstat > threshold) & (tstat >= local_max))
+    if len(peaks) == 0:
+        return peaks
+    # plateaus give several maxima, keep the first one
+    peaks = peaks[np.concatenate(([True], np.diff(peaks) > half_window))]
+    # lowest value of the windows [i - window_length, i] and [i, i + window_length]
+    size = window_length + 1
+    window_min = minimum_filter1d(tstat, size=size, mode='nearest')
+    left_min = window_min[np.clip(peaks - window_length + size // 2, 0, num_samples - 1)]
+    right_min = window_min[np.clip(peaks + size // 2, 0, num_samples - 1)]
+    height = tstat[peaks]
+    return peaks[(height - left_min > peak_height) & (height - right_min > peak_height)]
+
+
+def short_long_peak_detector(tstats, thresholds, window_lengths, peak_height):
+    """Combine the peaks of t-statistics from short to long windows
+
+    Peaks of longer windows are only used where no shorter window peak is within the shortest window length.
+
+    :param tstats: t-statistics from compute_tstat, shortest window first
+    :param thresholds: threshold of each t-statistic
+    :param window_lengths: window length of each t-statistic
+    :param peak_height: minimum height of a peak above its surroundings
+    :return: sorted sample indices of event boundaries
+    """
+    peaks = np.zeros(0, dtype=np.int64)
+    for tstat, threshold, window_length in zip(tstats, thresholds, window_lengths):
+        new_peaks = find_tstat_peaks(tstat, threshold, window_length, peak_height)
+        if len(peaks) > 0 and len(new_peaks) > 0:
+            # distance to the closest accepted peak
+            index = np.searchsorted(peaks, new_peaks)
+            left = np.abs(new_peaks - peaks[np.maximum(index - 1, 0)])
+            right = np.abs(peaks[np.minimum(index, len(peaks) - 1)] - new_peaks)
+            new_peaks = new_peaks[np.minimum(left, right) > window_lengths[0]]
+        peaks = np.union1d(peaks, new_peaks)
+    return peaks
+
+
+def ttest_event_detect(signal, window_lengths=(16, 40), thresholds=(8.0, 4.0), peak_height=1.0):
+    """Detect events with t-tests between adjacent windows of the signal in one vectorized pass
+
+    :param signal: signal in pA, converted to float32 if needed
+    :param window_lengths: t-test window lengths, shortest first
+    :param thresholds: t-test threshold of each window length
+    :param peak_height: minimum height of a t-statistic peak above its surroundings
+    :return: raw_starts, raw_lengths, means and stdvs of the events
+    """
+    assert len(window_lengths) == len(thresholds), "Need a threshold for every window length"
+    signal = np.asarray(signal, dtype=np.float32)
+    num_samples = len(signal)
+    # cumulative sums in float64 so long reads do not lose precision
+    sums = np.zeros(num_samples + 1, dtype=np.float64)
+    sumsqs = np.zeros(num_samples + 1, dtype=np.float64)
+    np.cumsum(signal, dtype=np.float64, out=sums[1:])
+    np.cumsum(np.square(signal, dtype=np.float64), out=sumsqs[1:])
+
+    tstats = [compute_tstat(sums, sumsqs, window_length) for window_length in window_lengths]
+    peaks = short_long_peak_detector(tstats, thresholds, window_lengths, peak_height)
+    boundaries = np.union1d(peaks[(peaks > 0) & (peaks < num_samples)], [0, num_samples]).astype(np.int64)
+    if num_samples == 0:
+        boundaries = boundaries[:1]
+    raw_starts = boundaries[:-1]
+    raw_lengths = np.diff(boundaries)
+    means = (sums[boundaries[1:]] - sums[raw_starts]) / raw_lengths
+    variances = (sumsqs[boundaries[1:]] - sumsqs[raw_starts]) / raw_lengths - means ** 2
+    stdvs = np.sqrt(np.maximum(variances, 0))
+    return raw_starts, raw_lengths, means, stdvs
+
+
+def create_ttest_event_table(signal, sampling_freq, start_time, window_lengths=(16, 40), thresholds=(8.0, 4.0),
+                             peak_height=1.0):
+    """Create new event table using ttest_event_detect event detection
+
+    :param signal: array of signal in pA for finding events, float32 avoids a copy
+    :param sampling_freq: sampling frequency of ADC in Hz
+    :param start_time: start time from fast5 file (time in seconds * sampling frequency
+    :param window_lengths: t-test windows for ttest_event_detect
+    :param thresholds: t-test thresholds for ttest_event_detect
+    :param peak_height: peak height param for ttest_event_detect
+    :return: Table of events without model state or move information
+    """
+    assert np.sign(start_time) == 1, "Start time has to be positive: {}".format(start_time)
+    assert np.asarray(signal).dtype.kind == 'f', "Signal needs to be in pA. Not ADC counts"
+    raw_starts, raw_lengths, means, stdvs = ttest_event_detect(signal, window_lengths=window_lengths,
+                                                               thresholds=thresholds, peak_height=peak_height)
+    return create_event_table(raw_starts=raw_starts, raw_lengths=raw_lengths, means=means, stdvs=stdvs,
+                              sampling_freq=sampling_freq, start_time=start_time)
+
+
+def scale_signal_chunk(chunk, offset=None, raw_unit=None):
+    """Scale a chunk of signal to float32 pA
+
+    :param chunk: RawSignal, integer ADC counts or signal already in pA
+    :param offset: channel offset, needed for integer chunks
+    :param raw_unit: channel range / digitisation, needed for integer chunks
+    :return: float32 signal in pA
+    """
+    if hasattr(chunk, "scaled"):
+        return chunk.scaled
+    chunk = np.asarray(chunk)
+    if chunk.dtype.kind in 'iu':
+        assert offset is not None and raw_unit is not None, "Need offset and raw_unit to scale ADC counts"
+        scaled = np.empty(len(chunk), dtype=np.float32)
+        np.add(chunk, offset, out=scaled, dtype=np.float32)
+        scaled *= np.float32(raw_unit)
+        return scaled
+    return chunk.astype(np.float32, copy=False)
+
+
+def stream_ttest_event_detect(chunks, window_lengths=(16, 40), thresholds=(8.0, 4.0), peak_height=1.0,
+                              offset=None, raw_unit=None):
+    """Run ttest_event_detect over consecutive chunks of a signal and yield events as soon as they are final
+
+    Each chunk is joined to an overlap of the previous chunks which is long enough to compute the t-statistic and
+    pick peaks as if the whole signal was in memory. Boundaries within the overlap at the end of a chunk wait for
+    the next chunk and the mean and standard deviation of the open event are kept as running sums, so memory is
+    bounded by the chunk size and not the read length.
+
+    :param chunks: iterable of RawSignal, integer ADC counts or signal in pA
+    :param window_lengths: t-test window lengths, shortest first
+    :param thresholds: t-test threshold of each window length
+    :param peak_height: minimum height of a t-statistic peak above its surroundings
+    :param offset: channel offset for integer chunks
+    :param raw_unit: channel range / digitisation for integer chunks
+    :return: generator of raw_starts, raw_lengths, means and stdvs of the finished events
+    """
+    assert len(window_lengths) == len(thresholds), "Need a threshold for every window length"
+    # samples needed on each side of a peak to compute it like ttest_event_detect
+    overlap = 2 * max(window_lengths) + 1
+    context = np.zeros(0, dtype=np.float32)
+    # absolute index of context[0] and of the first sample not decided yet
+    context_start = 0
+    decided = 0
+    # running sums of the open event
+    event_start = 0
+    event_sum = 0.0
+    event_sumsq = 0.0
+    chunks = iter(chunks)
+    chunk = next(chunks, None)
+    while chunk is not None:
+        # scale before reading ahead, chunks from Fast5.iterate_raw_signal share one buffer
+        signal = np.concatenate((context, scale_signal_chunk(chunk, offset=offset, raw_unit=raw_unit)))
+        next_chunk = next(chunks, None)
+        last_chunk = next_chunk is None
+        sums = np.zeros(len(signal) + 1, dtype=np.float64)
+        sumsqs = np.zeros(len(signal) + 1, dtype=np.float64)
+        np.cumsum(signal, dtype=np.float64, out=sums[1:])
+        np.cumsum(np.square(signal, dtype=np.float64), out=sumsqs[1:])
+        tstats = [compute_tstat(sums, sumsqs, window_length) for window_length in window_lengths]
+        peaks = short_long_peak_detector(tstats, thresholds, window_lengths, peak_height)
+
+        low = decided - context_start
+        high = len(signal) if last_chunk else max(low, len(signal) - overlap)
+        peaks = peaks[(peaks >= low) & (peaks < high)]
+        boundaries = np.concatenate(([low], peaks, [high]))
+        segment_sums = sums[boundaries[1:]] - sums[boundaries[:-1]]
+        segment_sumsqs = sumsqs[boundaries[1:]] - sumsqs[boundaries[:-1]]
+        if last_chunk:
+            # the end of the signal closes the last event
+            peaks = np.append(peaks, high)
+        if len(peaks) > 0:
+            raw_starts = np.concatenate(([event_start], peaks[:-1] + context_start)).astype(np.int64)
+            raw_lengths = peaks + context_start - raw_starts
+            event_sums = segment_sums[:len(peaks)].copy()
+            event_sumsqs = segment_sumsqs[:len(peaks)].copy()
+            event_sums[0] += event_sum
+            event_sumsqs[0] += event_sumsq
+            means = event_sums / raw_lengths
+            stdvs = np.sqrt(np.maximum(event_sumsqs / raw_lengths - means ** 2, 0))
+            keep = raw_lengths > 0
+            yield raw_starts[keep], raw_lengths[keep], means[keep], stdvs[keep]
+            event_start = int(peaks[-1] + context_start)
+            event_sum = 0.0
+            event_sumsq = 0.0
+        if not last_chunk:
+            event_sum += segment_sums[-1]
+            event_sumsq += segment_sumsqs[-1]
+            decided = context_start + high
+            new_start = max(0, high - overlap)
+            context = signal[new_start:].copy()
+            context_start += new_start
+        chunk = next_chunk
+
+
+def stream_ttest_event_table(fast5handle, sampling_freq, start_time, chunk_size=2 ** 20, read_number=None,
+                             window_lengths=(16, 40), thresholds=(8.0, 4.0), peak_height=1.0):
+    """Event tables of a read created chunk by chunk from the raw signal of a fast5 file
+
+    :param fast5handle: open Fast5 object
+    :param sampling_freq: sampling frequency of ADC in Hz
+    :param start_time: start time from fast5 file (time in seconds * sampling frequency
+    :param chunk_size: number of raw samples read at a time
+    :param read_number: read number of the raw read, default first read
+    :param window_lengths: t-test windows for ttest_event_detect
+    :param thresholds: t-test thresholds for ttest_event_detect
+    :param peak_height: peak height param for ttest_event_detect
+    :return: generator of event tables without model state or move information
+    """
+    assert np.sign(start_time) == 1, "Start time has to be positive: {}".format(start_time)
+    chunks = fast5handle.iterate_raw_signal(chunk_size, read_number=read_number)
+    for raw_starts, raw_lengths, means, stdvs in stream_ttest_event_detect(chunks, window_lengths=window_lengths,
+                                                                           thresholds=thresholds,
+                                                                           peak_height=peak_height):
+        yield create_event_table(raw_starts=raw_starts, raw_lengths=raw_lengths, means=means, stdvs=stdvs,
+                                 sampling_freq=sampling_freq, start_time=start_time)
+
+
+def create_streaming_event_table(fast5handle, sampling_freq, start_time, chunk_size=2 ** 20, read_number=None,
+                                 window_lengths=(16, 40), thresholds=(8.0, 4.0), peak_height=1.0):
+    """Create new event table with ttest_event_detect without reading the whole signal into memory
+
+    :param fast5handle: open Fast5 object
+    :param sampling_freq: sampling frequency of ADC in Hz
+    :param start_time: start time from fast5 file (time in seconds * sampling frequency
+    :param chunk_size: number of raw samples read at a time
+    :param read_number: read number of the raw read, default first read
+    :param window_lengths: t-test windows for ttest_event_detect
+    :param thresholds: t-test thresholds for ttest_event_detect
+    :param peak_height: peak height param for ttest_event_detect
+    :return: Table of events without model state or move information
+    """
+    tables = list(stream_ttest_event_table(fast5handle, sampling_freq, start_time, chunk_size=chunk_size,
+                                           read_number=read_number, window_lengths=window_lengths,
+                                           thresholds=thresholds, peak_height=peak_height))
+    if len(tables) == 0:
+        return np.zeros(0, dtype=EVENT_TABLE_DTYPE)
+    return np.concatenate(tables)
+
+
+# event detector name -> function creating the event table and name saved in the analysis attributes
+EVENT_DETECTORS = {"speedy": (create_speedy_event_table, "speedy_stat_split"),
+                   "minknow": (create_minknow_event_table, "minknow_event_detect"),
+                   "ttest": (create_ttest_event_table, "ttest_event_detect")}
+
+
+# ticks per second of event times without a sampling frequency, the same as rounding seconds to 7 decimals
+SECOND_TICKS = 1e7
+
+
+def event_sample_bounds(events, sampling_freq=None, start_time=0):
+    """Start and end of each event as int64 sample indices from the start of the read
+
+    Integer 'start' fields are sample indices already, as are 'raw_start' and 'raw_length' when the sampling
+    frequency is known. Times in seconds are rounded to the nearest sample, or to SECOND_TICKS without a sampling
+    frequency.
+
+    :param events: event table with 'start' and 'length' fields
+    :param sampling_freq: sampling frequency of ADC in Hz
+    :param start_time: start time from fast5 file (time in seconds * sampling frequency), must be 0 without a
+                       sampling frequency
+    :return: int64 arrays of start and end indices
+    """
+    check_numpy_table(events, req_fields=('start', 'length'))
+    if events["start"].dtype.kind in 'ui':
+        assert sampling_freq is not None, "Events in samples can only be compared with a sampling frequency"
+        starts = events["start"].astype(np.int64)
+        ends = starts + events["length"].astype(np.int64)
+    elif sampling_freq is not None and 'raw_start' in events.dtype.names and 'raw_length' in events.dtype.names:
+        starts = events["raw_start"].astype(np.int64)
+        ends = starts + events["raw_length"].astype(np.int64)
+    else:
+        # start_time is in samples and can not be converted to ticks without a sampling frequency
+        assert sampling_freq is not None or start_time == 0, \
+            "start_time can only be subtracted with a sampling frequency: {}".format(start_time)
+        ticks = SECOND_TICKS if sampling_freq is None else sampling_freq
+        starts = np.rint(events["start"] * ticks - start_time).astype(np.int64)
+        ends = np.rint((events["start"] + events["length"]) * ticks - start_time).astype(np.int64)
+    return starts, ends
+
+
+def create_anchor_kmers(new_events, old_events, sampling_freq=None, start_time=0):
     """
     Create anchor kmers for new event table.
 
     Basically, grab kmer and move information from previous event table and
     pull events covering the same time span into new event table.
     :param new_events: new event table
-    :param old_events: event table from Fast5 file
+    :param old_events: event table from Fast5 file, sorted by start
+    :param sampling_freq: compare events as sample indices, see event_sample_bounds. Default compares times in seconds
+                          as integer ticks of 1 / SECOND_TICKS seconds
+    :param start_time: start time from fast5 file (time in seconds * sampling frequency)
     :return New event table
     """
-    num_old_events = len(old_events)
     check_numpy_table(new_events, req_fields=('start', 'length', 'mean', 'stdv', 'model_state', 'move', 'p_model_state'))
     check_numpy_table(old_events, req_fields=('start', 'length', 'mean', 'stdv', 'model_state', 'move', 'p_model_state'))
-    # index of old events
-    old_indx = 0
-    # start index to trim new_events for those with data from old_events
-    start_index = 0
-    end_index = len(new_events)
-    # personal tracker for dealing with how the segmentation algorithm is working
-    most_moves = 0
-    # tracking overlaped events
-    selected_overlap = False
-    check_overlap = False
-    homopolymer = False
-    # keep track of events passed
-    last_left_over = 0
-    for i, event in enumerate(new_events):
-        # skip events that occur before labels from old events
-        if old_events[0]["start"] <= event["start"]:
-            # time of old event in new event for a given kmer
-            time = []
-            probs = []
-            moves = []
-            kmers = []
-            # new event's start and end
-            current_event_start = round(event["start"], 7)
-            current_event_end = round(current_event_start + event["length"], 7)
-            # if first event or event start is after current old_event start.
-            if old_indx != num_old_events:
-                prev_kmer = str()
-                num_loops = 0
-                # print(round(old_events[old_indx]["start"], 7), old_events[old_indx]["length"], current_event_end, round(old_events[old_indx]["start"], 7) < current_event_end)
-                while round(old_events[old_indx]["start"], 7) < current_event_end and old_indx != num_old_events:
-                    # print("INSIDE LOOP", round(old_events[old_indx]["start"], 7), old_events[old_indx]["length"], current_event_end, round(old_events[old_indx]["start"], 7) < current_event_end)
-                    # deal with bad event files and final event
-                    if old_indx == num_old_events-1:
-                        old_event_end = round(old_events[old_indx]["start"] + old_events[old_indx]["length"], 7)
-                    else:
-                        old_event_end = round(old_events[old_indx+1]["start"], 7)
-                    old_event_start = round(old_events[old_indx]["start"], 7)
-                    old_kmer = bytes.decode(old_events[old_indx]["model_state"])
-                    # homopolymers or stays should be tracked together
-                    if old_kmer == prev_kmer:
-                        if len(set(old_kmer)) == 1:
-                            if not homopolymer and selected_overlap and num_loops <= 1:
-                                moves[index] = 0
-                            homopolymer = True
-                        else:
-                            homopolymer = False
-                        index = kmers.index(old_kmer)
-                        probs[index] = max(probs[index], old_events[old_indx]["p_model_state"])
-                        moves[index] += old_events[old_indx]["move"]
-                    else:
-                        # add new kmer
-                        index = len(time)
-                        kmers.append(old_kmer)
-                        probs.append(old_events[old_indx]["p_model_state"])
-                        moves.append(old_events[old_indx]["move"])
-                        time.append(0)
-                        homopolymer = False
-                    prev_kmer = old_kmer
-                    # if old event passes through current event calculate correct time in current event
-                    # deal with old events ending after the new event end
-                    if old_event_end > current_event_end:
-                        time[index] += current_event_end - old_event_start
-                        new_check_overlap = True
-                        break
-                    # check if entire old event is within the new event or not
-                    else:
-                        if old_event_start < current_event_start:
-                            time[index] += old_event_end - current_event_start
-                        else:
-                            time[index] += old_event_end - old_event_start
-                        # if old_event_end != current_event_end:
-                        old_indx += 1
-                        new_check_overlap = False
-                    num_loops += 1
-                    # break loop at end of old events
-                    if old_indx == num_old_events:
-                        break
-            else:
-                end_index = i
-            num_kmers = len(kmers)
-            # select index of best kmer to assign
-            if num_kmers == 1:
-                best_index = 0
-                left_over = 0
-            elif num_kmers > 1:
-                # select on time in new event only
-                best_index = time.index(max(time))
-                # if there are several old events in a new event, track how many
-                if new_check_overlap:
-                    left_over = sum(moves[best_index+1:-1])
-                else:
-                    left_over = sum(moves[best_index+1:])
-            else:
-                # end of possible alignments
-                end_index = i
-                break
-            # if previous old event overlapped into current new event
-            # check if old event is going to be assigned twice
-            if selected_overlap and best_index == 0 and check_overlap:
-                if homopolymer:
-                    move = moves[best_index]
-                else:
-                    move = 0
-            elif selected_overlap and best_index != 0 and check_overlap:
-                move = min(5, moves[best_index] + last_left_over)
-            else:
-                move = min(5, moves[best_index]+sum(moves[:best_index])+last_left_over)
-                if most_moves < moves[best_index]+sum(moves[:best_index])+last_left_over:
-                    most_moves = moves[best_index]+sum(moves[:best_index])+last_left_over
-            # print(kmers, moves, left_over, moves[best_index], sum(moves[:best_index]), last_left_over, move)
-            # if new overlap
-            if new_check_overlap:
-                # new overlapped event will be tracked on next new_event so we drop a left_over count
-                left_over = max(0, left_over-1)
-                if most_moves < left_over-1:
-                    most_moves = left_over-1
-
-                # check if we currently selected an overlapping old event
-                if best_index == num_kmers-1:
-                    selected_overlap = True
-                else:
-                    selected_overlap = False
-            else:
-                selected_overlap = False
-
-            kmer = kmers[best_index]
-            prob = probs[best_index]
-            # assign event probs, move and model state
-            event["p_model_state"] = prob
-            event["move"] = move
-            event["model_state"] = kmer
-            check_overlap = new_check_overlap
-            last_left_over = left_over
-            new_check_overlap = False
-            homopolymer = False
-        else:
-            # skip event since the
-            start_index = i + 1
-    # print(most_moves)
+    # start and end times of new and old events
+    new_starts, new_ends = event_sample_bounds(new_events, sampling_freq=sampling_freq, start_time=start_time)
+    old_starts, old_ends = event_sample_bounds(old_events, sampling_freq=sampling_freq, start_time=start_time)
+    old_ends = np.append(old_starts[1:], old_ends[-1])
+    # skip events that occur before labels from old events
+    skipped = np.flatnonzero(new_starts < old_starts[0])
+    start_index = skipped[-1] + 1 if len(skipped) > 0 else 0
+    events = new_events[start_index:]
+    if len(events) == 0:
+        return events
+    current_starts = new_starts[start_index:]
+    current_ends = new_ends[start_index:]
+
+    # old events [first_old, last_old) are visited by each new event, an old event which ends after the new event
+    # ends overlaps into the next new event and is visited again
+    last_old = np.searchsorted(old_starts, current_ends, side='left')
+    overlap = old_ends[np.maximum(last_old - 1, 0)] > current_ends
+    first_old = np.concatenate(([0], last_old[:-1] - overlap[:-1]))
+    # end of possible alignments at the first new event without old events
+    no_old = np.flatnonzero(last_old <= first_old)
+    num_events = no_old[0] if len(no_old) > 0 else len(events)
+    end_index = start_index + num_events
+    if num_events == 0:
+        return new_events[start_index:end_index]
+    first_old = first_old[:num_events]
+    last_old = last_old[:num_events]
+    overlap = overlap[:num_events]
+    current_starts = current_starts[:num_events]
+    current_ends = current_ends[:num_events]
+
+    # one element for every old event visited by a new event
+    num_visited = last_old - first_old
+    element_offsets = np.concatenate(([0], np.cumsum(num_visited)[:-1]))
+    element_event = np.repeat(np.arange(num_events), num_visited)
+    position = np.arange(len(element_event)) - element_offsets[element_event]
+    old_index = first_old[element_event] + position
+    kmers, kmer_codes = np.unique(old_events["model_state"], return_inverse=True)
+    homopolymer_kmers = np.array([len(set(kmer)) == 1 for kmer in kmers.tolist()], dtype=bool)
+    codes = kmer_codes.ravel()[old_index]
+    # consecutive old events with the same kmer are tracked together on the first kmer entry of the new event
+    continuation = np.zeros(len(codes), dtype=bool)
+    continuation[1:] = (position[1:] > 0) & (codes[1:] == codes[:-1])
+    run_start = ~continuation
+    entry = np.cumsum(run_start) - 1
+    _, first_element, key_index = np.unique(element_event * len(kmers) + codes, return_index=True,
+                                            return_inverse=True)
+    entry = np.where(run_start, entry, entry[first_element[key_index.ravel()]])
+
+    # time of each old event in the new event
+    element_starts = old_starts[old_index]
+    element_ends = old_ends[old_index]
+    event_starts = current_starts[element_event]
+    event_ends = current_ends[element_event]
+    is_last = position == num_visited[element_event] - 1
+    element_time = np.where(is_last & overlap[element_event], event_ends - element_starts,
+                            np.where(element_starts < event_starts, element_ends - event_starts,
+                                     element_ends - element_starts))
+    num_entries = np.count_nonzero(run_start)
+    entry_event = element_event[run_start]
+    entry_offsets = np.flatnonzero(np.concatenate(([True], entry_event[1:] != entry_event[:-1])))
+    entry_index = np.arange(num_entries)
+    time = np.zeros(num_entries, dtype=element_time.dtype)
+    np.add.at(time, entry, element_time)
+    probs = old_events["p_model_state"][old_index[run_start]].copy()
+    np.maximum.at(probs, entry, old_events["p_model_state"][old_index])
+
+    # select index of best kmer to assign on time in new event only
+    max_time = np.maximum.reduceat(time, entry_offsets)
+    best_entry = np.minimum.reduceat(np.where(time == max_time[entry_event], entry_index, num_entries),
+                                     entry_offsets)
+    best_index = best_entry - entry_offsets
+    num_kmers = np.diff(np.append(entry_offsets, num_entries))
+    # overlapping old event was selected and will be visited by the next new event
+    selected_overlap = overlap & (best_index == num_kmers - 1)
+    previous_selected = np.concatenate(([False], selected_overlap[:-1]))
+    previous_overlap = np.concatenate(([False], overlap[:-1]))
+
+    # a homopolymer stay which was selected in the previous new event does not keep the move of its first event
+    element_moves = old_events["move"][old_index].astype(np.int64)
+    second = np.flatnonzero((position == 1) & continuation & homopolymer_kmers[codes] &
+                            previous_selected[element_event])
+    element_moves[second - 1] = 0
+    moves = np.zeros(num_entries, dtype=np.int64)
+    np.add.at(moves, entry, element_moves)
+    cumulative_moves = np.concatenate(([0], np.cumsum(moves)))
+    last_element = element_offsets + num_visited - 1
+    homopolymer = continuation[last_element] & homopolymer_kmers[codes[last_element]]
+
+    # moves after the best kmer which are not visited again by the next new event
+    left_over_end = np.maximum(entry_offsets + num_kmers - overlap, best_entry + 1)
+    left_over = cumulative_moves[left_over_end] - cumulative_moves[best_entry + 1]
+    left_over = np.where(overlap, np.maximum(0, left_over - 1), left_over)
+    last_left_over = np.concatenate(([0], left_over[:-1]))
+    best_moves = moves[best_entry]
+    all_moves = cumulative_moves[best_entry + 1] - cumulative_moves[entry_offsets]
+    # if previous old event overlapped into current new event check if old event is going to be assigned twice
+    assigned_twice = previous_selected & previous_overlap
+    move = np.where(assigned_twice & (best_index == 0), np.where(homopolymer, best_moves, 0),
+                    np.minimum(5, np.where(assigned_twice, best_moves, all_moves) + last_left_over))
+
+    # assign event probs, move and model state
+    new_events["p_model_state"][start_index:end_index] = probs[best_entry]
+    new_events["move"][start_index:end_index] = move
+    new_events["model_state"][start_index:end_index] = kmers[codes[run_start][best_entry]]
     return new_events[start_index:end_index]
 
 
@@ -271,19 +585,44 @@ def check_event_table_time(event_table):
     return True
 
 
-def resegment_reads(fast5_path, params, speedy=False, overwrite=False):
+def anchor_resegmented_events(event_table, old_event_table, sampling_freq, start_time, rna=False):
+    """Anchor kmers of a new event table to the basecalled events and get the new sequence
+
+    :param event_table: event table from one of EVENT_DETECTORS
+    :param old_event_table: basecalled event table from Fast5.get_basecall_data
+    :param sampling_freq: sampling frequency of ADC in Hz
+    :param start_time: start time from fast5 file (time in seconds * sampling frequency)
+    :param rna: the read is rna, the sequence is reversed and T is replaced with U
+    :return: new event table and sequence
+    """
+    new_event_table = create_anchor_kmers(new_events=event_table, old_events=old_event_table,
+                                          sampling_freq=sampling_freq, start_time=start_time)
+    # gather new sequence
+    sequence = sequence_from_events(new_event_table)
+    if rna:
+        sequence = ReverseComplement().reverse(sequence)
+        sequence = sequence.replace("T", "U")
+    return new_event_table, sequence
+
+
+def resegment_reads(fast5_path, params, speedy=False, overwrite=False, compression='gzip', compression_opts=4,
+                    sidecar_path=None, chunk_size=None):
     """Re-segment and create anchor alignment from previously base-called fast5 file
     :param fast5_path: path to fast5 file
-    :param params: event detection parameters
-    :param speedy: boolean option for speedyStatSplit or minknow
+    :param params: event detection parameters, "detector" selects one of EVENT_DETECTORS
+    :param speedy: boolean option for speedyStatSplit or minknow if params has no "detector"
     :param overwrite: overwrite a previous event re-segmented event table
     :param name: name of key where events table will be placed (Analyses/'name'/Events)
+    :param compression: compression filter of the event table: none, lzf or gzip
+    :param compression_opts: gzip compression level
+    :param sidecar_path: write the event table and fastq into this hdf5 file instead of the fast5 file
+    :param chunk_size: detect ttest events from chunks of this many raw samples instead of the whole signal
     :return True when completed
     """
     assert os.path.isfile(fast5_path), "File does not exist: {}".format(fast5_path)
     name = "ReSegmentBasecall_00{}"
-    # create Fast5 object
-    f5fh = Fast5(fast5_path, read='r+')
+    # create Fast5 object, the fast5 file is only read when writing to a side-car file
+    f5fh = Fast5(fast5_path, read='r' if sidecar_path else 'r+')
     # gather previous event detection
     old_event_table = f5fh.get_basecall_data()
     # assert check_event_table_time(old_event_table), "Old event is not consistent"
@@ -291,41 +630,68 @@ def resegment_reads(fast5_path, params, speedy=False, overwrite=False):
     sampling_freq = f5fh.sample_rate
     start_time = f5fh.raw_attributes['start_time']
     # pick event detection algorithm
-    signal = f5fh.get_read(raw=True, scale=True)
-
-    if speedy:
-        event_table = create_speedy_event_table(signal, sampling_freq, start_time, **params)
-        params = merge_dicts([params, {"event_detection": "speedy_stat_split"}])
+    params = dict(params)
+    detector = params.pop("detector", "speedy" if speedy else "minknow")
+    assert detector in EVENT_DETECTORS, "Unknown detector {}. Options: {}".format(detector,
+                                                                                  sorted(EVENT_DETECTORS.keys()))
+    create_event_table_function, event_detection = EVENT_DETECTORS[detector]
+    if chunk_size is not None:
+        assert detector == "ttest", "Only the ttest detector can stream the signal in chunks"
+        event_table = create_streaming_event_table(f5fh, sampling_freq, start_time, chunk_size=chunk_size, **params)
     else:
-        event_table = create_minknow_event_table(signal, sampling_freq, start_time, **params)
-        params = merge_dicts([params, {"event_detection": "minknow_event_detect"}])
+        if detector == "ttest":
+            signal = f5fh.get_raw_signal().scaled
+        else:
+            signal = f5fh.get_read(raw=True, scale=True)
+        event_table = create_event_table_function(signal, sampling_freq, start_time, **params)
+    params = merge_dicts([params, {"event_detection": event_detection}])
 
     keys = ["nanotensor version", "time_stamp"]
     values = ["0.2.0", TimeStamp().posix_date()]
     attributes = merge_dicts([params, dict(zip(keys, values)), f5fh.raw_attributes])
-    if f5fh.is_read_rna():
-        old_event_table = index_to_time(old_event_table, sampling_freq=sampling_freq, start_time=start_time)
-    # set event table
-    new_event_table = create_anchor_kmers(new_events=event_table, old_events=old_event_table)
-    f5fh.set_new_event_table(name, new_event_table, attributes, overwrite=overwrite)
-    # gather new sequence
-    sequence = sequence_from_events(new_event_table)
-    if f5fh.is_read_rna():
-        sequence = ReverseComplement().reverse(sequence)
-        sequence = sequence.replace("T", "U")
+    new_event_table, sequence = anchor_resegmented_events(event_table, old_event_table, sampling_freq, start_time,
+                                                          rna=f5fh.is_read_rna())
     quality_scores = '!'*len(sequence)
     fastq = create_fastq_line(read_id+" :", sequence, quality_scores)
-    # set fastq
-    f5fh.set_fastq(name, fastq)
+    # set event table and fastq in one flush
+    with f5fh.write_batch(compression=compression, compression_opts=compression_opts, sidecar_path=sidecar_path):
+        f5fh.set_new_event_table(name, new_event_table, attributes, overwrite=overwrite)
+        f5fh.set_fastq(name, fastq)
     return f5fh
 
 
+def view_field_types(table, field_types):
+    """View a structured numpy array with new types for some of its fields
+
+    The memory of the table is reused, so each new type must have the size of the field it replaces. Field types
+    are taken from the dtype and not its description, which loses the string metadata h5py adds.
+
+    :param table: structured numpy array
+    :param field_types: dict of field name to new type
+    :return: view of table with the new field types
+    """
+    assert table.dtype.names is not None, "Must be a structured numpy array"
+    assert set(field_types).issubset(table.dtype.names), "Names must be fields in the structured numpy array"
+    formats = []
+    offsets = []
+    for name in table.dtype.names:
+        field_type, offset = table.dtype.fields[name][:2]
+        new_type = np.dtype(field_types.get(name, field_type))
+        assert new_type.itemsize == field_type.itemsize, "Field {} of type {} can not be viewed as {}".format(
+            name, field_type, new_type)
+        formats.append(new_type)
+        offsets.append(offset)
+    return table.view(np.dtype({"names": list(table.dtype.names), "formats": formats, "offsets": offsets,
+                                "itemsize": table.dtype.itemsize}))
+
+
 def index_to_time(basecall_events, sampling_freq=0, start_time=0):
     """Convert RNA basecall read start and length from indexes to time stamps
 
-    :param basecall_events: basecall events from albacore/metricore basecalled event table
+    :param basecall_events: basecall events from albacore/metricore basecalled event table, converted in place
     :param sampling_freq: sampling frequency of experiment
     :param start_time: start time of experiment via fasta5 file
+    :return: view of basecall_events with start and length in seconds
     """
     check_numpy_table(basecall_events, req_fields=('start', 'length'))
     assert basecall_events["start"].dtype is np.dtype('uint64'), "Event start should be np.int32 type: {}"\
@@ -333,19 +699,20 @@ def index_to_time(basecall_events, sampling_freq=0, start_time=0):
     assert sampling_freq != 0, "Must set sampling frequency"
     assert start_time != 0, "Must set start time"
 
-    event_table = change_np_field_type(basecall_events, 'start', float)
-    event_table = change_np_field_type(event_table, 'length', float)
-    event_table["start"] = (event_table["start"] / sampling_freq) + (start_time / sampling_freq)
-    event_table["length"] = event_table["length"] / float(sampling_freq)
+    starts, lengths = event_seconds(basecall_events["start"], basecall_events["length"], sampling_freq, start_time)
+    event_table = view_field_types(basecall_events, {'start': np.float64, 'length': np.float64})
+    event_table["start"] = starts
+    event_table["length"] = lengths
     return event_table
 
 
 def time_to_index(event_table, sampling_freq=0, start_time=0):
     """Convert start and lengths from time to raw signal indexes
 
-    :param event_table: basecall events from albacore/metricore basecalled event table
+    :param event_table: basecall events from albacore/metricore basecalled event table, converted in place
     :param sampling_freq: sampling frequency of experiment
     :param start_time: start time of experiment via fasta5 file
+    :return: view of event_table with start and length in samples
     """
     check_numpy_table(event_table, req_fields=('start', 'length'))
     assert event_table["start"].dtype is not np.dtype('uint64'), "Event start should not be np.int32 type: {}" \
@@ -353,14 +720,24 @@ def time_to_index(event_table, sampling_freq=0, start_time=0):
     assert sampling_freq != 0, "Must set sampling frequency"
     assert start_time != 0, "Must set start time"
 
-    event_table["start"] = np.round((event_table["start"] - (start_time / float(sampling_freq))) * sampling_freq)
-    event_table["length"] = np.round(event_table["length"] * sampling_freq)
-    event_table = change_np_field_type(event_table, 'start', int)
-    event_table = change_np_field_type(event_table, 'length', int)
-
+    starts = np.round((event_table["start"] - (start_time / float(sampling_freq))) * sampling_freq)
+    lengths = np.round(event_table["length"] * sampling_freq)
+    event_table = view_field_types(event_table, {'start': np.int64, 'length': np.int64})
+    event_table["start"] = starts
+    event_table["length"] = lengths
     return event_table
 
 
+def model_state_bytes(events):
+    """View the fixed width 'model_state' kmers of an event table as a matrix of bytes
+
+    :param events: event table with 'model_state' field
+    :return: uint8 array with a row for each event and a column for each base
+    """
+    model_states = np.ascontiguousarray(events["model_state"])
+    assert model_states.dtype.kind == 'S', "model_state must be a bytes field: {}".format(model_states.dtype)
+    return model_states.view(np.uint8).reshape(len(model_states), model_states.dtype.itemsize)
+
 
 def sequence_from_events(events):
     """Get new read from event table with 'model_state' and 'move' fields
@@ -369,83 +746,49 @@ def sequence_from_events(events):
 
     """
     check_numpy_table(events, req_fields=("model_state", "move"))
-    bases = []
-    for i, event in enumerate(events):
-        if i == 0:
-            bases.extend([chr(x) for x in event['model_state']])
-
-        else:
-            if event['move'] > 0:
-                bases.append(bytes.decode
-                             (event['model_state'][-event['move']:]))
-    sequence = ''.join(bases)
+    kmers = model_state_bytes(events)
+    kmer_length = kmers.shape[1]
+    # first kmer and then the last 'move' bases of each kmer
+    num_bases = np.clip(events["move"], 0, kmer_length)
+    if len(events) > 0:
+        num_bases[0] = kmer_length
+    bases = kmers[np.arange(kmer_length) >= kmer_length - num_bases[:, None]]
+    sequence = bases[bases != 0].tobytes().decode()
     return sequence
 
 
+def get_fastq_sequence(fast5handle, analysis, section="template"):
+    """Get the sequence of the fastq of the latest analysis with a given name
+
+    :param fast5handle: Fast5 object
+    :param analysis: analysis name, eg. 'Basecall_1D'
+    :param section: basecall section
+    """
+    fastq = fast5handle.get_fastq(analysis=analysis, section=section)
+    if isinstance(fastq, bytes):
+        fastq = bytes.decode(fastq)
+    fastq = fastq.rstrip('\n')
+    # make sure the underlying assumption that we can split on newline is ok
+    check_fastq_line(fastq)
+    return fastq.split('\n')[1]
+
+
 def get_resegment_accuracy(fast5handle, section="template"):
     """Get accuracy comparison between original sequence and resegmented generated sequence
 
     :param fast5handle: Fast5 object with re-segemented read
     """
     assert isinstance(fast5handle, Fast5), "fast5handle needs to be a Fast5 instance"
-    # get fastqs
-    resegment_fastq = fast5handle.get_fastq(analysis="ReSegmentBasecall", section=section)
-    original_fastq = bytes.decode(fast5handle.get_fastq(analysis="Basecall_1D", section=section))[:-1]
-    # make sure the underlying assumption that we can split on newline is ok
-    check_fastq_line(resegment_fastq)
-    check_fastq_line(original_fastq)
-    # get sequence
-    resegment_seq = resegment_fastq.split('\n')[1]
-    original_seq = original_fastq.split('\n')[1]
+    resegment_seq = get_fastq_sequence(fast5handle, "ReSegmentBasecall", section=section)
+    original_seq = get_fastq_sequence(fast5handle, "Basecall_1D", section=section)
     return pairwise_alignment_accuracy(original_seq, resegment_seq, soft_clip=True)
 
 
-def main():
-    """Main docstring"""
-    start = timer()
-
-    dna_reads = "/Users/andrewbailey/CLionProjects/nanopore-RNN/test_files/minion-reads/canonical/"
-    rna_reads = "/Users/andrewbailey/CLionProjects/nanopore-RNN/test_files/minion-reads/rna_reads"
-
-    dna_minknow_params = dict(window_lengths=(5, 10), thresholds=(2.0, 1.1), peak_height=1.2)
-    dna_speedy_params = dict(min_width=5, max_width=80, min_gain_per_sample=0.008, window_width=800)
-    rna_minknow_params = dict(window_lengths=(5, 10), thresholds=(2.0, 1.1), peak_height=1.2)
-    rna_speedy_params = dict(min_width=5, max_width=40, min_gain_per_sample=0.008, window_width=800)
-
-
-    rna_minknow_params = dict(window_lengths=(5, 10), thresholds=(1.9, 1.0), peak_height=1.2)
-    rna_speedy_params = dict(min_width=5, max_width=40, min_gain_per_sample=0.008, window_width=800)
-    dna_minknow_params = dict(window_lengths=(5, 10), thresholds=(2.0, 1.1), peak_height=1.2)
-    dna_speedy_params = dict(min_width=5, max_width=80, min_gain_per_sample=0.008, window_width=800)
-
-    rna_files = list_dir(rna_reads, ext='fast5')
-    dna_files = list_dir(dna_reads, ext='fast5')
-    print("MAX RNA SKIPS: Speedy")
-    for fast5_path in rna_files:
-        print(fast5_path)
-        f5fh = resegment_reads(fast5_path, rna_speedy_params, speedy=True, overwrite=True)
-        print(get_resegment_accuracy(f5fh))
-        # f5fh = resegment_reads(fast5_path, rna_minknow_params, speedy=False, overwrite=True)
-        # print(test_resegment_accuracy(f5fh))
-
-    print("MAX RNA SKIPS: Minknow")
-    for fast5_path in rna_files:
-        f5fh = resegment_reads(fast5_path, rna_minknow_params, speedy=False, overwrite=True)
-        print(get_resegment_accuracy(f5fh))
-
-    print("MAX DNA SKIPS: speedy")
-    for fast5_path in dna_files:
-            print(fast5_path)
-            f5fh = resegment_reads(fast5_path, dna_speedy_params, speedy=True, overwrite=True)
-            print(get_resegment_accuracy(f5fh))
-    print("MAX DNA SKIPS:Minknow")
-    for fast5_path in dna_files:
-        f5fh = resegment_reads(fast5_path, dna_minknow_params, speedy=False, overwrite=True)
-        print(get_resegment_accuracy(f5fh))
-
-        # print(fast5_path)
-    stop = timer()
-    print("Running Time = {} seconds".format(stop - start), file=sys.stderr)
+def main(in_opts=None):
+    """Resegment fast5 files from the command line, see resegment.py"""
+    # resegment.py imports this module
+    from nanotensor.resegment import main as resegment_main
+    resegment_main(in_opts)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+"""Benchmark event table construction and anchor kmer assignment on fast5 reads"""
+########################################################################
+# File: event_table_benchmark.py
+#  executable: event_table_benchmark.py
+#
+# Author: Andrew Bailey
+# History: Created 05/10/18
+########################################################################
+
+from __future__ import print_function
+import sys
+import os
+import platform
+import argparse
+from datetime import datetime
+from timeit import default_timer as timer
+import numpy as np
+from py3helpers.utils import list_dir, save_json, check_numpy_table
+
+from nanotensor.fast5 import Fast5
+from nanotensor.event_detection import EVENT_TABLE_DTYPE, speedy_events_to_table, minknow_events_to_table, \
+    create_anchor_kmers, create_ttest_event_table, index_to_time
+from nanotensor.mea_benchmark import get_git_commit
+
+
+def loop_speedy_event_table(events, sampling_freq, start_time):
+    """Event table from SpeedyStatSplit segments filled one event at a time (previous implementation)"""
+    event_table = np.empty(len(events), dtype=EVENT_TABLE_DTYPE)
+    for i, event in enumerate(events):
+        event_table['start'][i] = event.start / sampling_freq + (start_time / sampling_freq)
+        event_table['raw_start'][i] = event.start
+        event_table['length'][i] = event.duration / sampling_freq
+        event_table['raw_length'][i] = event.duration
+        event_table['mean'][i] = event.mean
+        event_table['stdv'][i] = event.std
+    return event_table
+
+
+def loop_minknow_event_table(events, sampling_freq, start_time):
+    """Event table from minknow events filled one event at a time (previous implementation)"""
+    event_table = np.empty(len(events), dtype=EVENT_TABLE_DTYPE)
+    for i, event in enumerate(events):
+        event_table['start'][i] = event["start"] + (start_time / sampling_freq)
+        event_table['length'][i] = event["length"]
+        event_table['mean'][i] = event["mean"]
+        event_table['stdv'][i] = event["stdv"]
+        event_table['raw_start'][i] = np.round(event["start"] * sampling_freq)
+        event_table['raw_length'][i] = np.round(event["length"] * sampling_freq)
+    return event_table
+
+
+# detector name -> (loop implementation, column implementation)
+EVENT_TABLE_VARIANTS = {"speedy": (loop_speedy_event_table, speedy_events_to_table),
+                        "minknow": (loop_minknow_event_table, minknow_events_to_table)}
+# fields set by both implementations
+COMPARED_FIELDS = ('start', 'length', 'mean', 'stdv', 'raw_start', 'raw_length')
+
+
+def loop_create_anchor_kmers(new_events, old_events):
+    """
+    Create anchor kmers for new event table one new event at a time (previous implementation)
+
+    Basically, grab kmer and move information from previous event table and
+    pull events covering the same time span into new event table.
+    :param new_events: new event table
+    :param old_events: event table from Fast5 file
+    :return New event table
+    """
+    num_old_events = len(old_events)
+    check_numpy_table(new_events, req_fields=('start', 'length', 'mean', 'stdv', 'model_state', 'move', 'p_model_state'))
+    check_numpy_table(old_events, req_fields=('start', 'length', 'mean', 'stdv', 'model_state', 'move', 'p_model_state'))
+    # index of old events
+    old_indx = 0
+    # start index to trim new_events for those with data from old_events
+    start_index = 0
+    end_index = len(new_events)
+    # personal tracker for dealing with how the segmentation algorithm is working
+    most_moves = 0
+    # tracking overlaped events
+    selected_overlap = False
+    check_overlap = False
+    homopolymer = False
+    # keep track of events passed
+    last_left_over = 0
+    for i, event in enumerate(new_events):
+        # skip events that occur before labels from old events
+        if old_events[0]["start"] <= event["start"]:
+            # time of old event in new event for a given kmer
+            time = []
+            probs = []
+            moves = []
+            kmers = []
+            # new event's start and end
+            current_event_start = round(event["start"], 7)
+            current_event_end = round(current_event_start + event["length"], 7)
+            # if first event or event start is after current old_event start.
+            if old_indx != num_old_events:
+                prev_kmer = str()
+                num_loops = 0
+                while round(old_events[old_indx]["start"], 7) < current_event_end and old_indx != num_old_events:
+                    # deal with bad event files and final event
+                    if old_indx == num_old_events-1:
+                        old_event_end = round(old_events[old_indx]["start"] + old_events[old_indx]["length"], 7)
+                    else:
+                        old_event_end = round(old_events[old_indx+1]["start"], 7)
+                    old_event_start = round(old_events[old_indx]["start"], 7)
+                    old_kmer = bytes.decode(old_events[old_indx]["model_state"])
+                    # homopolymers or stays should be tracked together
+                    if old_kmer == prev_kmer:
+                        if len(set(old_kmer)) == 1:
+                            if not homopolymer and selected_overlap and num_loops <= 1:
+                                moves[index] = 0
+                            homopolymer = True
+                        else:
+                            homopolymer = False
+                        index = kmers.index(old_kmer)
+                        probs[index] = max(probs[index], old_events[old_indx]["p_model_state"])
+                        moves[index] += old_events[old_indx]["move"]
+                    else:
+                        # add new kmer
+                        index = len(time)
+                        kmers.append(old_kmer)
+                        probs.append(old_events[old_indx]["p_model_state"])
+                        moves.append(old_events[old_indx]["move"])
+                        time.append(0)
+                        homopolymer = False
+                    prev_kmer = old_kmer
+                    # if old event passes through current event calculate correct time in current event
+                    # deal with old events ending after the new event end
+                    if old_event_end > current_event_end:
+                        time[index] += current_event_end - old_event_start
+                        new_check_overlap = True
+                        break
+                    # check if entire old event is within the new event or not
+                    else:
+                        if old_event_start < current_event_start:
+                            time[index] += old_event_end - current_event_start
+                        else:
+                            time[index] += old_event_end - old_event_start
+                        # if old_event_end != current_event_end:
+                        old_indx += 1
+                        new_check_overlap = False
+                    num_loops += 1
+                    # break loop at end of old events
+                    if old_indx == num_old_events:
+                        break
+            else:
+                end_index = i
+            num_kmers = len(kmers)
+            # select index of best kmer to assign
+            if num_kmers == 1:
+                best_index = 0
+                left_over = 0
+            elif num_kmers > 1:
+                # select on time in new event only
+                best_index = time.index(max(time))
+                # if there are several old events in a new event, track how many
+                if new_check_overlap:
+                    left_over = sum(moves[best_index+1:-1])
+                else:
+                    left_over = sum(moves[best_index+1:])
+            else:
+                # end of possible alignments
+                end_index = i
+                break
+            # if previous old event overlapped into current new event
+            # check if old event is going to be assigned twice
+            if selected_overlap and best_index == 0 and check_overlap:
+                if homopolymer:
+                    move = moves[best_index]
+                else:
+                    move = 0
+            elif selected_overlap and best_index != 0 and check_overlap:
+                move = min(5, moves[best_index] + last_left_over)
+            else:
+                move = min(5, moves[best_index]+sum(moves[:best_index])+last_left_over)
+                if most_moves < moves[best_index]+sum(moves[:best_index])+last_left_over:
+                    most_moves = moves[best_index]+sum(moves[:best_index])+last_left_over
+            # if new overlap
+            if new_check_overlap:
+                # new overlapped event will be tracked on next new_event so we drop a left_over count
+                left_over = max(0, left_over-1)
+                if most_moves < left_over-1:
+                    most_moves = left_over-1
+
+                # check if we currently selected an overlapping old event
+                if best_index == num_kmers-1:
+                    selected_overlap = True
+                else:
+                    selected_overlap = False
+            else:
+                selected_overlap = False
+
+            kmer = kmers[best_index]
+            prob = probs[best_index]
+            # assign event probs, move and model state
+            event["p_model_state"] = prob
+            event["move"] = move
+            event["model_state"] = kmer
+            check_overlap = new_check_overlap
+            last_left_over = left_over
+            new_check_overlap = False
+            homopolymer = False
+        else:
+            # skip event since the
+            start_index = i + 1
+    return new_events[start_index:end_index]
+
+
+# fields set by create_anchor_kmers
+ANCHOR_FIELDS = ('start', 'model_state', 'move', 'p_model_state')
+
+
+def detect_events(fast5_path, detector):
+    """Run an event detector on a read
+
+    :param fast5_path: path to fast5 file
+    :param detector: speedy or minknow
+    :return: detector events, sampling frequency and start time
+    """
+    with Fast5(fast5_path, 'r') as fast5handle:
+        signal = fast5handle.get_read(raw=True, scale=True)
+        sampling_freq = fast5handle.sample_rate
+        start_time = fast5handle.raw_attributes['start_time']
+    if detector == "speedy":
+        from PyPore.parsers import SpeedyStatSplit
+        parser = SpeedyStatSplit(min_width=5, max_width=80, min_gain_per_sample=0.008, window_width=800,
+                                 sampling_freq=sampling_freq)
+        events = parser.parse(np.asarray(signal, dtype=np.float64))
+    else:
+        from nanonet.eventdetection.filters import minknow_event_detect
+        events = minknow_event_detect(np.asarray(signal, dtype=float), sample_rate=sampling_freq, get_peaks=False,
+                                      window_lengths=(16, 40), thresholds=(8.0, 4.0), peak_height=1.0)
+    return events, sampling_freq, start_time
+
+
+def tile_events(events, tile):
+    """Repeat detector events to emulate longer reads"""
+    if tile == 1:
+        return events
+    if isinstance(events, np.ndarray):
+        return np.tile(events, tile)
+    return list(events) * tile
+
+
+def tables_equal(table1, table2, sampling_freq=None):
+    """Check the fields set by both implementations are equal
+
+    :param table1: event table
+    :param table2: event table
+    :param sampling_freq: compare start and length in seconds to within half a sample, the column tables derive
+                          seconds from samples where the previous minknow loop copied the detector times
+    """
+    for field in COMPARED_FIELDS:
+        if sampling_freq is not None and field in ('start', 'length'):
+            if not np.allclose(table1[field], table2[field], rtol=0, atol=0.5 / sampling_freq):
+                return False
+        elif not np.array_equal(table1[field], table2[field]):
+            return False
+    return True
+
+
+def run_event_table_benchmark(fast5_files, detectors=("speedy", "minknow"), repeats=5, tile=1):
+    """Time the loop and column event table construction on detector events of each read
+
+    :param fast5_files: list of fast5 paths
+    :param detectors: names of EVENT_TABLE_VARIANTS to run
+    :param repeats: number of timed runs
+    :param tile: repeat the events of each read this many times
+    :return: list of result dictionaries
+    """
+    for detector in detectors:
+        assert detector in EVENT_TABLE_VARIANTS, "Unknown detector {}. Options: {}".format(
+            detector, sorted(EVENT_TABLE_VARIANTS.keys()))
+    results = []
+    for fast5_path in fast5_files:
+        for detector in detectors:
+            events, sampling_freq, start_time = detect_events(fast5_path, detector)
+            events = tile_events(events, tile)
+            result = {"fast5": os.path.basename(fast5_path), "detector": detector, "events": len(events)}
+            tables = []
+            for name, function in zip(("loop", "column"), EVENT_TABLE_VARIANTS[detector]):
+                times = []
+                for _ in range(repeats):
+                    start = timer()
+                    table = function(events, sampling_freq, start_time)
+                    times.append(timer() - start)
+                tables.append(table)
+                result[name + "_min_time"] = min(times)
+                result[name + "_times"] = times
+            result["speedup"] = result["loop_min_time"] / max(result["column_min_time"], 1e-12)
+            result["identical"] = tables_equal(*tables, sampling_freq=sampling_freq)
+            print("{detector} {fast5} events={events}: {speedup:.1f}x identical={identical}".format(**result),
+                  file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def get_anchor_kmer_tables(fast5_path, params):
+    """New ttest event table and the basecalled event table of a read in seconds
+
+    :param fast5_path: path to fast5 file
+    :param params: ttest event detection parameters
+    :return: new events, old events, sampling frequency and start time
+    """
+    with Fast5(fast5_path, 'r') as fast5handle:
+        sampling_freq = fast5handle.sample_rate
+        start_time = fast5handle.raw_attributes['start_time']
+        new_events = create_ttest_event_table(fast5handle.get_raw_signal().scaled, sampling_freq, start_time,
+                                              **params)
+        old_events = fast5handle.get_basecall_data()
+        if fast5handle.is_read_rna():
+            # rna basecalled events are in samples
+            old_events = index_to_time(old_events, sampling_freq=sampling_freq, start_time=start_time)
+    return new_events, old_events, sampling_freq, start_time
+
+
+def run_anchor_kmers_benchmark(fast5_files, params=None, repeats=5):
+    """Time the loop and array create_anchor_kmers on the basecalled events of each read
+
+    :param fast5_files: list of fast5 paths with basecalled events
+    :param params: ttest event detection parameters
+    :param repeats: number of timed runs
+    :return: list of result dictionaries
+    """
+    if params is None:
+        params = dict(window_lengths=(6, 12), thresholds=(2.0, 1.1), peak_height=1.2)
+    results = []
+    for fast5_path in fast5_files:
+        new_events, old_events, sampling_freq, start_time = get_anchor_kmer_tables(fast5_path, params)
+        check_numpy_table(old_events, req_fields=ANCHOR_FIELDS)
+        result = {"fast5": os.path.basename(fast5_path), "new_events": len(new_events),
+                  "old_events": len(old_events)}
+        tables = dict()
+        variants = (("loop", loop_create_anchor_kmers, {}), ("array", create_anchor_kmers, {}),
+                    ("samples", create_anchor_kmers, {"sampling_freq": sampling_freq, "start_time": start_time}))
+        for name, function, kwargs in variants:
+            times = []
+            for _ in range(repeats):
+                events = new_events.copy()
+                start = timer()
+                table = function(events, old_events, **kwargs)
+                times.append(timer() - start)
+            tables[name] = table
+            result[name + "_min_time"] = min(times)
+            result[name + "_times"] = times
+        for name in ("array", "samples"):
+            result[name + "_speedup"] = result["loop_min_time"] / max(result[name + "_min_time"], 1e-12)
+            result[name + "_identical"] = len(tables["loop"]) == len(tables[name]) and \
+                all(np.array_equal(tables["loop"][field], tables[name][field]) for field in ANCHOR_FIELDS)
+            # integer times break exact ties and edges which the loop broke by float rounding noise
+            _, loop_index, index = np.intersect1d(tables["loop"]["start"], tables[name]["start"],
+                                                  return_indices=True)
+            result[name + "_matched"] = len(index)
+            result[name + "_moves_changed"] = int(np.sum(tables["loop"]["move"][loop_index] !=
+                                                         tables[name]["move"][index]))
+        print("anchor {fast5} events={new_events}: {array_speedup:.1f}x moves changed={array_moves_changed}".format(
+            **result), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def main(in_opts=None):
+    """Run the event table benchmark from the command line"""
+    test_reads = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests/test_files/minion-reads")
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output', required=True, help='path to json output')
+    parser.add_argument('-d', '--fast5_dirs', nargs='+', default=[os.path.join(test_reads, "methylated"),
+                                                                  os.path.join(test_reads, "rna_reads")],
+                        help='directories of fast5 files, default the bundled test reads')
+    parser.add_argument('--detectors', nargs='+', default=sorted(EVENT_TABLE_VARIANTS.keys()),
+                        choices=sorted(EVENT_TABLE_VARIANTS.keys()), help='event detectors to run')
+    parser.add_argument('--repeats', type=int, default=5, help='number of timed runs')
+    parser.add_argument('--tile', type=int, default=1, help='repeat the events of each read to emulate long reads')
+    parser.add_argument('--anchor_kmers', action='store_true',
+                        help='benchmark create_anchor_kmers instead of event table construction')
+    args = parser.parse_args(in_opts)
+
+    fast5_files = [path for fast5_dir in args.fast5_dirs for path in sorted(list_dir(fast5_dir, ext="fast5"))]
+    if args.anchor_kmers:
+        results = run_anchor_kmers_benchmark(fast5_files, repeats=args.repeats)
+    else:
+        results = run_event_table_benchmark(fast5_files, detectors=args.detectors, repeats=args.repeats,
+                                            tile=args.tile)
+    save_json({"commit": get_git_commit(),
+               "date": datetime.now().isoformat(),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "platform": platform.platform(),
+               "results": results}, args.output)
+
+
+if __name__ == "__main__":
+    main()
+    raise SystemExit
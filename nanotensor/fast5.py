@@ -18,10 +18,13 @@ from glob import glob
 import subprocess
 import shutil
 import re
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import h5py
 import numpy as np
 import numpy.lib.recfunctions as nprf
 from copy import deepcopy
+from collections import OrderedDict, deque
 from py3helpers.utils import check_numpy_table
 from py3helpers.seq_tools import check_fastq_line
 
@@ -35,11 +38,241 @@ def short_names(fname):
     return filename_short, name_short
 
 
+class RawSignal(object):
+    """Raw signal in ADC counts read once from a fast5 file with a lazily computed scaled signal in pA"""
+
+    def __init__(self, raw, offset, raw_unit, start=0):
+        """Keep the raw signal and scaling parameters
+
+        :param raw: raw signal in ADC counts as read from the file (usually int16)
+        :param offset: channel offset
+        :param raw_unit: channel range / digitisation
+        :param start: index of the first sample in the read
+        """
+        self.raw = raw
+        self.offset = offset
+        self.raw_unit = raw_unit
+        self.start = start
+        self._scaled = None
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def scaled(self):
+        """float32 signal scaled to pA, computed on first access without float64 temporaries"""
+        if self._scaled is None:
+            scaled = np.empty(len(self.raw), dtype=np.float32)
+            np.add(self.raw, self.offset, out=scaled, dtype=np.float32)
+            scaled *= np.float32(self.raw_unit)
+            self._scaled = scaled
+        return self._scaled
+
+
+class Fast5WriteBatch(object):
+    """Queue tables, strings, attributes and deletes for a Fast5 file and write them in one flush
+
+    While the batch is active (see Fast5.write_batch) the Fast5 writer methods queue into the batch and path
+    lookups (check_path, get_analysis_latest, `in`) see the queued changes. flush writes everything into the file,
+    or into a side-car hdf5 file which leaves the original file untouched. With a side-car file the lookups answer
+    from the side-car file, so new analyses are numbered after the ones already written there. If a write fails
+    the writes of the flush are rolled back.
+    """
+    __compression_filters__ = ('none', 'lzf', 'gzip')
+    __trash_path__ = '/write_batch_trash'
+
+    def __init__(self, fast5handle, compression='gzip', compression_opts=4, chunks=True, sidecar_path=None):
+        """Set up an empty batch
+
+        :param fast5handle: Fast5 object to write to
+        :param compression: compression filter of tables: none, lzf or gzip
+        :param compression_opts: gzip compression level
+        :param chunks: chunk shape of tables or True to let h5py pick one
+        :param sidecar_path: write to this hdf5 file instead of fast5handle
+        """
+        assert compression in self.__compression_filters__, \
+            "compression must be one of {}: {}".format(self.__compression_filters__, compression)
+        self.fast5handle = fast5handle
+        self.compression = None if compression == 'none' else compression
+        self.compression_opts = compression_opts if compression == 'gzip' else None
+        self.chunks = chunks
+        self.sidecar_path = sidecar_path
+        self.operations = []
+        self._sidecar_names = None
+
+    @staticmethod
+    def _normalize(location):
+        return '/' + location.strip('/')
+
+    def _queue(self, operation, location, value=None):
+        self.operations.append((operation, self._normalize(location), value))
+        self.fast5handle._clear_analysis_index()
+
+    def add_table(self, location, data):
+        """Queue a numpy table"""
+        if not isinstance(data, np.ndarray):
+            raise TypeError('Table is not a ndarray.')
+        self._queue('table', location, data)
+
+    def add_string(self, location, data):
+        """Queue a string dataset"""
+        assert type(data) == str, 'Need to supply a string'
+        self._queue('string', location, data)
+
+    def add_attrs(self, location, data, convert=None):
+        """Queue attributes of a possibly new group"""
+        if convert is not None:
+            data = {k: convert(v) for k, v in data.items()}
+        self._queue('attrs', location, dict(data))
+
+    def delete(self, location):
+        """Queue deleting a group or dataset"""
+        self._queue('delete', location)
+
+    def contains(self, name):
+        """Whether name exists after the queued operations, None if they do not touch it"""
+        name = self._normalize(name)
+        for operation, location, _ in reversed(self.operations):
+            if operation == 'delete':
+                if name == location or name.startswith(location + '/'):
+                    return False
+            elif name == location or location.startswith(name.rstrip('/') + '/'):
+                return True
+        return None
+
+    def children(self, parent):
+        """Names of the groups and datasets the queued operations create directly under parent"""
+        prefix = self._normalize(parent).rstrip('/') + '/'
+        return set(location[len(prefix):].split('/')[0] for operation, location, _ in self.operations
+                   if operation != 'delete' and location.startswith(prefix))
+
+    def _get_sidecar_names(self):
+        """Names of the groups and datasets in the side-car file, listed once until the next flush"""
+        if self._sidecar_names is None:
+            self._sidecar_names = set()
+            if os.path.isfile(self.sidecar_path):
+                with h5py.File(self.sidecar_path, 'r') as sidecar:
+                    sidecar.visit(lambda x: self._sidecar_names.add('/' + x))
+        return self._sidecar_names
+
+    def sidecar_contains(self, name):
+        """Whether name exists in the side-car file before the queued operations"""
+        return self._normalize(name) in self._get_sidecar_names()
+
+    def sidecar_children(self, parent):
+        """Names of the groups and datasets directly under parent in the side-car file"""
+        prefix = self._normalize(parent).rstrip('/') + '/'
+        return set(name[len(prefix):] for name in self._get_sidecar_names()
+                   if name.startswith(prefix) and '/' not in name[len(prefix):])
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __enter__(self):
+        assert self.fast5handle._write_batch is None, "A write batch is already active"
+        self.fast5handle._write_batch = self
+        self.fast5handle._clear_analysis_index()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.fast5handle._write_batch = None
+        self.fast5handle._clear_analysis_index()
+        if exc_type is None:
+            self.flush()
+        return False
+
+    @staticmethod
+    def _first_missing(target, location):
+        """Highest group of location which does not exist in target"""
+        path = ''
+        for part in location.strip('/').split('/'):
+            path += '/' + part
+            if path not in target:
+                return path
+        return None
+
+    def _apply(self, target, created, moved, old_attrs):
+        """Write the queued operations into an open hdf5 file"""
+        for operation, location, value in self.operations:
+            if operation == 'delete':
+                if location in target:
+                    trash = '{}/{}'.format(self.__trash_path__, len(moved))
+                    if self.__trash_path__ not in target:
+                        h5py.Group.create_group(target, self.__trash_path__)
+                    target.move(location, trash)
+                    moved.append((location, trash))
+                continue
+            missing = self._first_missing(target, location)
+            if missing is not None:
+                created.append(missing)
+            if operation == 'table':
+                h5py.Group.create_dataset(target, location, data=value, chunks=self.chunks if value.size else None,
+                                          compression=self.compression if value.size else None,
+                                          compression_opts=self.compression_opts if value.size else None)
+            elif operation == 'string':
+                h5py.Group.create_dataset(target, location, data=value)
+            else:
+                if location not in target:
+                    h5py.Group.create_group(target, location)
+                attrs = target[location].attrs
+                old_attrs.append((location, dict(attrs)))
+                for k, v in value.items():
+                    attrs[k] = v
+
+    @staticmethod
+    def _rollback(target, created, moved, old_attrs):
+        """Undo the writes of a failed flush"""
+        for location, attrs in reversed(old_attrs):
+            if location in target:
+                target[location].attrs.clear()
+                target[location].attrs.update(attrs)
+        for location in reversed(created):
+            if location in target:
+                h5py.Group.__delitem__(target, location)
+        for location, trash in reversed(moved):
+            target.move(trash, location)
+
+    def flush(self):
+        """Write the queued operations and empty the batch
+
+        :return: number of operations written
+        """
+        if self.sidecar_path is None:
+            self.fast5handle.assert_writable()
+            target = self.fast5handle
+        else:
+            target = h5py.File(self.sidecar_path, 'a')
+        batch, self.fast5handle._write_batch = self.fast5handle._write_batch, None
+        created, moved, old_attrs = [], [], []
+        try:
+            try:
+                self._apply(target, created, moved, old_attrs)
+            except Exception:
+                self._rollback(target, created, moved, old_attrs)
+                raise
+            finally:
+                if self.__trash_path__ in target:
+                    h5py.Group.__delitem__(target, self.__trash_path__)
+        finally:
+            if self.sidecar_path is not None:
+                target.close()
+            self.fast5handle._write_batch = batch
+            self.fast5handle._clear_metadata_cache()
+            self.fast5handle._clear_analysis_index()
+        num_operations = len(self.operations)
+        self.operations = []
+        self._sidecar_names = None
+        return num_operations
+
+
 class Fast5(h5py.File):
     """Class for grabbing data from single read fast5 files. Many attributes/
     groups are assumed to exist currently (we're concerned mainly with reading).
     Needs some development to make robust and for writing.
 
+    Multi-read files (read_<id>/Raw, read_<id>/Analyses) are indexed by read id on open. One read is
+    selected at a time with select_read and all getters and setters work on the selected read.
+
     """
     __base_analysis__ = '/Analyses'
     __event_detect_name__ = 'EventDetection'
@@ -90,16 +323,108 @@ class Fast5(h5py.File):
     __default_engine_state_path__ = '/EngineStates/'
     __temp_fields__ = ('heatsink', 'asic')
 
-    def __init__(self, fname, read='r'):
+    # multi-read files keep every read in its own group at the root of the file
+    __multi_read_prefix__ = 'read_'
+    __multi_read_raw_path__ = '/{}/Raw'
+    __multi_read_meta_paths__ = {'__channel_meta_path__': 'channel_id',
+                                 '__tracking_id_path__': 'tracking_id',
+                                 '__context_tags_path__': 'context_tags'}
+    # absolute paths which are moved under the read group of multi-read files
+    __multi_read_analysis_paths__ = ('__base_analysis__', '__default_corrected_genome__',
+                                     '__default_signalalign_events__', '__default_resegment_basecall__',
+                                     '__default_eventalign_events__')
+
+    def __init__(self, fname, read='r', read_id=None):
         super(Fast5, self).__init__(fname, read)
+        # metadata dicts are read from hdf5 attributes once per handle, writer methods clear them
+        self._metadata_cache = dict()
+        # number of hdf5 attributes read into the metadata cache
+        self.attr_reads = 0
+        # sorted analysis group names and memoized lookups, rebuilt after writes or when the number of links
+        # in the analysis group changes, which also catches writes through subgroup handles
+        self._analysis_names = None
+        self._analysis_links = None
+        self._analysis_lookups = dict()
+        # number of times the analysis group was listed
+        self.analysis_index_builds = 0
+        # active Fast5WriteBatch, writer methods queue into it
+        self._write_batch = None
+        # read id -> read group of multi-read files, empty for single read files
+        self.read_index = self._build_read_index()
+        self.read_id = None
+        self.read_group = None
+
+        if self.is_multi_read:
+            self.select_read(read_id if read_id is not None else next(iter(self.read_index)))
+        else:
+            assert read_id is None, "read_id can only be selected in multi-read files: {}".format(fname)
+            self._set_channel_meta_attributes()
 
-        # Attach channel_meta as attributes, slightly redundant
-        for k, v in self[self.__channel_meta_path__].attrs.items():
+        self.filename_short, self.name_short = short_names(self.filename)
+
+    def _set_channel_meta_attributes(self):
+        """Attach channel_meta as attributes, slightly redundant"""
+        for k, v in self.channel_meta.items():
             setattr(self, k, v)
         # Backward compat.
         self.sample_rate = self.sampling_rate
 
-        self.filename_short, self.name_short = short_names(self.filename)
+    def _build_read_index(self):
+        """Map read ids to read groups of a multi-read file from a single listing of the root group"""
+        prefix = self.__multi_read_prefix__
+        return OrderedDict((name[len(prefix):], name) for name in self.keys() if name.startswith(prefix))
+
+    @property
+    def is_multi_read(self):
+        """True if the file contains read_<id> groups"""
+        return len(self.read_index) > 0
+
+    def select_read(self, read_id):
+        """Select a read of a multi-read file. Getters and setters work on the selected read afterwards.
+
+        :param read_id: read id of the read
+        """
+        assert self.is_multi_read, "Only multi-read files contain more than one read: {}".format(self.filename)
+        try:
+            read_group = self.read_index[read_id]
+        except KeyError:
+            raise KeyError("Read {} not found in {}".format(read_id, self.filename))
+        if read_group == self.read_group:
+            return
+        self.read_id = read_id
+        self.read_group = read_group
+        # instance attributes shadow the single read paths of the class
+        for name, group in self.__multi_read_meta_paths__.items():
+            setattr(self, name, self._join_path('', read_group, group))
+        for name in self.__multi_read_analysis_paths__:
+            setattr(self, name, '/' + read_group + getattr(type(self), name))
+        self._clear_metadata_cache()
+        self._clear_analysis_index()
+        self._set_channel_meta_attributes()
+
+    def get_read_ids(self):
+        """Get the read ids in the file
+
+        :return: list of read ids, a single read file without read_id attribute gives [None]
+        """
+        if self.is_multi_read:
+            return list(self.read_index.keys())
+        read_id = self.raw_attributes.get('read_id')
+        if isinstance(read_id, bytes):
+            read_id = read_id.decode()
+        return [read_id]
+
+    def iterate_reads(self):
+        """Select every read of the file in turn without reopening the file
+
+        :return: generator of read ids, the handle has the read selected while it is processed
+        """
+        if not self.is_multi_read:
+            yield self.get_read_ids()[0]
+        else:
+            for read_id in self.read_index:
+                self.select_read(read_id)
+                yield read_id
 
     @classmethod
     def New(cls, fname, read='a', tracking_id={}, context_tags={}, channel_id={}):
@@ -139,7 +464,11 @@ class Fast5(h5py.File):
         :param location: hdf path
         :param convert: function to apply to all dictionary values
         """
-        self.__add_attrs(self, data, location, convert=convert)
+        if self._write_batch is not None:
+            self._write_batch.add_attrs(location, data, convert=convert)
+        else:
+            self.__add_attrs(self, data, location, convert=convert)
+        self._clear_metadata_cache()
 
     @staticmethod
     def __add_attrs(self, data, location, convert=None):
@@ -157,10 +486,32 @@ class Fast5(h5py.File):
 
     def _add_string_dataset(self, data, location):
         assert type(data) == str, 'Need to supply a string'
-        self.create_dataset(location, data=data)
+        if self._write_batch is not None:
+            self._write_batch.add_string(location, data)
+        else:
+            self.create_dataset(location, data=data)
 
     def _add_numpy_table(self, data, location):
-        self.create_dataset(location, data=data, compression=True)
+        if self._write_batch is not None:
+            self._write_batch.add_table(location, data)
+        else:
+            self.create_dataset(location, data=data, compression=True)
+
+    def write_batch(self, compression='gzip', compression_opts=4, chunks=True, sidecar_path=None):
+        """Queue writes and write them in one flush when the with block exits
+
+            with fast5handle.write_batch(compression='lzf') as batch:
+                fast5handle.set_new_event_table(...)
+                fast5handle.set_fastq(...)
+
+        :param compression: compression filter of tables: none, lzf or gzip
+        :param compression_opts: gzip compression level
+        :param chunks: chunk shape of tables or True to let h5py pick one
+        :param sidecar_path: write into this hdf5 file instead, the fast5 file can be opened read only
+        :return: Fast5WriteBatch
+        """
+        return Fast5WriteBatch(self, compression=compression, compression_opts=compression_opts, chunks=chunks,
+                               sidecar_path=sidecar_path)
 
     def _add_event_table(self, data, location):
         if not isinstance(data, np.ndarray):
@@ -181,33 +532,104 @@ class Fast5(h5py.File):
     @property
     def writable(self):
         """Can we write to the file."""
-        if self.mode is 'r':
-            return False
-        else:
+        if self._write_batch is not None and self._write_batch.sidecar_path is not None:
             return True
+        return self.mode != 'r'
 
     def assert_writable(self):
         assert self.writable, "File not writable, opened with {}.".format(self.mode)
 
+    def _cached_attrs(self, name, get_group):
+        """Get a copy of the attributes of a group, reading them from the file only once per handle
+
+        :param name: name of the metadata in the cache
+        :param get_group: function returning the hdf group
+        """
+        if name not in self._metadata_cache:
+            attrs = dict(get_group().attrs)
+            self.attr_reads += len(attrs)
+            self._metadata_cache[name] = attrs
+        return dict(self._metadata_cache[name])
+
+    def _clear_metadata_cache(self):
+        """Clear cached metadata after the file has been changed"""
+        self._metadata_cache.clear()
+
+    def _count_analysis_links(self):
+        """Number of links in the analysis group of the file without listing their names"""
+        if not super(Fast5, self).__contains__(self.__base_analysis__):
+            return 0
+        return len(super(Fast5, self).__getitem__(self.__base_analysis__))
+
+    def _get_analysis_names(self):
+        """Sorted names of the analysis groups, listed from the file once until the next write"""
+        links = self._count_analysis_links()
+        if self._analysis_names is None or links != self._analysis_links:
+            names = set()
+            if self._write_batch is not None and self._write_batch.sidecar_path is not None:
+                names.update(self._write_batch.sidecar_children(self.__base_analysis__))
+            elif super(Fast5, self).__contains__(self.__base_analysis__):
+                names.update(self[self.__base_analysis__].keys())
+            if self._write_batch is not None:
+                names.update(self._write_batch.children(self.__base_analysis__))
+                names = [name for name in names if self._join_path(self.__base_analysis__, name) in self]
+            self._analysis_names = sorted(names)
+            self._analysis_links = links
+            self._analysis_lookups = dict()
+            self.analysis_index_builds += 1
+        return self._analysis_names
+
+    def _clear_analysis_index(self):
+        """Clear the analysis index after groups or datasets were added or deleted"""
+        self._analysis_names = None
+        self._analysis_lookups = dict()
+
+    def create_group(self, name, *args, **kwargs):
+        group = super(Fast5, self).create_group(name, *args, **kwargs)
+        self._clear_analysis_index()
+        return group
+
+    def create_dataset(self, name, *args, **kwargs):
+        dataset = super(Fast5, self).create_dataset(name, *args, **kwargs)
+        self._clear_analysis_index()
+        return dataset
+
+    def __setitem__(self, name, obj):
+        super(Fast5, self).__setitem__(name, obj)
+        self._clear_analysis_index()
+
+    def __delitem__(self, name):
+        super(Fast5, self).__delitem__(name)
+        self._clear_analysis_index()
+
+    def __contains__(self, name):
+        if self._write_batch is not None:
+            pending = self._write_batch.contains(name)
+            if pending is not None:
+                return pending
+            if self._write_batch.sidecar_path is not None:
+                return self._write_batch.sidecar_contains(name)
+        return super(Fast5, self).__contains__(name)
+
     @property
     def channel_meta(self):
         """Channel meta information as python dict"""
-        return dict(self[self.__channel_meta_path__].attrs)
+        return self._cached_attrs('channel_meta', lambda: self[self.__channel_meta_path__])
 
     @property
     def tracking_id(self):
         """Tracking id meta information as python dict"""
-        return dict(self[self.__tracking_id_path__].attrs)
+        return self._cached_attrs('tracking_id', lambda: self[self.__tracking_id_path__])
 
     @property
     def raw_attributes(self):
         """Attributes for a read, assumes one read in file"""
-        return dict(self.get_read(group=True, raw=True).attrs)
+        return self._cached_attrs('raw_attributes', lambda: self.get_read(group=True, raw=True))
 
     @property
     def event_attributes(self):
         """Attributes for a read, assumes one read in file"""
-        return dict(self.get_read(group=True).attrs)
+        return self._cached_attrs('event_attributes', lambda: self.get_read(group=True))
 
     def summary(self, rename=True, delete=True, scale=True):
         """A read summary, assumes one read in file"""
@@ -255,6 +677,8 @@ class Fast5(h5py.File):
         for name in analyses.keys():
             if name not in keep:
                 del analyses[name]
+        self._clear_metadata_cache()
+        self._clear_analysis_index()
 
     def repack(self):
         """Run h5repack on the current file. Returns a fresh object."""
@@ -287,6 +711,9 @@ class Fast5(h5py.File):
             event_group = self.get_analysis_latest(self.__event_detect_name__)
             event_path = self._join_path(event_group, self.__default_event_path__)
             reads = self[event_path]
+        elif self.is_multi_read:
+            # the raw group of the selected read is the only raw read
+            reads = {self.read_group: self[self.__multi_read_raw_path__.format(self.read_group)]}
         else:
             try:
                 reads = self[self.__raw_path__]
@@ -391,23 +818,22 @@ class Fast5(h5py.File):
         # We assume that if start is an int or uint the data is in samples
         #    else it is in seconds already.
         needs_scaling = False
-        if events['start'].dtype.kind in ['i', 'u']:
+        if events.dtype['start'].kind in ['i', 'u']:
             needs_scaling = True
 
         dtype = np.dtype([(d[0], 'float') if d[0] in float_fields else d
                           for d in events.dtype.descr
                           ])
-        data = None
-        with events.astype(dtype):
-            if indices is None:
-                data = events[()]
-            else:
-                try:
-                    data = events[indices[0]:indices[1]]
-                except:
-                    raise ValueError(
-                        'Cannot retrieve events using {} as indices'.format(indices)
-                    )
+        if indices is None:
+            data = events[()]
+        else:
+            try:
+                data = events[indices[0]:indices[1]]
+            except:
+                raise ValueError(
+                    'Cannot retrieve events using {} as indices'.format(indices)
+                )
+        data = data.astype(dtype)
 
         # File spec mentions a read.attrs['scaling_used'] attribute,
         #    its not clear what this is. We'll ignore it and hope for
@@ -419,27 +845,79 @@ class Fast5(h5py.File):
 
     def _get_read_data_raw(self, read, indices=None, scale=True):
         """Private accessor to read raw data"""
-        raw = read['Signal']
-        dtype = float if scale else int
-
-        data = None
-        with raw.astype(dtype):
-            if indices is None:
-                data = raw[()]
-            else:
-                try:
-                    data = raw[indices[0]:indices[1]]
-                except:
-                    raise ValueError(
-                        'Cannot retrieve events using {} as indices'.format(indices)
-                    )
-
+        signal = self._read_raw_signal(read, indices=indices)
         # Scale data to pA
         if scale:
             meta = self.channel_meta
             raw_unit = meta['range'] / meta['digitisation']
-            data = (data + meta['offset']) * raw_unit
-        return data
+            return (signal + meta['offset']) * raw_unit
+        return signal.astype(int)
+
+    @staticmethod
+    def _clip_indices(length, indices=None):
+        """Clip (start, end) indices to a signal of length like slicing does
+
+        :param length: length of the signal
+        :param indices: (start, end) indices, negative and out of range values behave like a slice
+        :return: start, end with 0 <= start <= end <= length
+        """
+        if indices is None:
+            return 0, length
+        start, end, _ = slice(indices[0], indices[1]).indices(length)
+        return start, max(start, end)
+
+    @staticmethod
+    def _read_raw_signal(read, indices=None, buffer=None):
+        """Read the raw signal of a read group with a single read_direct call
+
+        :param read: raw read hdf group
+        :param indices: (start, end) indices of the signal to read, clipped to the signal like a slice
+        :param buffer: array to read into if it is large enough and has the dtype of the signal
+        :return: raw signal array, a view of buffer if it was used
+        """
+        raw = read['Signal']
+        start, end = Fast5._clip_indices(raw.shape[0], indices)
+        length = end - start
+        if buffer is not None and buffer.dtype == raw.dtype and len(buffer) >= length:
+            signal = buffer[:length]
+        else:
+            signal = np.empty(length, dtype=raw.dtype)
+        if length > 0:
+            raw.read_direct(signal, np.s_[start:end])
+        return signal
+
+    def get_raw_signal(self, read_number=None, indices=None, buffer=None):
+        """Read raw signal once and scale it only when needed
+
+        :param read_number: read number of the raw read, default first read
+        :param indices: (start, end) indices of the signal to read
+        :param buffer: reusable array for the raw signal, see _read_raw_signal
+        :return: RawSignal object with raw and lazily scaled signal
+        """
+        read = self.get_read(group=True, raw=True, read_number=read_number)
+        meta = self.channel_meta
+        signal = self._read_raw_signal(read, indices=indices, buffer=buffer)
+        start = self._clip_indices(read['Signal'].shape[0], indices)[0]
+        return RawSignal(signal, meta['offset'], meta['range'] / meta['digitisation'], start=start)
+
+    def iterate_raw_signal(self, window_size, read_number=None):
+        """Iterate over windows of the raw signal reusing one buffer
+
+        Each RawSignal is only valid until the next window is read, copy the arrays to keep them.
+
+        :param window_size: number of samples in each window
+        :param read_number: read number of the raw read, default first read
+        """
+        assert window_size > 0, "window_size must be positive: {}".format(window_size)
+        read = self.get_read(group=True, raw=True, read_number=read_number)
+        meta = self.channel_meta
+        raw_unit = meta['range'] / meta['digitisation']
+        signal_length = read['Signal'].shape[0]
+        buffer = np.empty(min(window_size, signal_length), dtype=read['Signal'].dtype)
+        for start in range(0, signal_length, window_size):
+            end = min(start + window_size, signal_length)
+            signal = self._read_raw_signal(read, indices=(start, end), buffer=buffer)
+            yield RawSignal(signal, meta['offset'], raw_unit, start=start)
 
     def set_read(self, data, meta, scale=True):
         """Write event data to file
@@ -471,6 +949,7 @@ class Fast5(h5py.File):
             data['length'] *= self.sample_rate
 
         self._add_event_table(data, self._join_path(path, 'Events'))
+        self._clear_metadata_cache()
 
     def set_fastq(self, path, data, section='template'):
         """Write new fasta file to file
@@ -548,13 +1027,47 @@ class Fast5(h5py.File):
 
         return True
 
+    def set_mea_alignment_table(self, data, overwrite=False):
+        """Write mea alignment table into the latest signalAlign analysis
+
+        :param data: mea alignment events table
+        :param overwrite: replace an existing mea alignment table
+        """
+        self.assert_writable()
+        if not isinstance(data, np.ndarray):
+            raise TypeError('Table is not a ndarray.')
+        path = self.check_path(self.__default_signalalign_events__, latest=True)
+        if path not in self:
+            raise KeyError('Read does not contain required fields: {}'.format(path))
+        location = self._join_path(path, 'MEA_alignment_labels')
+        if location in self:
+            if not overwrite:
+                raise KeyError('MEA alignment table already exists: {}'.format(location))
+            self.delete(location)
+        self._add_numpy_table(data, location)
+        return location
+
     def check_path(self, path, latest=False):
         """Check if path exists, if it does increment numbering
 
         :param path: path to fast5 object. Needs to have a field where string.format can work! """
+        parent, _, name = path.rpartition('/')
+        if parent == self.__base_analysis__:
+            # analysis groups are answered from the analysis index
+            key = ('check_path', name, latest)
+            analysis_names = self._get_analysis_names()
+            if key not in self._analysis_lookups:
+                self._analysis_lookups[key] = self._check_name(name, set(analysis_names), latest=latest)
+            found = self._analysis_lookups[key]
+            return None if found is None else self._join_path(parent, found)
+        return self._check_name(path, self, latest=latest)
+
+    @staticmethod
+    def _check_name(path, existing, latest=False):
+        """Implementation of check_path for any container of existing paths"""
         highest = 0
         while highest < 20:
-            if path.format(highest) in self:
+            if path.format(highest) in existing:
                 highest += 1
                 continue
             else:
@@ -642,6 +1155,7 @@ class Fast5(h5py.File):
         data_path = self._join_path(read_path, 'Signal')
         self._add_attrs(meta, read_path)
         self[data_path] = raw
+        self._clear_metadata_cache()
 
         ###
     # Analysis path resolution
@@ -652,15 +1166,14 @@ class Fast5(h5py.File):
         :param name: Get the (full) path of newest analysis with a given base
             name.
         """
-        try:
-            return self._join_path(
-                self.__base_analysis__,
-                sorted(filter(
-                    lambda x: name in x, self[self.__base_analysis__].keys()
-                ))[-1]
-            )
-        except (IndexError, KeyError):
+        analysis_names = self._get_analysis_names()
+        key = ('latest', name)
+        if key not in self._analysis_lookups:
+            matches = [x for x in analysis_names if name in x]
+            self._analysis_lookups[key] = matches[-1] if matches else None
+        if self._analysis_lookups[key] is None:
             raise IndexError('No analyses with name {} present.'.format(name))
+        return self._join_path(self.__base_analysis__, self._analysis_lookups[key])
 
     def get_analysis_new(self, name):
         """Get group path for new analysis with a given base name.
@@ -1095,12 +1608,18 @@ class Fast5(h5py.File):
         """Delete a section of the H5file"""
         self.assert_writable()
         try:
-            del self[section]
+            if self._write_batch is not None:
+                if section not in self:
+                    raise KeyError(section)
+                self._write_batch.delete(section)
+            else:
+                del self[section]
         except KeyError:
             if ignore:
                 pass
             else:
                 raise KeyError("{} not found in Fast5 file".format(section))
+        self._clear_metadata_cache()
 
     def is_read_rna(self):
         """
@@ -1110,14 +1629,14 @@ class Fast5(h5py.File):
         # check both experiment type and kit slots for "rna"
         exp_type, exp_kit = None, None
         try:
-            exp_type = bytes.decode(self['UniqueGlobalKey/context_tags'].attrs[
+            exp_type = bytes.decode(self[self.__context_tags_path__].attrs[
                                         'experiment_type'])
             # remove the word internal since it contains rna.
             exp_type = exp_type.replace('internal', '')
         except:
             pass
         try:
-            exp_kit = bytes.decode(self['UniqueGlobalKey/context_tags'].attrs[
+            exp_kit = bytes.decode(self[self.__context_tags_path__].attrs[
                                        'experiment_kit'])
             # remove the word internal since it contains rna.
             exp_kit = exp_kit.replace('internal', '')
@@ -1134,7 +1653,8 @@ class Fast5(h5py.File):
         return rna
 
 
-def iterate_fast5(path, strand_list=None, paths=False, mode='r', limit=None, files_group_pattern=None, sort_by_size=None):
+def iterate_fast5(path, strand_list=None, paths=False, mode='r', limit=None, files_group_pattern=None, sort_by_size=None,
+                  reads=False, catalog=None):
     """Iterate over directory or list of .fast5 files.
 
     :param path: Directory in which single read fast5 are located or filename.
@@ -1144,8 +1664,17 @@ def iterate_fast5(path, strand_list=None, paths=False, mode='r', limit=None, fil
     :param limit: limit number of files to consider.
     :param files_group_pattern: yield file paths in groups of specified pattern
     :param sort_by_size: 'desc' - from largest to smallest, 'asc' - opposite
+    :param reads: iterate over every read of multi-read files. Each file is opened once and the handle is yielded
+        once per read with the read selected, or (path, read_id) if paths is set
+    :param catalog: iterate over the files of a read catalog (see read_catalog.query_read_catalog) instead of
+        listing path. sort_by_size uses the catalog file sizes
     """
-    if strand_list is None:
+    if catalog is not None:
+        files = list(OrderedDict.fromkeys(catalog["path"].tolist()))
+        if sort_by_size is not None:
+            file_sizes = dict(zip(catalog["path"].tolist(), catalog["file_size"].tolist()))
+            files.sort(reverse=sort_by_size == 'desc', key=lambda x: file_sizes[x])
+    elif strand_list is None:
         #  Could make glob more specific to filename pattern expected
         if os.path.isdir(path):
             files = glob(os.path.join(path, '*.fast5'))
@@ -1159,7 +1688,7 @@ def iterate_fast5(path, strand_list=None, paths=False, mode='r', limit=None, fil
     else:
         files = [os.path.join(path, x) for x in strand_list]
 
-    if sort_by_size is not None:
+    if sort_by_size is not None and catalog is None:
         reverse = True if sort_by_size == 'desc' else False
         files.sort(reverse=reverse, key=lambda x: os.path.getsize(x))
 
@@ -1167,7 +1696,14 @@ def iterate_fast5(path, strand_list=None, paths=False, mode='r', limit=None, fil
         if not os.path.exists(f):
             sys.stderr.write('File {} does not exist, skipping\n'.format(f))
             continue
-        if not paths:
+        if reads:
+            with Fast5(f, read=mode) as fh:
+                for read_id in fh.iterate_reads():
+                    if paths:
+                        yield os.path.abspath(f), read_id
+                    else:
+                        yield fh
+        elif not paths:
             fh = Fast5(f, read=mode)
             yield fh
             fh.close()
@@ -1175,6 +1711,133 @@ def iterate_fast5(path, strand_list=None, paths=False, mode='r', limit=None, fil
             yield os.path.abspath(f)
 
 
+# datasets prefetch_fast5 can read, each reader takes a Fast5 handle with the read selected
+PREFETCH_READERS = {
+    "raw_signal": lambda fast5handle: fast5handle.get_raw_signal(),
+    "channel_meta": lambda fast5handle: fast5handle.channel_meta,
+    "basecall_events": lambda fast5handle: fast5handle.get_basecall_data(),
+    "resegment_events": lambda fast5handle: fast5handle.get_resegment_basecall(),
+    "signalalign_events": lambda fast5handle: fast5handle.get_signalalign_events(),
+    "mea_alignment": lambda fast5handle: fast5handle.get_signalalign_events(mea=True),
+    "eventalign_events": lambda fast5handle: fast5handle.get_eventalign_events(),
+}
+# datasets derived from another dataset, which is read once per read: name -> (source dataset, function)
+PREFETCH_DERIVED = {
+    "raw": ("raw_signal", lambda raw_signal: raw_signal.raw),
+    "scaled": ("raw_signal", lambda raw_signal: raw_signal.scaled),
+}
+
+
+def _read_prefetch_dataset(fast5handle, name, read_cache):
+    """Read a dataset of PREFETCH_READERS or PREFETCH_DERIVED, each dataset is read once into read_cache"""
+    if name not in read_cache:
+        if name in PREFETCH_DERIVED:
+            source, derive = PREFETCH_DERIVED[name]
+            read_cache[name] = derive(_read_prefetch_dataset(fast5handle, source, read_cache))
+        else:
+            read_cache[name] = PREFETCH_READERS[name](fast5handle)
+    return read_cache[name]
+
+
+def read_fast5_datasets(fast5_path, datasets=("raw",)):
+    """Read datasets of every read in a fast5 file
+
+    Datasets which can not be read are set to None and the error is kept in "errors".
+
+    :param fast5_path: path to fast5 file
+    :param datasets: names of PREFETCH_READERS or PREFETCH_DERIVED to read
+    :return: list with a dict per read with path, read_id, the datasets and errors
+    """
+    reads = []
+    try:
+        with Fast5(fast5_path, 'r') as fast5handle:
+            for read_id in fast5handle.iterate_reads():
+                data = {"path": fast5_path, "read_id": read_id, "errors": dict()}
+                read_cache = dict()
+                for name in datasets:
+                    try:
+                        data[name] = _read_prefetch_dataset(fast5handle, name, read_cache)
+                    except Exception:
+                        data[name] = None
+                        data["errors"][name] = traceback.format_exc()
+                reads.append(data)
+    except Exception:
+        reads.append({"path": fast5_path, "read_id": None, "errors": {"file": traceback.format_exc()}})
+    return reads
+
+
+def _prefetched_bytes(reads):
+    """Approximate memory of the arrays read by read_fast5_datasets"""
+    arrays = dict()
+    for data in reads:
+        for value in data.values():
+            if isinstance(value, RawSignal):
+                value = [value.raw] if value._scaled is None else [value.raw, value._scaled]
+            elif isinstance(value, np.ndarray):
+                value = [value]
+            else:
+                continue
+            # raw and scaled share their arrays with raw_signal
+            arrays.update((id(array), array.nbytes) for array in value)
+    return sum(arrays.values())
+
+
+def prefetch_fast5(path, datasets=("raw",), num_workers=4, readahead=8, max_bytes=None, ordered=True,
+                   processes=False, strand_list=None, limit=None, sort_by_size=None):
+    """Iterate over the reads of fast5 files while a pool reads the next files in the background
+
+    At most readahead files are read ahead of the consumer. If max_bytes is set no new files are submitted while
+    the finished but not yet consumed arrays take more memory. Threads share the process and overlap the hdf5 io
+    with the consumer, processes also read in parallel but the arrays are pickled back to the consumer.
+
+    :param path: directory of fast5 files or filename, see iterate_fast5
+    :param datasets: names of PREFETCH_READERS or PREFETCH_DERIVED to read for every read
+    :param num_workers: number of threads or processes
+    :param readahead: maximum number of files read or being read ahead of the consumer
+    :param max_bytes: memory cap of the arrays read ahead of the consumer
+    :param ordered: yield reads in file order, otherwise as soon as they are read
+    :param processes: read with a process pool instead of a thread pool
+    :param strand_list: see iterate_fast5
+    :param limit: see iterate_fast5
+    :param sort_by_size: see iterate_fast5
+    :return: generator of dicts from read_fast5_datasets, one per read
+    """
+    assert readahead > 0, "readahead must be positive: {}".format(readahead)
+    for name in datasets:
+        assert name in PREFETCH_READERS or name in PREFETCH_DERIVED, "Unknown dataset {}. Options: {}".format(
+            name, sorted(list(PREFETCH_READERS) + list(PREFETCH_DERIVED)))
+    datasets = tuple(datasets)
+    files = iterate_fast5(path, strand_list=strand_list, paths=True, limit=limit, sort_by_size=sort_by_size)
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(max_workers=num_workers) as executor:
+        in_flight = deque()
+
+        def buffered_bytes():
+            return sum(_prefetched_bytes(future.result()) for future in in_flight if future.done())
+
+        def submit():
+            """Submit files until readahead or max_bytes is reached"""
+            while len(in_flight) < readahead and (max_bytes is None or not in_flight or
+                                                  buffered_bytes() < max_bytes):
+                fast5_path = next(files, None)
+                if fast5_path is None:
+                    return
+                in_flight.append(executor.submit(read_fast5_datasets, fast5_path, datasets))
+
+        submit()
+        while in_flight:
+            if ordered:
+                future = in_flight.popleft()
+            else:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                future = next(f for f in in_flight if f in done)
+                in_flight.remove(future)
+            reads = future.result()
+            submit()
+            for data in reads:
+                yield data
+
+
 def main():
     fast5_file = "/Users/andrewbailey/CLionProjects/nanopore-RNN/nanotensor/tests/test_files/minion-reads/canonical/miten_PC_20160820_FNFAD20259_MN17223_sequencing_run_AMS_158_R9_WGA_Ecoli_08_20_16_43623_ch100_read214_strand.fast5"
     f5fh = Fast5(fast5_file, read='r+')
@@ -12,13 +12,20 @@
 import sys
 import os
 import numpy as np
+import h5py
 from scipy import sparse
 from timeit import default_timer as timer
 from nanotensor.fast5 import Fast5
 from py3helpers.utils import list_dir, check_numpy_table
-from py3helpers.seq_tools import ReverseComplement
-from collections import defaultdict
+from py3helpers.seq_tools import sam_string_to_aligned_segment
+from collections import defaultdict, deque, OrderedDict
+from multiprocessing import Pool
 import traceback
+import hashlib
+from array import array
+
+# increment when changes to the mea alignment change its output so cached alignments are recomputed
+MEA_ALGORITHM_VERSION = 1
 
 
 def maximum_expected_accuracy_alignment(posterior_matrix, shortest_ref_per_event, return_all=False,
@@ -196,6 +203,279 @@ def maximum_expected_accuracy_alignment(posterior_matrix, shortest_ref_per_event
         return best_forward_edge
 
 
+def mea_edge_arrays(posterior_matrix, shortest_ref_per_event, batch_width=64, chunk_size=65536):
+    """Computes the maximum expected accuracy alignment with edges linked by integer indexes instead of nested lists
+
+    Same algorithm as maximum_expected_accuracy_alignment. Every edge is written once into flat storage allocated
+    with the number of non-zero cells and points to the edge it came from by index. Events with at least
+    batch_width references are processed as a single numpy batch, smaller events (signalAlign reports one to three
+    references per event) are cheaper to process one reference at a time.
+
+    :param posterior_matrix: matrix of posterior probabilities with reference as columns and
+                            events as rows, dense or in any scipy sparse format
+    :param shortest_ref_per_event: list of the highest possible reference position for all future events at a
+                                    given index
+    :param batch_width: minimum number of references for an event to be processed as a numpy batch
+    :param chunk_size: number of cells converted to python lists at a time
+
+    :return edges, forward_edges: structured array of edges ['ref_index', 'event_index', 'posterior_probability',
+                                  'sum_prob', 'prev_edge', 'cell_index'] (prev_edge of -1 is the start of a path and
+                                  cell_index is the index of the edge in the coo data of posterior_matrix) and the
+                                  indexes of the final forward edges sorted by reference index
+    """
+    # coo_matrix accepts dense matrices as well as any scipy sparse format
+    sparse_posterior_matrix = sparse.coo_matrix(posterior_matrix)
+    # events have to be processed in order and references in order within each event
+    order = np.lexsort((sparse_posterior_matrix.col, sparse_posterior_matrix.row))
+    rows = sparse_posterior_matrix.row[order]
+    cols = sparse_posterior_matrix.col[order].astype(np.int64)
+    data = sparse_posterior_matrix.data[order].astype(np.float64)
+    num_cells = len(data)
+    edges_dtype = [('ref_index', np.int64), ('event_index', np.int64), ('posterior_probability', np.float64),
+                   ('sum_prob', np.float64), ('prev_edge', np.int64), ('cell_index', np.int64)]
+    if num_cells == 0:
+        return np.zeros(0, dtype=edges_dtype), np.zeros(0, dtype=np.int64)
+    shortest_ref_per_event = np.asarray(shortest_ref_per_event).tolist()
+    # edge storage: ref_index, event_index, posterior_probability, sum_prob, prev_edge, cell_index
+    # typed arrays keep 8 bytes per value and are as fast as lists for single values
+    storage = tuple(array(np.dtype(dtype).char, bytes(8 * num_cells)) for _, dtype in edges_dtype)
+
+    # boundaries of each event in the sorted cells
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(rows)) + 1, [num_cells])).tolist()
+    event_indexes = rows[bounds[:-1]].tolist()
+
+    # first event: keep every reference up to the most probable one if it is at least as probable as the last
+    posteriors = data[:bounds[1]].tolist()
+    forward_edges = ([], [], [])
+    max_prob = 0
+    for x in range(posteriors.index(max(posteriors)) + 1):
+        if posteriors[x] >= max_prob:
+            max_prob = posteriors[x]
+            _add_edge(storage, forward_edges, len(forward_edges[0]), int(cols[x]), event_indexes[0], max_prob,
+                      max_prob, -1, int(order[x]))
+    num_edges = len(forward_edges[0])
+
+    # cells are converted to python lists a chunk at a time for the events processed one reference at a time
+    chunk_start = chunk_end = 0
+    for i in range(1, len(event_indexes)):
+        start, end = bounds[i], bounds[i + 1]
+        event_index = event_indexes[i]
+        shortest_ref = shortest_ref_per_event[event_index]
+        if end - start >= batch_width:
+            forward_edges, num_edges = _mea_event_batch(storage, forward_edges, num_edges, cols[start:end],
+                                                        data[start:end], order[start:end], event_index,
+                                                        shortest_ref)
+            continue
+        if end > chunk_end:
+            chunk_start, chunk_end = start, max(end, start + chunk_size)
+            col_list = cols[chunk_start:chunk_end].tolist()
+            data_list = data[chunk_start:chunk_end].tolist()
+            cell_list = order[chunk_start:chunk_end].tolist()
+        forward_edges, num_edges = _mea_event(storage, forward_edges, num_edges,
+                                              col_list[start - chunk_start:end - chunk_start],
+                                              data_list[start - chunk_start:end - chunk_start],
+                                              cell_list[start - chunk_start:end - chunk_start], event_index,
+                                              shortest_ref)
+
+    edges = np.zeros(num_edges, dtype=edges_dtype)
+    for (field, dtype), values in zip(edges_dtype, storage):
+        edges[field] = np.frombuffer(values, dtype=dtype, count=num_edges)
+    # trailing edges need some probability
+    forward_edges = np.asarray([edge for edge, sum_prob in zip(forward_edges[0], forward_edges[2]) if sum_prob > 0],
+                               dtype=np.int64)
+    return edges, forward_edges
+
+
+def _add_edge(storage, forward_edges, edge, ref_index, event_index, posterior, sum_prob, prev_edge, cell_index):
+    """Write an edge into mea_edge_arrays storage and append it to the forward edges"""
+    storage[0][edge] = ref_index
+    storage[1][edge] = event_index
+    storage[2][edge] = posterior
+    storage[3][edge] = sum_prob
+    storage[4][edge] = prev_edge
+    storage[5][edge] = cell_index
+    forward_edges[0].append(edge)
+    forward_edges[1].append(ref_index)
+    forward_edges[2].append(sum_prob)
+
+
+def _mea_event(storage, forward_edges, num_edges, ref_indexes, posteriors, cell_indexes, event_index, shortest_ref):
+    """Connect the references of one event to the forward edges one reference at a time
+
+    :param storage: edge storage arrays of mea_edge_arrays
+    :param forward_edges: (edges, ref_indexes, sum_probs) lists of the current forward edges
+    :param num_edges: number of edges already in storage
+    :param ref_indexes: sorted reference indexes of the event
+    :param posteriors: posterior probabilities of the event for each reference index
+    :param cell_indexes: index in the posterior matrix coo data for each reference index
+    :param event_index: index of the event
+    :param shortest_ref: shortest reference position for all future events
+    :return: new forward edges and number of edges in storage
+    """
+    edges, refs, sums = forward_edges
+    num_forward = len(edges)
+    new_edges = ([], [], [])
+    max_prob = 0
+    # only the best edge before the shortest future reference position can be used again
+    i = 0
+    while i < num_forward and refs[i] < shortest_ref:
+        i += 1
+    if i:
+        max_prob = sums[i - 1]
+        new_edges[0].append(edges[i - 1])
+        new_edges[1].append(refs[i - 1])
+        new_edges[2].append(max_prob)
+    i = 0
+    for ref_index, posterior, cell_index in zip(ref_indexes, posteriors, cell_indexes):
+        # carry forward edges before the reference if they improve the best probability
+        while i < num_forward and refs[i] < ref_index:
+            if sums[i] > max_prob:
+                max_prob = sums[i]
+                new_edges[0].append(edges[i])
+                new_edges[1].append(refs[i])
+                new_edges[2].append(max_prob)
+            i += 1
+        if i < num_forward and refs[i] == ref_index:
+            # stay on the same reference if it is strictly better than moving from the earlier reference
+            if i == 0 or sums[i] > sums[i - 1] + posterior:
+                sum_prob, prev_edge = sums[i], edges[i]
+            else:
+                sum_prob, prev_edge = sums[i - 1] + posterior, edges[i - 1]
+            i += 1
+        elif i == 0:
+            sum_prob, prev_edge = posterior, -1
+        else:
+            sum_prob, prev_edge = sums[i - 1] + posterior, edges[i - 1]
+        if sum_prob > max_prob:
+            max_prob = sum_prob
+            _add_edge(storage, new_edges, num_edges, ref_index, event_index, posterior, sum_prob, prev_edge,
+                      cell_index)
+            num_edges += 1
+    # carry trailing edges
+    while i < num_forward:
+        if sums[i] > max_prob:
+            max_prob = sums[i]
+            new_edges[0].append(edges[i])
+            new_edges[1].append(refs[i])
+            new_edges[2].append(max_prob)
+        i += 1
+    return new_edges, num_edges
+
+
+def _mea_event_batch(storage, forward_edges, num_edges, ref_indexes, posteriors, cell_indexes, event_index,
+                     shortest_ref):
+    """Connect all references of one event to the forward edges with numpy operations
+
+    Same inputs and outputs as _mea_event but ref_indexes, posteriors and cell_indexes are numpy arrays.
+    """
+    edges = np.asarray(forward_edges[0], dtype=np.int64)
+    refs = np.asarray(forward_edges[1], dtype=np.int64)
+    sums = np.asarray(forward_edges[2], dtype=np.float64)
+    num_forward = len(edges)
+    # only the best edge before the shortest future reference position can be used again
+    num_before = int(np.searchsorted(refs, shortest_ref, side='left'))
+    max_prob = sums[num_before - 1] if num_before else 0
+
+    # number of forward edges before each reference position
+    position = np.searchsorted(refs, ref_indexes, side='left')
+    has_prev = position > 0
+    prev_position = np.maximum(position - 1, 0)
+    same_position = np.minimum(position, max(num_forward - 1, 0))
+    has_same = (position < num_forward) & (refs[same_position] == ref_indexes) if num_forward else has_prev
+
+    # move from the best earlier reference or start a new path if there is no earlier reference
+    if num_forward:
+        new_sums = np.where(has_prev, sums[prev_position] + posteriors, posteriors)
+        new_prevs = np.where(has_prev, edges[prev_position], -1)
+        # stay on the same reference if it is strictly better than moving
+        stay = has_same & (~has_prev | (sums[same_position] > new_sums))
+        new_sums = np.where(stay, sums[same_position], new_sums)
+        new_prevs = np.where(stay, edges[same_position], new_prevs)
+    else:
+        new_sums = posteriors
+        new_prevs = np.full(len(posteriors), -1, dtype=np.int64)
+
+    # merge carried forward edges with new edges and keep the ones which increase the best probability
+    carried = np.ones(num_forward, dtype=bool)
+    carried[position[has_same]] = False
+    num_carried = int(np.count_nonzero(carried))
+    merged_refs = np.concatenate((refs[carried], ref_indexes))
+    merged_sums = np.concatenate((sums[carried], new_sums))
+    merged_edges = np.concatenate((edges[carried], np.full(len(ref_indexes), -1, dtype=np.int64)))
+    merge_order = np.argsort(merged_refs, kind='mergesort')
+    merged_refs = merged_refs[merge_order]
+    merged_sums = merged_sums[merge_order]
+    merged_edges = merged_edges[merge_order]
+    running_max = np.maximum.accumulate(np.concatenate(([max_prob], merged_sums)))[:-1]
+    keep = merged_sums > running_max
+
+    # write the new edges which were kept into storage
+    new_edge_mask = keep & (merged_edges == -1)
+    new_cells = merge_order[new_edge_mask] - num_carried
+    new_edge_indexes = np.arange(num_edges, num_edges + len(new_cells))
+    end = num_edges + len(new_cells)
+    for values, new_values in zip(storage, (ref_indexes[new_cells], event_index, posteriors[new_cells],
+                                            new_sums[new_cells], new_prevs[new_cells], cell_indexes[new_cells])):
+        np.frombuffer(values, dtype=values.typecode)[num_edges:end] = new_values
+    merged_edges[new_edge_mask] = new_edge_indexes
+
+    new_edges = (merged_edges[keep].tolist(), merged_refs[keep].tolist(), merged_sums[keep].tolist())
+    if num_before:
+        new_edges[0].insert(0, forward_edges[0][num_before - 1])
+        new_edges[1].insert(0, forward_edges[1][num_before - 1])
+        new_edges[2].insert(0, forward_edges[2][num_before - 1])
+    return new_edges, end
+
+
+def nested_edges_from_arrays(edges, edge_indexes):
+    """Convert edges from mea_edge_arrays into the nested list format of maximum_expected_accuracy_alignment
+
+    :param edges: structured array of edges from mea_edge_arrays
+    :param edge_indexes: indexes of edges to convert
+    :return: list of nested edges -> [ref_index, event_index, prob, sum_prob, [prev_event]]
+    """
+    nested = dict()
+    nested_edges = []
+    for edge_index in edge_indexes:
+        # walk back until we find an edge which has already been converted
+        chain = []
+        while edge_index != -1 and edge_index not in nested:
+            chain.append(edge_index)
+            edge_index = edges['prev_edge'][edge_index]
+        prev_edge = nested[edge_index] if edge_index != -1 else None
+        for index in reversed(chain):
+            edge = edges[index]
+            prev_edge = [edge['ref_index'], edge['event_index'], edge['posterior_probability'], edge['sum_prob'],
+                         prev_edge]
+            nested[index] = prev_edge
+        nested_edges.append(prev_edge)
+    return nested_edges
+
+
+def mea_vectorized(posterior_matrix, shortest_ref_per_event, return_all=False, sparse_posterior_matrix=None,
+                   batch_width=64):
+    """Drop in replacement for maximum_expected_accuracy_alignment using the array based mea_edge_arrays
+
+    :param posterior_matrix: matrix of posterior probabilities with reference as columns and
+                            events as rows.
+    :param shortest_ref_per_event: list of the highest possible reference position for all future events at a
+                                    given index
+    :param return_all: option to return all the paths through the matrix
+    :param sparse_posterior_matrix: unused, kept for the maximum_expected_accuracy_alignment signature. Dense and
+                                    sparse matrices are both accepted
+    :param batch_width: minimum number of references for an event to be processed as a numpy batch
+
+    :return best_path: a nested list of lists-> last_event = [ref_index, event_index, prob, sum_prob, [prev_event]]
+    """
+    edges, forward_edges = mea_edge_arrays(posterior_matrix, shortest_ref_per_event, batch_width=batch_width)
+    if return_all:
+        return nested_edges_from_arrays(edges, forward_edges)
+    if len(forward_edges) == 0:
+        return 0
+    best_edge = forward_edges[int(np.argmax(edges['sum_prob'][forward_edges]))]
+    return nested_edges_from_arrays(edges, [best_edge])[0]
+
+
 def binary_search_for_edge(forward_edges, ref_index, event_index, posterior):
     """Search the forward edges list for best ref index comparison
     :param forward_edges: list of forward edges to search
@@ -244,33 +524,34 @@ def binary_search_for_edge(forward_edges, ref_index, event_index, posterior):
             i = (l + r) // 2
 
 
-def get_indexes_from_best_path(best_path):
-    """Grab the reference and event index of the best path from the maximum_expected_accuracy_alignment function.
-    :param best_path: output from maximum_expected_accuracy_alignment
-    :return: list of events [[ref_pos, event_pos]...]
+def get_edge_path(edges, edge_index):
+    """Follow the prev_edge backpointers from an edge of mea_edge_arrays to the start of the path
+
+    :param edges: structured array of edges from mea_edge_arrays
+    :param edge_index: index of the last edge in the path
+    :return: numpy array of edge indexes from the first event to the last
     """
+    prev_edges = edges["prev_edge"]
     path = []
-    while best_path[4]:
-        ref_pos = best_path[0]
-        event_pos = best_path[1]
-        path.append([ref_pos, event_pos])
-        best_path = best_path[4]
-    # gather last event
-    ref_pos = best_path[0]
-    event_pos = best_path[1]
-    path.append([ref_pos, event_pos])
-    # flip ordering of path
-    return path[::-1]
-
-
-def get_mea_params_from_events(events):
+    while edge_index != -1:
+        path.append(edge_index)
+        edge_index = prev_edges[edge_index]
+    return np.asarray(path[::-1], dtype=np.int64)
+
+
+def get_mea_params_from_events(events, sparse_output=False):
     """Get the posterior matrix, shortest_ref_per_event and event matrix from events table
 
-    :param events: events table with required fields"""
+    :param events: events table with required fields
+    :param sparse_output: return a sparse posterior matrix and the row index into events for each non-zero cell
+                          instead of the dense posterior matrix and event matrix
+    """
     check_numpy_table(events, req_fields=('contig', 'reference_index', 'reference_kmer', 'strand', 'event_index',
                                          'event_mean', 'event_noise', 'event_duration', 'aligned_kmer',
                                          'scaled_mean_current', 'scaled_noise', 'posterior_probability',
                                          'descaled_event_mean', 'ont_model_mean', 'path_kmer'))
+    if sparse_output:
+        return sparse_mea_params_from_events(events)
     # get min/max args
     ref_start = min(events["reference_index"])
     ref_end = max(events["reference_index"])
@@ -319,6 +600,137 @@ def get_mea_params_from_events(events):
     return posterior_matrix, shortest_ref_per_event, event_matrix
 
 
+def sparse_mea_params_from_events(events):
+    """Get a sparse posterior matrix, shortest_ref_per_event and event rows from events table
+
+    Memory scales with the number of rows in the events table instead of events x reference positions.
+
+    :param events: events table with required fields
+    :return posterior_matrix, shortest_ref_per_event, event_rows: coo_matrix with cells sorted by event then
+                    reference, shortest reference index of each event and all future events (inf for events
+                    without data) and the index into events for each non-zero cell of posterior_matrix
+    """
+    check_numpy_table(events, req_fields=('reference_index', 'event_index', 'posterior_probability'))
+    reference_index = np.asarray(events["reference_index"], dtype=np.int64)
+    event_index = np.asarray(events["event_index"], dtype=np.int64)
+    ref_start, ref_end, minus_strand = get_mea_reference_bounds(events)
+    event_start = event_index.min()
+    event_end = event_index.max()
+
+    if minus_strand:
+        ref_indx = ref_end - reference_index
+    else:
+        ref_indx = reference_index - ref_start
+    event_indx = event_index - event_start
+    ref_length = int(ref_end - ref_start + 1)
+    event_length = int(event_end - event_start + 1)
+
+    # sort cells by event then reference and keep the first row of the events table for duplicate cells
+    event_rows = np.lexsort((ref_indx, event_indx))
+    cells = event_indx[event_rows] * ref_length + ref_indx[event_rows]
+    unique_cells = np.ones(len(cells), dtype=bool)
+    unique_cells[1:] = cells[1:] != cells[:-1]
+    event_rows = event_rows[unique_cells]
+    rows = event_indx[event_rows]
+    cols = ref_indx[event_rows]
+    posterior_matrix = sparse.coo_matrix((np.asarray(events["posterior_probability"], dtype=np.float64)[event_rows],
+                                          (rows, cols)), shape=(event_length, ref_length))
+
+    shortest_ref_per_event = get_shortest_ref_per_event(rows, cols, event_length)
+    return posterior_matrix, shortest_ref_per_event, event_rows
+
+
+def get_mea_reference_bounds(events):
+    """Get the reference start, end and strand of a signalAlign events table
+
+    :param events: events table with 'reference_index' and 'event_index' fields
+    :return ref_start, ref_end, minus_strand: minus strand reads have reference index decreasing with event index
+    """
+    check_numpy_table(events, req_fields=('reference_index', 'event_index'))
+    reference_index = np.asarray(events["reference_index"], dtype=np.int64)
+    event_index = np.asarray(events["event_index"], dtype=np.int64)
+    # check strand of the read
+    minus_strand = bool(reference_index[event_index == event_index.min()].min() >
+                        reference_index[event_index == event_index.max()].max())
+    return reference_index.min(), reference_index.max(), minus_strand
+
+
+def get_shortest_ref_per_event(rows, cols, event_length):
+    """Get the shortest reference index for each event and all events after it from the non-zero cells of a
+    posterior matrix
+
+    :param rows: event index of each cell
+    :param cols: reference index of each cell
+    :param event_length: number of events in the posterior matrix
+    :return: numpy array of shortest reference index per event, inf for events without cells
+    """
+    shortest_ref_per_event = np.full(event_length, np.inf)
+    np.minimum.at(shortest_ref_per_event, rows, cols)
+    has_data = np.isfinite(shortest_ref_per_event)
+    shortest_ref_per_event = np.minimum.accumulate(shortest_ref_per_event[::-1])[::-1]
+    shortest_ref_per_event[~has_data] = np.inf
+    return shortest_ref_per_event
+
+
+def get_guide_band_centers(sam_string, events):
+    """Get the center of the band for each event of the sparse posterior matrix from the guide alignment
+
+    Events are spread evenly over the read and each is assigned the reference position the guide alignment gives
+    for its read position.
+
+    :param sam_string: sam alignment string of the guide alignment
+    :param events: signalAlign events table
+    :return: numpy array of reference index in posterior matrix coordinates for each event
+    """
+    ref_start, ref_end, minus_strand = get_mea_reference_bounds(events)
+    event_length = int(events["event_index"].max() - events["event_index"].min() + 1)
+    aligned_segment = sam_string_to_aligned_segment(sam_string)
+    aligned_pairs = np.asarray(aligned_segment.get_aligned_pairs(matches_only=True), dtype=np.int64)
+    query_length = aligned_segment.infer_read_length()
+    query_index = aligned_pairs[:, 0]
+    if minus_strand:
+        ref_indx = ref_end - aligned_pairs[:, 1]
+        query_index = query_length - 1 - query_index
+    else:
+        ref_indx = aligned_pairs[:, 1] - ref_start
+    order = np.argsort(query_index, kind='mergesort')
+    event_query_index = np.linspace(0, query_length - 1, event_length)
+    return np.rint(np.interp(event_query_index, query_index[order], ref_indx[order])).astype(np.int64)
+
+
+def get_diagonal_band_centers(event_length, ref_length):
+    """Get the center of the band for each event along the diagonal of the posterior matrix
+
+    :param event_length: number of events in the posterior matrix
+    :param ref_length: number of reference positions in the posterior matrix
+    :return: numpy array of reference index for each event
+    """
+    return np.rint(np.linspace(0, ref_length - 1, event_length)).astype(np.int64)
+
+
+def band_posterior_matrix(posterior_matrix, band_centers, band_width):
+    """Remove the cells of a posterior matrix outside of a band around the center reference index of each event
+
+    :param posterior_matrix: matrix of posterior probabilities with reference as columns and events as rows
+    :param band_centers: center reference index of the band for each event
+    :param band_width: number of reference positions on each side of the center
+    :return posterior_matrix, shortest_ref_per_event, in_band: coo_matrix of cells inside the band, shortest
+                    reference per event for the banded matrix and mask of the kept cells of the coo data
+    """
+    assert band_width >= 0, "band_width must be non-negative: {}".format(band_width)
+    posterior_matrix = sparse.coo_matrix(posterior_matrix)
+    band_centers = np.asarray(band_centers)
+    assert len(band_centers) == posterior_matrix.shape[0], \
+        "Need one band center per event: {} != {}".format(len(band_centers), posterior_matrix.shape[0])
+    in_band = np.abs(posterior_matrix.col - band_centers[posterior_matrix.row]) <= band_width
+    banded_matrix = sparse.coo_matrix((posterior_matrix.data[in_band],
+                                       (posterior_matrix.row[in_band], posterior_matrix.col[in_band])),
+                                      shape=posterior_matrix.shape)
+    shortest_ref_per_event = get_shortest_ref_per_event(banded_matrix.row, banded_matrix.col,
+                                                        posterior_matrix.shape[0])
+    return banded_matrix, shortest_ref_per_event, in_band
+
+
 def mea_alignment_from_signal_align(fast5_path, events=None):
     """Get the maximum expected alignment from a nanopore read fast5 file which has signalalign data
 
@@ -327,19 +739,256 @@ def mea_alignment_from_signal_align(fast5_path, events=None):
     """
     if events is None:
         assert os.path.isfile(fast5_path)
-        fileh = Fast5(fast5_path)
-        events = fileh.get_signalalign_events()
+        with Fast5(fast5_path, 'r') as fileh:
+            events = fileh.get_signalalign_events()
 
-    posterior_matrix, shortest_ref_per_event, event_matrix = get_mea_params_from_events(events)
+    posterior_matrix, shortest_ref_per_event, event_rows = get_mea_params_from_events(events, sparse_output=True)
     # get mea alignment
-    mea_alignments = maximum_expected_accuracy_alignment(posterior_matrix, shortest_ref_per_event)
-    # get raw index values from alignment data structure
-    best_path = get_indexes_from_best_path(mea_alignments)
-    # corrected_path = fix_path_indexes(best_path)
-    final_event_table = get_events_from_path(event_matrix, best_path)
+    edges, forward_edges = mea_edge_arrays(posterior_matrix, shortest_ref_per_event)
+    best_edge = forward_edges[np.argmax(edges["sum_prob"][forward_edges])]
+    # each edge knows the cell of the posterior matrix and each cell knows the row of the events table
+    path = get_edge_path(edges, best_edge)
+    final_event_table = events[event_rows[edges["cell_index"][path]]]
     return final_event_table
 
 
+def banded_mea_alignment_from_signal_align(fast5_path, events=None, band_width=50, guide_alignment=True,
+                                           sam_string=None):
+    """Get the maximum expected alignment only using cells in a band around the guide alignment or the diagonal
+
+    :param fast5_path: path to fast5 file
+    :param events: directly pass events in via a numpy array
+    :param band_width: number of reference positions on each side of the band center
+    :param guide_alignment: center the band on the guide alignment, otherwise on the diagonal
+    :param sam_string: directly pass the guide alignment sam string
+    :return final_event_table, band_edge_touches: mea alignment events and number of path events on the band edge
+    """
+    if events is None or (guide_alignment and sam_string is None):
+        assert os.path.isfile(fast5_path)
+        with Fast5(fast5_path, 'r') as fileh:
+            if events is None:
+                events = fileh.get_signalalign_events()
+            if guide_alignment and sam_string is None:
+                sam_string = fileh.get_signalalign_events(sam=True)
+
+    posterior_matrix, _, event_rows = get_mea_params_from_events(events, sparse_output=True)
+    if guide_alignment:
+        band_centers = get_guide_band_centers(sam_string, events)
+    else:
+        band_centers = get_diagonal_band_centers(*posterior_matrix.shape)
+    posterior_matrix, shortest_ref_per_event, in_band = band_posterior_matrix(posterior_matrix, band_centers,
+                                                                              band_width)
+    event_rows = event_rows[in_band]
+    edges, forward_edges = mea_edge_arrays(posterior_matrix, shortest_ref_per_event)
+    assert len(forward_edges) > 0, "No cells inside band of width {}".format(band_width)
+    best_edge = forward_edges[np.argmax(edges["sum_prob"][forward_edges])]
+    path = get_edge_path(edges, best_edge)
+    # a path on the edge of the band may have been cut short by the band
+    path_edges = edges[path]
+    band_edge_touches = int(np.count_nonzero(
+        np.abs(path_edges["ref_index"] - band_centers[path_edges["event_index"]]) == band_width))
+    final_event_table = events[event_rows[path_edges["cell_index"]]]
+    return final_event_table, band_edge_touches
+
+
+class MeaCache(object):
+    """On disk least recently used cache of mea alignments keyed by the signalAlign events and algorithm version"""
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3):
+        """Index mea alignments already in the cache directory
+
+        :param cache_dir: directory to store mea alignments
+        :param max_bytes: maximum size of all cached mea alignments
+        """
+        assert max_bytes > 0, "max_bytes must be positive: {}".format(max_bytes)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # least recently used first
+        self.entries = OrderedDict()
+        cached_files = sorted(list_dir(cache_dir, ext=".npy"), key=os.path.getmtime)
+        for path in cached_files:
+            self.entries[os.path.basename(path)[:-4]] = os.path.getsize(path)
+        self.size = sum(self.entries.values())
+
+    @staticmethod
+    def key(events):
+        """Hash of the signalAlign events table and MEA_ALGORITHM_VERSION
+
+        :param events: signalAlign full events table
+        """
+        events = np.ascontiguousarray(events)
+        key_hash = hashlib.sha1(str(MEA_ALGORITHM_VERSION).encode())
+        key_hash.update(str(events.dtype.descr).encode())
+        key_hash.update(events.tobytes())
+        return key_hash.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, "{}.npy".format(key))
+
+    def get(self, key):
+        """Get a cached mea alignment or None if it is not cached
+
+        :param key: key from MeaCache.key
+        """
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            mea_events = np.load(path)
+        except (IOError, ValueError):
+            # removed or corrupted by another process
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        os.utime(path, None)
+        self.hits += 1
+        return mea_events
+
+    def put(self, key, mea_events):
+        """Store a mea alignment and evict least recently used alignments to stay under max_bytes
+
+        :param key: key from MeaCache.key
+        :param mea_events: mea alignment events table
+        """
+        path = self._path(key)
+        np.save(path, mea_events)
+        if key in self.entries:
+            self.size -= self.entries.pop(key)
+        self.entries[key] = os.path.getsize(path)
+        self.size += self.entries[key]
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+def cached_mea_alignment_from_signal_align(fast5_path, cache, events=None):
+    """Get the maximum expected alignment from the cache or compute and cache it
+
+    :param fast5_path: path to fast5 file
+    :param cache: MeaCache object
+    :param events: directly pass events in via a numpy array
+    """
+    if events is None:
+        assert os.path.isfile(fast5_path)
+        with Fast5(fast5_path, 'r') as fileh:
+            events = fileh.get_signalalign_events()
+    key = cache.key(events)
+    mea_events = cache.get(key)
+    if mea_events is None:
+        mea_events = mea_alignment_from_signal_align(fast5_path, events=events)
+        cache.put(key, mea_events)
+    return mea_events
+
+
+def _mea_alignment_worker(args):
+    """Compute the mea alignment of a single fast5 file opened read only
+
+    :param args: (fast5_path, band_width, guide_alignment) band_width of None runs the full mea alignment
+    :return fast5_path, mea_events, seconds, error: mea_events is None and error is the traceback if it failed
+    """
+    fast5_path, band_width, guide_alignment = args
+    start = timer()
+    try:
+        with Fast5(fast5_path, 'r') as fileh:
+            events = fileh.get_signalalign_events()
+            sam_string = fileh.get_signalalign_events(sam=True) if band_width is not None and guide_alignment \
+                else None
+        if band_width is None:
+            mea_events = mea_alignment_from_signal_align(fast5_path, events=events)
+        else:
+            mea_events, _ = banded_mea_alignment_from_signal_align(fast5_path, events=events, band_width=band_width,
+                                                                   guide_alignment=guide_alignment,
+                                                                   sam_string=sam_string)
+        return fast5_path, mea_events, timer() - start, None
+    except Exception:
+        return fast5_path, None, timer() - start, traceback.format_exc()
+
+
+def batch_mea_alignment(fast5_files, num_workers=1, output_path=None, max_in_flight=None, band_width=None,
+                        guide_alignment=True, overwrite=False):
+    """Compute mea alignments for many fast5 files with a process pool
+
+    Workers only read the fast5 files and send back the mea alignment table. The parent writes each table
+    into the latest signalAlign analysis of its fast5 file or, if output_path is set, into one hdf5 file with a
+    dataset per read.
+
+    :param fast5_files: directory of fast5 files or list of fast5 paths
+    :param num_workers: number of worker processes
+    :param output_path: path to consolidated hdf5 output file
+    :param max_in_flight: maximum number of reads submitted to the pool but not yet written (default 2 x workers)
+    :param band_width: run the banded mea alignment with this band width
+    :param guide_alignment: center the band on the guide alignment, otherwise on the diagonal
+    :param overwrite: replace existing mea alignment tables
+    :return: dict with number of successes and failures, failed reads, per read seconds and total seconds
+    """
+    if isinstance(fast5_files, str):
+        assert os.path.isdir(fast5_files), "fast5_files must be a directory or list of files: {}".format(fast5_files)
+        fast5_files = list_dir(fast5_files, ext="fast5")
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+    assert max_in_flight > 0, "max_in_flight must be positive: {}".format(max_in_flight)
+    summary = {"success": 0, "failed": 0, "failures": dict(), "read_seconds": dict()}
+    output_fh = h5py.File(output_path, 'a') if output_path else None
+    start = timer()
+    try:
+        with Pool(processes=num_workers) as pool:
+            in_flight = deque()
+            jobs = ((fast5_path, band_width, guide_alignment) for fast5_path in fast5_files)
+            for args in jobs:
+                in_flight.append(pool.apply_async(_mea_alignment_worker, (args,)))
+                if len(in_flight) >= max_in_flight:
+                    _write_mea_alignment(in_flight.popleft().get(), summary, output_fh, overwrite)
+            while in_flight:
+                _write_mea_alignment(in_flight.popleft().get(), summary, output_fh, overwrite)
+    finally:
+        if output_fh is not None:
+            output_fh.close()
+    summary["total_seconds"] = timer() - start
+    print("MEA alignment: {} succeeded, {} failed in {:.2f} seconds".format(summary["success"], summary["failed"],
+                                                                           summary["total_seconds"]),
+          file=sys.stderr)
+    return summary
+
+
+def _write_mea_alignment(result, summary, output_fh=None, overwrite=False):
+    """Write a result from _mea_alignment_worker and record it in the batch_mea_alignment summary"""
+    fast5_path, mea_events, seconds, error = result
+    summary["read_seconds"][fast5_path] = seconds
+    if error is None:
+        try:
+            if output_fh is not None:
+                name = os.path.splitext(os.path.basename(fast5_path))[0]
+                if name in output_fh and overwrite:
+                    del output_fh[name]
+                output_fh.create_dataset(name, data=mea_events, compression=True)
+                output_fh[name].attrs["fast5_path"] = fast5_path
+            else:
+                with Fast5(fast5_path, 'r+') as fileh:
+                    fileh.set_mea_alignment_table(mea_events, overwrite=overwrite)
+        except Exception:
+            error = traceback.format_exc()
+    if error is None:
+        summary["success"] += 1
+    else:
+        summary["failed"] += 1
+        summary["failures"][fast5_path] = error
+        print("{} failed with {}".format(fast5_path, error), file=sys.stderr)
+
+
 def get_events_from_path(event_matrix, path):
     """Return an event table from a list of index pairs generated from the mea alignment
 
@@ -355,17 +1004,54 @@ def get_events_from_path(event_matrix, path):
                                 ('ont_model_mean', '<f8'), ('path_kmer', 'S5')])
     events_dtype = events.dtype
     # for each pair, access event info from matrix
-    for index_pair in path:
-        ref_pos = index_pair[0]
-        event_pos = index_pair[1]
-        try:
-            events = np.append(events, np.array(event_matrix[event_pos][ref_pos], dtype=events_dtype))
-        except TypeError:
-            traceback.print_exc(file=sys.stderr)
-            raise TypeError("Selected non event location in event matrix. Check path for correct indexes")
+    path_events = [event_matrix[event_pos][ref_pos] for ref_pos, event_pos in path]
+    try:
+        if not all(isinstance(event, np.void) for event in path_events):
+            raise TypeError("Event matrix location is not an event")
+        events = np.array(path_events, dtype=events_dtype)
+    except TypeError:
+        traceback.print_exc(file=sys.stderr)
+        raise TypeError("Selected non event location in event matrix. Check path for correct indexes")
     return events
 
 
+# upper case every byte then swap A/T and G/C, same as ReverseComplement
+_UPPER_CASE_TABLE = np.arange(256, dtype=np.uint8)
+_UPPER_CASE_TABLE[ord('a'):ord('z') + 1] -= ord('a') - ord('A')
+_COMPLEMENT_TABLE = _UPPER_CASE_TABLE.copy()
+for _base, _complement in zip(b"ATGC", b"TACG"):
+    _COMPLEMENT_TABLE[_UPPER_CASE_TABLE == _base] = _complement
+
+
+def transform_kmers(kmers, reverse=False, complement=False):
+    """Reverse and/or complement an array of fixed width kmers with byte lookup tables
+
+    Output matches ReverseComplement applied to each kmer, including converting to upper case.
+
+    :param kmers: array of bytes (or str) kmers eg: 'S5'
+    :param reverse: reverse each kmer
+    :param complement: complement each kmer
+    :return: numpy array of bytes kmers with the same width
+    """
+    kmers = np.asarray(kmers)
+    if kmers.dtype.kind == 'U':
+        kmers = np.char.encode(kmers, 'ascii')
+    assert kmers.dtype.kind == 'S', "kmers must be bytes or str: {}".format(kmers.dtype)
+    width = kmers.dtype.itemsize
+    kmer_bytes = np.ascontiguousarray(kmers).view(np.uint8).reshape(len(kmers), width)
+    if complement:
+        kmer_bytes = _COMPLEMENT_TABLE[kmer_bytes]
+    else:
+        kmer_bytes = _UPPER_CASE_TABLE[kmer_bytes]
+    if reverse:
+        # shorter kmers are padded with null bytes which have to stay at the end
+        lengths = np.count_nonzero(kmer_bytes, axis=1)
+        positions = np.arange(width)
+        reverse_index = np.where(positions < lengths[:, None], lengths[:, None] - 1 - positions, positions)
+        kmer_bytes = np.take_along_axis(kmer_bytes, reverse_index, axis=1)
+    return np.ascontiguousarray(kmer_bytes).view('S{}'.format(width)).ravel()
+
+
 def match_events_with_signalalign(sa_events=None, event_detections=None, minus=False, rna=False):
     """Match event index with event detection data to label segments of signal for each kmer
 
@@ -394,31 +1080,22 @@ def match_events_with_signalalign(sa_events=None, event_detections=None, minus=F
     label = np.zeros(len(sa_events), dtype=[('raw_start', int), ('raw_length', int), ('reference_index', int),
                                             ('posterior_probability', float), ('kmer', 'S5')])
 
-    label['raw_start'] = [event_detections[x]["raw_start"] for x in sa_events["event_index"]]
-    label['raw_length'] = [event_detections[x]["raw_length"] for x in sa_events["event_index"]]
+    label['raw_start'] = np.asarray(event_detections["raw_start"])[sa_events["event_index"]]
+    label['raw_length'] = np.asarray(event_detections["raw_length"])[sa_events["event_index"]]
     label['reference_index'] = sa_events["reference_index"]
 
-    def convert_to_str(string):
-        """Helper function to catch bytes as strings"""
-        if type(string) is str:
-            return string
-        else:
-            return bytes.decode(string)
-
-    flip = ReverseComplement()
     if minus:
         if rna:
-            kmers = [flip.complement(convert_to_str(x)) for x in sa_events["reference_kmer"]]
+            kmers = transform_kmers(sa_events["reference_kmer"], complement=True)
         else:
-            kmers = [flip.reverse_complement(convert_to_str(x)) for x in sa_events["reference_kmer"]]
+            kmers = transform_kmers(sa_events["reference_kmer"], reverse=True, complement=True)
     else:
         if rna:
-            kmers = [flip.reverse(convert_to_str(x)) for x in sa_events["reference_kmer"]]
+            kmers = transform_kmers(sa_events["reference_kmer"], reverse=True)
         else:
             kmers = sa_events["reference_kmer"]
     label['kmer'] = kmers
     label['posterior_probability'] = sa_events["posterior_probability"]
-    np.sort(label, order='raw_start', kind='mergesort')
 
     return label
 
@@ -516,6 +1193,34 @@ def create_random_prob_matrix(row=None, col=None, gaps=True):
     return prob_matrix, shortest_future_col_per_row
 
 
+def create_random_banded_prob_matrix(row=None, col=None, cells_per_row=3, band_width=10, seed=None):
+    """Create a sparse matrix of random probability distributions along each row inside a band around the diagonal
+
+    Unlike create_random_prob_matrix the matrix is never dense so it can be used for realistic read lengths.
+
+    :param row: number of rows
+    :param col: number of columns
+    :param cells_per_row: number of random cells in each row before removing duplicates
+    :param band_width: number of columns on each side of the diagonal cells can be placed
+    :param seed: seed for the random number generator
+    :return posterior_matrix, shortest_future_col_per_row: coo_matrix with cells sorted by row then column
+    """
+    assert row is not None, "Must set row option"
+    assert col is not None, "Must set col option"
+    assert cells_per_row > 0, "cells_per_row must be positive: {}".format(cells_per_row)
+    random_state = np.random.RandomState(seed)
+    centers = get_diagonal_band_centers(row, col)
+    offsets = random_state.randint(-band_width, band_width + 1, size=(row, cells_per_row))
+    cols = np.clip(centers[:, None] + offsets, 0, col - 1)
+    cells = np.unique((np.arange(row, dtype=np.int64)[:, None] * col + cols).ravel())
+    rows = cells // col
+    cols = cells % col
+    data = random_state.random_sample(len(cells))
+    data /= np.bincount(rows, weights=data, minlength=row)[rows]
+    posterior_matrix = sparse.coo_matrix((data, (rows, cols)), shape=(row, col))
+    return posterior_matrix, get_shortest_ref_per_event(rows, cols, row)
+
+
 def matrix_event_length_pairs_test(posterior_matrix, shortest_events):
     """Test if the shortest events list matches what is in the posterior matrix"""
     # posterior matrix is events x ref
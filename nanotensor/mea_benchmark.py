@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""Benchmark the maximum expected accuracy alignment implementations on seeded synthetic workloads"""
+########################################################################
+# File: mea_benchmark.py
+#  executable: mea_benchmark.py
+#
+# Author: Andrew Bailey
+# History: Created 05/02/18
+########################################################################
+
+from __future__ import print_function
+import sys
+import os
+import platform
+import argparse
+import subprocess
+import tracemalloc
+from datetime import datetime
+from timeit import default_timer as timer
+import numpy as np
+from scipy import sparse
+from py3helpers.utils import save_json
+
+from nanotensor.mea_algorithm import maximum_expected_accuracy_alignment, mea_vectorized, mea_edge_arrays, \
+    mea_slow, mea_slower, band_posterior_matrix, get_diagonal_band_centers, create_random_prob_matrix, \
+    create_random_banded_prob_matrix
+
+
+def _banded_mea(posterior_matrix, shortest_ref_per_event, band_width):
+    """Run mea_edge_arrays on the cells inside a band around the diagonal"""
+    band_centers = get_diagonal_band_centers(*posterior_matrix.shape)
+    posterior_matrix, shortest_ref_per_event, _ = band_posterior_matrix(posterior_matrix, band_centers, band_width)
+    return mea_edge_arrays(posterior_matrix, shortest_ref_per_event)
+
+
+# every variant takes a sparse posterior matrix, shortest ref per event and the workload band width
+MEA_VARIANTS = {
+    "maximum_expected_accuracy_alignment": lambda matrix, shortest_ref, band_width:
+    maximum_expected_accuracy_alignment(matrix, shortest_ref, sparse_posterior_matrix=True),
+    "mea_vectorized": lambda matrix, shortest_ref, band_width:
+    mea_vectorized(matrix, shortest_ref, sparse_posterior_matrix=True),
+    "mea_edge_arrays": lambda matrix, shortest_ref, band_width:
+    mea_edge_arrays(matrix, shortest_ref),
+    "banded_mea": _banded_mea,
+    "mea_slower": lambda matrix, shortest_ref, band_width:
+    mea_slower(matrix, shortest_ref, sparse_posterior_matrix=True),
+    "mea_slow": lambda matrix, shortest_ref, band_width: mea_slow(matrix.toarray(), shortest_ref),
+}
+# variants which are too slow or need a dense matrix
+SLOW_VARIANTS = ("mea_slower", "mea_slow")
+
+
+def get_workloads(max_events=100000, events=(1000, 10000, 100000), cells_per_row=(2, 5, 20),
+                  band_widths=(10, 50), events_per_ref=1.5, dense_sizes=(50, 100, 200), seed=0):
+    """Get the list of benchmark workloads
+
+    Dense workloads come from create_random_prob_matrix and banded workloads from
+    create_random_banded_prob_matrix. signalAlign usually reports 1-3 cells per event.
+
+    :param max_events: skip workloads with more events
+    :param events: number of events of the banded workloads
+    :param cells_per_row: number of cells per event of the banded workloads
+    :param band_widths: band widths of the banded workloads
+    :param events_per_ref: number of events per reference position of the banded workloads
+    :param dense_sizes: number of events and reference positions of the dense workloads
+    :param seed: seed of the first workload, each workload gets its own seed
+    :return: list of workload dictionaries
+    """
+    workloads = []
+    for size in dense_sizes:
+        if size <= max_events:
+            workloads.append({"type": "dense", "events": size, "refs": size, "cells_per_row": None,
+                              "band_width": None})
+    for num_events in events:
+        if num_events > max_events:
+            continue
+        for num_cells in cells_per_row:
+            for band_width in band_widths:
+                workloads.append({"type": "banded", "events": num_events,
+                                  "refs": max(1, int(num_events / events_per_ref)), "cells_per_row": num_cells,
+                                  "band_width": band_width})
+    for i, workload in enumerate(workloads):
+        workload["seed"] = seed + i
+    return workloads
+
+
+def create_workload(workload):
+    """Create the posterior matrix and shortest ref per event of a workload
+
+    :param workload: workload dictionary from get_workloads
+    :return posterior_matrix, shortest_ref_per_event: coo_matrix and numpy array
+    """
+    if workload["type"] == "dense":
+        # create_random_prob_matrix uses the global random state
+        np.random.seed(workload["seed"])
+        posterior_matrix, shortest_ref_per_event = create_random_prob_matrix(row=workload["events"],
+                                                                             col=workload["refs"])
+        return sparse.coo_matrix(posterior_matrix), shortest_ref_per_event
+    return create_random_banded_prob_matrix(row=workload["events"], col=workload["refs"],
+                                            cells_per_row=workload["cells_per_row"],
+                                            band_width=workload["band_width"], seed=workload["seed"])
+
+
+def time_variant(function, posterior_matrix, shortest_ref_per_event, band_width, repeats=3):
+    """Time a mea variant and measure its peak memory
+
+    :param function: mea variant from MEA_VARIANTS
+    :param posterior_matrix: sparse posterior matrix
+    :param shortest_ref_per_event: shortest ref position per event
+    :param band_width: workload band width
+    :param repeats: number of timed runs
+    :return: dictionary of run times in seconds and peak traced memory in bytes
+    """
+    times = []
+    for _ in range(repeats):
+        start = timer()
+        function(posterior_matrix, shortest_ref_per_event, band_width)
+        times.append(timer() - start)
+    # tracing slows down python so memory is measured in a separate run
+    tracemalloc.start()
+    try:
+        function(posterior_matrix, shortest_ref_per_event, band_width)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"times": times, "min_time": min(times), "mean_time": float(np.mean(times)),
+            "peak_memory": peak_memory}
+
+
+def run_mea_benchmark(workloads, variants=None, repeats=3, max_slow_area=40000):
+    """Run every mea variant on every workload
+
+    :param workloads: list of workload dictionaries from get_workloads
+    :param variants: names of MEA_VARIANTS to run, default all
+    :param repeats: number of timed runs per variant
+    :param max_slow_area: skip SLOW_VARIANTS on workloads with more events x reference positions
+    :return: list of result dictionaries
+    """
+    if variants is None:
+        variants = sorted(MEA_VARIANTS.keys())
+    for variant in variants:
+        assert variant in MEA_VARIANTS, "Unknown mea variant {}. Options: {}".format(variant,
+                                                                                     sorted(MEA_VARIANTS.keys()))
+    results = []
+    for workload in workloads:
+        posterior_matrix, shortest_ref_per_event = create_workload(workload)
+        for variant in variants:
+            if variant in SLOW_VARIANTS and workload["events"] * workload["refs"] > max_slow_area:
+                continue
+            result = dict(workload)
+            result["variant"] = variant
+            result["cells"] = int(posterior_matrix.nnz)
+            result.update(time_variant(MEA_VARIANTS[variant], posterior_matrix, shortest_ref_per_event,
+                                       workload["band_width"] or posterior_matrix.shape[1], repeats=repeats))
+            print("{variant} events={events} cells={cells}: {min_time:.4f}s {peak_memory} bytes".format(**result),
+                  file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def get_git_commit():
+    """Get the git commit of the repository or None"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_mea_benchmark(results, output_path):
+    """Save benchmark results with environment information as json
+
+    :param results: results from run_mea_benchmark
+    :param output_path: path to json file
+    """
+    benchmark = {"commit": get_git_commit(),
+                 "date": datetime.now().isoformat(),
+                 "python": platform.python_version(),
+                 "numpy": np.__version__,
+                 "platform": platform.platform(),
+                 "results": results}
+    return save_json(benchmark, output_path)
+
+
+def main(in_opts=None):
+    """Run the mea benchmark from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output', required=True, help='path to json output')
+    parser.add_argument('--max-events', type=int, default=100000, help='largest number of events in a workload')
+    parser.add_argument('--repeats', type=int, default=3, help='number of timed runs per variant')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first workload')
+    parser.add_argument('--variants', nargs='+', default=None, choices=sorted(MEA_VARIANTS.keys()),
+                        help='mea variants to run')
+    parser.add_argument('--max-slow-area', type=int, default=40000,
+                        help='largest events x reference positions for {}'.format(', '.join(SLOW_VARIANTS)))
+    args = parser.parse_args(in_opts)
+
+    start = timer()
+    workloads = get_workloads(max_events=args.max_events, seed=args.seed)
+    results = run_mea_benchmark(workloads, variants=args.variants, repeats=args.repeats,
+                                max_slow_area=args.max_slow_area)
+    save_mea_benchmark(results, args.output)
+    stop = timer()
+    print("Running Time = {} seconds".format(stop - start), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
+    raise SystemExit
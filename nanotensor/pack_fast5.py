@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""Pack a directory of single read fast5 files into multi-read bundle files"""
+########################################################################
+# File: pack_fast5.py
+#  executable: pack_fast5.py
+#
+# Author: Andrew Bailey
+# History: Created 05/07/18
+########################################################################
+
+from __future__ import print_function
+import sys
+import os
+import argparse
+import traceback
+from multiprocessing import Pool
+from timeit import default_timer as timer
+import h5py
+import numpy as np
+from py3helpers.utils import list_dir, save_json, load_json
+
+from nanotensor.fast5 import Fast5
+
+# same whitelist as Fast5.strip_analyses, raw data and channel metadata are always packed
+DEFAULT_KEEP = ('{}_000'.format(Fast5.__event_detect_name__),)
+MANIFEST_NAME = "manifest.json"
+INDEX_NAME = "index.json"
+
+
+def get_bundle_name(bundle_number):
+    """Name of a bundle file"""
+    return "bundle_{:05d}.fast5".format(bundle_number)
+
+
+def get_bundle_index_path(bundle_path):
+    """Path of the read index written next to a finished bundle"""
+    return os.path.splitext(bundle_path)[0] + ".index.json"
+
+
+def assign_bundles(fast5_files, num_bundles=None, reads_per_bundle=4000):
+    """Split fast5 files into bundles of consecutive files
+
+    :param fast5_files: list of fast5 paths
+    :param num_bundles: number of bundles, default enough bundles for reads_per_bundle
+    :param reads_per_bundle: number of reads per bundle if num_bundles is not set
+    :return: list of lists of fast5 paths
+    """
+    fast5_files = sorted(fast5_files)
+    if num_bundles is None:
+        num_bundles = int(np.ceil(len(fast5_files) / reads_per_bundle))
+    assert num_bundles > 0, "num_bundles must be positive: {}".format(num_bundles)
+    num_bundles = min(num_bundles, len(fast5_files))
+    return [list(files) for files in np.array_split(np.asarray(fast5_files, dtype=object), num_bundles)]
+
+
+def copy_group(source, destination, compression="gzip", compression_opts=1):
+    """Recursively copy a hdf group with chunked and compressed datasets
+
+    :param source: hdf group to copy
+    :param destination: empty hdf group to copy into
+    :param compression: hdf5 compression filter
+    :param compression_opts: compression level
+    """
+    destination.attrs.update(source.attrs)
+    for name, item in source.items():
+        if isinstance(item, h5py.Group):
+            copy_group(item, destination.create_group(name), compression=compression,
+                       compression_opts=compression_opts)
+        elif item.shape == () or item.size == 0:
+            # scalars (fastq, sam strings) and empty datasets can not be chunked
+            destination.create_dataset(name, data=item[()])
+            destination[name].attrs.update(item.attrs)
+        else:
+            destination.create_dataset(name, data=item[()], chunks=True, shuffle=True, compression=compression,
+                                       compression_opts=compression_opts)
+            destination[name].attrs.update(item.attrs)
+
+
+def pack_read(fast5_path, bundle, keep=DEFAULT_KEEP, compression="gzip", compression_opts=1):
+    """Add a single read fast5 file to an open multi-read bundle
+
+    :param fast5_path: path to single read fast5 file
+    :param bundle: h5py File opened for writing
+    :param keep: whitelist of analysis groups to keep
+    :param compression: hdf5 compression filter
+    :param compression_opts: compression level
+    :return: read id and read group of the read in the bundle
+    """
+    with Fast5(fast5_path, 'r') as fast5handle:
+        assert not fast5handle.is_multi_read, "{} is already a multi-read file".format(fast5_path)
+        read_id = fast5handle.get_read_ids()[0]
+        if read_id is None:
+            read_id = fast5handle.name_short
+        read_group = fast5handle.__multi_read_prefix__ + read_id
+        group = bundle.create_group(read_group)
+        try:
+            copy_group(fast5handle.get_read(group=True, raw=True), group.create_group("Raw"),
+                       compression=compression, compression_opts=compression_opts)
+            for name, path in fast5handle.__multi_read_meta_paths__.items():
+                source_path = getattr(fast5handle, name)
+                if source_path in fast5handle:
+                    copy_group(fast5handle[source_path], group.create_group(path), compression=compression,
+                               compression_opts=compression_opts)
+            analyses = group.create_group(fast5handle.__base_analysis__.strip('/'))
+            if fast5handle.__base_analysis__ in fast5handle:
+                for name, analysis in fast5handle[fast5handle.__base_analysis__].items():
+                    if name in keep:
+                        copy_group(analysis, analyses.create_group(name), compression=compression,
+                                   compression_opts=compression_opts)
+        except Exception:
+            # a half written read would shift the offsets of every later read in the bundle
+            del bundle[read_group]
+            raise
+    return read_id, read_group
+
+
+def pack_bundle(fast5_files, bundle_path, keep=DEFAULT_KEEP, compression="gzip", compression_opts=1):
+    """Write a bundle file and its read index
+
+    The bundle is written to a temporary file and renamed when it is complete so an interrupted run never
+    leaves a bundle which looks finished.
+
+    :param fast5_files: paths of single read fast5 files in the bundle
+    :param bundle_path: path to bundle file
+    :param keep: whitelist of analysis groups to keep
+    :param compression: hdf5 compression filter
+    :param compression_opts: compression level
+    :return: read index of the bundle and dict of failed files to errors
+    """
+    tmp_path = bundle_path + ".tmp"
+    index = dict()
+    failures = dict()
+    bundle_name = os.path.basename(bundle_path)
+    # track creation order so the read offsets in the index match the order of the read groups
+    with h5py.File(tmp_path, 'w', track_order=True) as bundle:
+        bundle.attrs["file_type"] = "multi-read"
+        for fast5_path in fast5_files:
+            try:
+                read_id, read_group = pack_read(fast5_path, bundle, keep=keep, compression=compression,
+                                                compression_opts=compression_opts)
+            except Exception:
+                failures[fast5_path] = traceback.format_exc()
+                continue
+            index[read_id] = {"bundle": bundle_name, "group": read_group, "offset": len(index),
+                              "source": os.path.abspath(fast5_path)}
+    save_json({"reads": index, "failures": failures}, get_bundle_index_path(bundle_path))
+    os.rename(tmp_path, bundle_path)
+    return index, failures
+
+
+def _pack_bundle_worker(args):
+    """Pool worker for pack_bundle"""
+    fast5_files, bundle_path, keep, compression, compression_opts = args
+    start = timer()
+    index, failures = pack_bundle(fast5_files, bundle_path, keep=keep, compression=compression,
+                                  compression_opts=compression_opts)
+    return bundle_path, index, failures, timer() - start
+
+
+def is_bundle_finished(bundle_path):
+    """A bundle is finished when the bundle and its read index exist"""
+    return os.path.exists(bundle_path) and os.path.exists(get_bundle_index_path(bundle_path))
+
+
+def pack_fast5_directory(fast5_dir, output_dir, num_bundles=None, reads_per_bundle=4000, num_workers=1,
+                         keep=DEFAULT_KEEP, compression="gzip", compression_opts=1):
+    """Pack single read fast5 files into multi-read bundles in parallel
+
+    The assignment of files to bundles is saved in a manifest on the first run. Running again with the same
+    output directory only packs the bundles which did not finish and rebuilds the read index. The fast5 files
+    and keep must match the manifest. Reads with a read_id which is already in the index are reported as
+    failures and left out of the index.
+
+    :param fast5_dir: directory of single read fast5 files or list of fast5 paths
+    :param output_dir: directory for bundles, manifest and read index
+    :param num_bundles: number of bundles, default enough bundles for reads_per_bundle
+    :param reads_per_bundle: number of reads per bundle if num_bundles is not set
+    :param num_workers: number of worker processes
+    :param keep: whitelist of analysis groups to keep
+    :param compression: hdf5 compression filter
+    :param compression_opts: compression level
+    :return: dict with number of packed reads and bundles, failed files and total seconds
+    """
+    start = timer()
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if isinstance(fast5_dir, str):
+        assert os.path.isdir(fast5_dir), "fast5_dir must be a directory or list of files: {}".format(fast5_dir)
+        fast5_dir = list_dir(fast5_dir, ext="fast5")
+    assert len(fast5_dir) > 0, "No fast5 files to pack"
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        manifest = load_json(manifest_path)
+        bundles = manifest["bundles"]
+        assert sorted(manifest["keep"]) == sorted(keep), \
+            "keep {} does not match the manifest in {}: {}".format(list(keep), output_dir, manifest["keep"])
+        assert sorted(os.path.abspath(path) for path in fast5_dir) == \
+            sorted(os.path.abspath(path) for files in bundles.values() for path in files), \
+            "fast5 files do not match the manifest in {}, use a new output directory".format(output_dir)
+    else:
+        bundles = {get_bundle_name(i): files for i, files in
+                   enumerate(assign_bundles(fast5_dir, num_bundles=num_bundles, reads_per_bundle=reads_per_bundle))}
+        save_json({"bundles": bundles, "keep": list(keep)}, manifest_path)
+
+    jobs = []
+    for bundle_name in sorted(bundles):
+        bundle_path = os.path.join(output_dir, bundle_name)
+        if not is_bundle_finished(bundle_path):
+            jobs.append((bundles[bundle_name], bundle_path, tuple(keep), compression, compression_opts))
+    with Pool(processes=num_workers) as pool:
+        for bundle_path, _, failures, seconds in pool.imap_unordered(_pack_bundle_worker, jobs):
+            print("Packed {} in {:.2f} seconds with {} failures".format(bundle_path, seconds, len(failures)),
+                  file=sys.stderr)
+
+    index = dict()
+    failures = dict()
+    for bundle_name in sorted(bundles):
+        bundle_index = load_json(get_bundle_index_path(os.path.join(output_dir, bundle_name)))
+        failures.update(bundle_index["failures"])
+        for read_id, location in bundle_index["reads"].items():
+            if read_id in index:
+                failures[location["source"]] = "Duplicate read_id {} already packed from {}".format(
+                    read_id, index[read_id]["source"])
+            else:
+                index[read_id] = location
+    save_json(index, os.path.join(output_dir, INDEX_NAME))
+    return {"reads": len(index), "bundles": len(bundles), "packed_bundles": len(jobs), "failures": failures,
+            "total_seconds": timer() - start}
+
+
+def main(in_opts=None):
+    """Pack single read fast5 files from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', '--fast5_dir', required=True, help='directory of single read fast5 files')
+    parser.add_argument('-o', '--output_dir', required=True, help='directory for bundles and the read index')
+    parser.add_argument('-n', '--num_bundles', type=int, default=None, help='number of bundle files')
+    parser.add_argument('--reads_per_bundle', type=int, default=4000,
+                        help='reads per bundle if --num_bundles is not set')
+    parser.add_argument('-j', '--num_workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--keep', nargs='+', default=list(DEFAULT_KEEP), help='analysis groups to keep')
+    parser.add_argument('--compression_opts', type=int, default=1, help='gzip compression level')
+    args = parser.parse_args(in_opts)
+
+    summary = pack_fast5_directory(args.fast5_dir, args.output_dir, num_bundles=args.num_bundles,
+                                   reads_per_bundle=args.reads_per_bundle, num_workers=args.num_workers,
+                                   keep=args.keep, compression_opts=args.compression_opts)
+    print("Packed {reads} reads into {bundles} bundles with {} failures in {total_seconds:.2f} seconds".format(
+        len(summary["failures"]), **summary), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
+    raise SystemExit
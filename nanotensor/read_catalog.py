@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""Scan fast5 files once into a columnar catalog of per read metadata"""
+########################################################################
+# File: read_catalog.py
+#  executable: read_catalog.py
+#
+# Author: Andrew Bailey
+# History: Created 05/08/18
+########################################################################
+
+from __future__ import print_function
+import sys
+import os
+import argparse
+import traceback
+from collections import OrderedDict
+from multiprocessing import Pool
+from timeit import default_timer as timer
+import numpy as np
+from py3helpers.utils import list_dir
+
+from nanotensor.fast5 import Fast5
+
+# catalog columns and their numpy types, string columns are stored as unicode arrays
+CATALOG_COLUMNS = OrderedDict([("path", str), ("mtime", np.float64), ("file_size", np.int64), ("read_id", str),
+                               ("read_number", np.int64), ("channel", str), ("start_time", np.int64),
+                               ("duration", np.int64), ("sampling_rate", np.float64), ("is_rna", bool),
+                               ("signal_length", np.int64), ("event_length", np.int64), ("analyses", str),
+                               ("error", str)])
+# separator of the analysis group names in the analyses column
+ANALYSES_SEP = ";"
+
+
+def _decode(value):
+    """Decode bytes attributes"""
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def scan_fast5(fast5_path):
+    """Get the catalog rows of every read in a fast5 file
+
+    Unknown values are -1 or empty strings. Files which can not be read give one row with the error.
+
+    :param fast5_path: path to fast5 file
+    :return: list of row dicts
+    """
+    stat = os.stat(fast5_path)
+    rows = []
+    try:
+        with Fast5(fast5_path, 'r') as fast5handle:
+            for read_id in fast5handle.iterate_reads():
+                row = {"path": fast5_path, "mtime": stat.st_mtime, "file_size": stat.st_size,
+                       "read_id": read_id or "", "error": ""}
+                raw_attributes = fast5handle.raw_attributes
+                channel_meta = fast5handle.channel_meta
+                row["read_number"] = raw_attributes.get("read_number", -1)
+                row["start_time"] = raw_attributes.get("start_time", -1)
+                row["duration"] = raw_attributes.get("duration", -1)
+                row["channel"] = _decode(channel_meta.get("channel_number", ""))
+                row["sampling_rate"] = channel_meta.get("sampling_rate", -1)
+                row["is_rna"] = fast5handle.is_read_rna()
+                row["signal_length"] = fast5handle.get_read(group=True, raw=True)["Signal"].shape[0]
+                try:
+                    row["event_length"] = len(fast5handle.get_read(group=True)["Events"])
+                except (IndexError, KeyError, StopIteration):
+                    row["event_length"] = -1
+                if fast5handle.__base_analysis__ in fast5handle:
+                    row["analyses"] = ANALYSES_SEP.join(fast5handle[fast5handle.__base_analysis__].keys())
+                else:
+                    row["analyses"] = ""
+                rows.append(row)
+    except Exception:
+        rows = [{"path": fast5_path, "mtime": stat.st_mtime, "file_size": stat.st_size,
+                 "error": traceback.format_exc()}]
+    return rows
+
+
+def rows_to_catalog(rows):
+    """Convert catalog rows to a dict of column arrays"""
+    catalog = OrderedDict()
+    for name, dtype in CATALOG_COLUMNS.items():
+        default = "" if dtype is str else (False if dtype is bool else -1)
+        catalog[name] = np.array([row.get(name, default) for row in rows], dtype=dtype)
+    return catalog
+
+
+def catalog_to_rows(catalog, indices=None):
+    """Convert catalog columns back to row dicts"""
+    if indices is None:
+        indices = range(len(catalog["path"]))
+    return [{name: catalog[name][i].item() for name in CATALOG_COLUMNS} for i in indices]
+
+
+def save_read_catalog(catalog, catalog_path):
+    """Save a catalog as a npz file of columns
+
+    :param catalog: dict of column arrays
+    :param catalog_path: path to npz file
+    """
+    with open(catalog_path, "wb") as fh:
+        np.savez(fh, **catalog)
+    return catalog_path
+
+
+def load_read_catalog(catalog_path):
+    """Load a catalog saved with save_read_catalog
+
+    :param catalog_path: path to npz file
+    :return: dict of column arrays
+    """
+    with np.load(catalog_path) as data:
+        return OrderedDict((name, data[name]) for name in CATALOG_COLUMNS)
+
+
+def build_read_catalog(fast5_dir, catalog_path=None, num_workers=1):
+    """Scan fast5 files in parallel into a catalog
+
+    If catalog_path exists only new files and files with a different modification time are scanned again. Rows
+    of files which no longer exist are dropped.
+
+    :param fast5_dir: directory of fast5 files or list of fast5 paths
+    :param catalog_path: npz file to update and save the catalog to
+    :param num_workers: number of worker processes
+    :return: dict of column arrays sorted by path
+    """
+    start = timer()
+    if isinstance(fast5_dir, str):
+        assert os.path.isdir(fast5_dir), "fast5_dir must be a directory or list of files: {}".format(fast5_dir)
+        fast5_dir = list_dir(fast5_dir, ext="fast5")
+    fast5_files = sorted(os.path.abspath(path) for path in fast5_dir)
+
+    rows_by_file = OrderedDict((path, None) for path in fast5_files)
+    if catalog_path is not None and os.path.exists(catalog_path):
+        old_catalog = load_read_catalog(catalog_path)
+        for row in catalog_to_rows(old_catalog):
+            path = row["path"]
+            if path in rows_by_file and os.path.getmtime(path) == row["mtime"]:
+                rows_by_file[path] = rows_by_file[path] or []
+                rows_by_file[path].append(row)
+
+    to_scan = [path for path, rows in rows_by_file.items() if rows is None]
+    if to_scan:
+        with Pool(processes=num_workers) as pool:
+            for path, rows in zip(to_scan, pool.imap(scan_fast5, to_scan, chunksize=16)):
+                rows_by_file[path] = rows
+    catalog = rows_to_catalog([row for rows in rows_by_file.values() for row in rows])
+    if catalog_path is not None:
+        save_read_catalog(catalog, catalog_path)
+    print("Scanned {} of {} fast5 files in {:.2f} seconds".format(len(to_scan), len(fast5_files), timer() - start),
+          file=sys.stderr)
+    return catalog
+
+
+def query_read_catalog(catalog, mask=None, analysis=None, sort_by=None, reverse=False, include_errors=False):
+    """Filter and sort the reads of a catalog
+
+    :param catalog: dict of column arrays
+    :param mask: boolean array or function of the catalog returning a boolean array
+    :param analysis: only keep reads with this analysis group name, eg. 'SignalAlign_000'
+    :param sort_by: column name to sort by
+    :param reverse: sort in descending order
+    :param include_errors: keep files which could not be read
+    :return: catalog with the selected reads
+    """
+    keep = np.ones(len(catalog["path"]), dtype=bool)
+    if not include_errors:
+        keep &= catalog["error"] == ""
+    if mask is not None:
+        keep &= mask(catalog) if callable(mask) else np.asarray(mask, dtype=bool)
+    if analysis is not None:
+        analyses = np.char.add(np.char.add(ANALYSES_SEP, catalog["analyses"]), ANALYSES_SEP)
+        keep &= np.char.find(analyses, ANALYSES_SEP + analysis + ANALYSES_SEP) >= 0
+    indices = np.flatnonzero(keep)
+    if sort_by is not None:
+        assert sort_by in catalog, "Unknown column {}. Options: {}".format(sort_by, list(catalog.keys()))
+        indices = indices[np.argsort(catalog[sort_by][indices], kind="stable")]
+        if reverse:
+            indices = indices[::-1]
+    return OrderedDict((name, column[indices]) for name, column in catalog.items())
+
+
+def get_catalog_paths(catalog):
+    """Unique fast5 paths of a catalog in catalog order"""
+    return list(OrderedDict.fromkeys(catalog["path"].tolist()))
+
+
+def main(in_opts=None):
+    """Build or update a read catalog from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', '--fast5_dir', required=True, help='directory of fast5 files')
+    parser.add_argument('-o', '--output', required=True, help='path to npz catalog, updated if it exists')
+    parser.add_argument('-j', '--num_workers', type=int, default=1, help='number of worker processes')
+    args = parser.parse_args(in_opts)
+
+    catalog = build_read_catalog(args.fast5_dir, catalog_path=args.output, num_workers=args.num_workers)
+    print("{} reads in {}".format(len(catalog["path"]), args.output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
+    raise SystemExit
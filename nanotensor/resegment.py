@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""Resegment a directory of basecalled fast5 files in parallel with named event detection presets"""
+########################################################################
+# File: resegment.py
+#  executable: resegment.py
+#
+# Author: Andrew Bailey
+# History: Created 05/14/18
+########################################################################
+
+from __future__ import print_function
+import sys
+import os
+import argparse
+import traceback
+from multiprocessing import Pool
+from timeit import default_timer as timer
+import numpy as np
+from py3helpers.utils import list_dir, save_json, load_json
+
+from nanotensor.fast5 import Fast5
+from nanotensor.event_detection import resegment_reads, get_resegment_accuracy, EVENT_DETECTORS
+from nanotensor.read_catalog import load_read_catalog, get_catalog_paths
+
+# event detection parameters for each type of read and detector
+RESEGMENT_PRESETS = {
+    "dna_speedy": dict(detector="speedy", min_width=5, max_width=80, min_gain_per_sample=0.008, window_width=800),
+    "dna_minknow": dict(detector="minknow", window_lengths=(5, 10), thresholds=(2.0, 1.1), peak_height=1.2),
+    "dna_ttest": dict(detector="ttest", window_lengths=(5, 10), thresholds=(2.0, 1.1), peak_height=1.2),
+    "rna_speedy": dict(detector="speedy", min_width=5, max_width=40, min_gain_per_sample=0.008, window_width=800),
+    "rna_minknow": dict(detector="minknow", window_lengths=(5, 10), thresholds=(1.9, 1.0), peak_height=1.2),
+    "rna_ttest": dict(detector="ttest", window_lengths=(5, 10), thresholds=(1.9, 1.0), peak_height=1.2)}
+RESEGMENT_NAME = "ReSegmentBasecall"
+
+
+def get_preset_params(preset, overrides=None):
+    """Copy of the parameters of a preset
+
+    :param preset: name of a RESEGMENT_PRESETS entry
+    :param overrides: dict of parameters replacing the preset values
+    :return: dict of resegment_reads parameters
+    """
+    assert preset in RESEGMENT_PRESETS, "Unknown preset {}. Options: {}".format(preset,
+                                                                                sorted(RESEGMENT_PRESETS.keys()))
+    params = dict(RESEGMENT_PRESETS[preset])
+    if overrides:
+        params.update(overrides)
+    return params
+
+
+def _attribute_equal(stored, value):
+    """Compare an hdf attribute with the parameter value it was written from"""
+    if isinstance(stored, bytes):
+        stored = stored.decode()
+    if isinstance(value, str) or isinstance(stored, str):
+        return stored == value
+    return np.array_equal(np.asarray(stored), np.asarray(value))
+
+
+def is_resegmented(fast5handle, params):
+    """Check if the latest resegmented event table was made with the same parameters
+
+    :param fast5handle: open Fast5 object
+    :param params: resegment_reads parameters with a "detector"
+    :return: True if the stored attributes match every parameter
+    """
+    try:
+        attributes = fast5handle[fast5handle.get_analysis_latest(RESEGMENT_NAME)].attrs
+    except (IndexError, KeyError):
+        return False
+    params = dict(params)
+    detector = params.pop("detector")
+    if not _attribute_equal(attributes.get("event_detection", ""), EVENT_DETECTORS[detector][1]):
+        return False
+    return all(name in attributes and _attribute_equal(attributes[name], value) for name, value in params.items())
+
+
+def resegment_fast5(fast5_path, params, overwrite=False, skip_existing=True, accuracy=True, chunk_size=None):
+    """Resegment one read and summarize the result
+
+    :param fast5_path: path to fast5 file
+    :param params: resegment_reads parameters with a "detector"
+    :param overwrite: overwrite the latest resegmented event table instead of adding a new one
+    :param skip_existing: skip reads resegmented with identical parameters
+    :param accuracy: compute the accuracy of the resegmented sequence with get_resegment_accuracy
+    :param chunk_size: stream ttest event detection in chunks of this many samples
+    :return: dict with path, status, accuracy, seconds and error
+    """
+    start = timer()
+    row = {"path": fast5_path, "status": "resegmented", "accuracy": -1.0, "error": ""}
+    try:
+        with Fast5(fast5_path, 'r') as fast5handle:
+            skip = skip_existing and is_resegmented(fast5handle, params)
+        if skip:
+            row["status"] = "skipped"
+            fast5handle = Fast5(fast5_path, 'r')
+        else:
+            fast5handle = resegment_reads(fast5_path, params, overwrite=overwrite, chunk_size=chunk_size)
+        try:
+            if accuracy:
+                row["accuracy"] = get_resegment_accuracy(fast5handle)
+        finally:
+            fast5handle.close()
+    except Exception:
+        row["status"] = "failed"
+        row["error"] = traceback.format_exc()
+    row["seconds"] = timer() - start
+    return row
+
+
+def _resegment_fast5_worker(args):
+    """Pool worker for resegment_fast5"""
+    fast5_path, kwargs = args
+    return resegment_fast5(fast5_path, **kwargs)
+
+
+def resegment_directory(fast5_dir, params, num_workers=1, overwrite=False, skip_existing=True, accuracy=True,
+                        chunk_size=None):
+    """Resegment fast5 files over a pool of worker processes
+
+    :param fast5_dir: directory of fast5 files, list of fast5 paths or read catalog
+    :param params: resegment_reads parameters with a "detector"
+    :param num_workers: number of worker processes
+    :param overwrite: overwrite the latest resegmented event table instead of adding a new one
+    :param skip_existing: skip reads resegmented with identical parameters
+    :param accuracy: compute the accuracy of each resegmented sequence
+    :param chunk_size: stream ttest event detection in chunks of this many samples
+    :return: dict with per read rows, counts, mean accuracy, total seconds and reads per second
+    """
+    start = timer()
+    assert "detector" in params and params["detector"] in EVENT_DETECTORS, \
+        "params need a detector. Options: {}".format(sorted(EVENT_DETECTORS.keys()))
+    if isinstance(fast5_dir, dict):
+        fast5_files = get_catalog_paths(fast5_dir)
+    elif isinstance(fast5_dir, str):
+        assert os.path.isdir(fast5_dir), "fast5_dir must be a directory, list of files or catalog: {}".format(
+            fast5_dir)
+        fast5_files = sorted(list_dir(fast5_dir, ext="fast5"))
+    else:
+        fast5_files = list(fast5_dir)
+    kwargs = dict(params=params, overwrite=overwrite, skip_existing=skip_existing, accuracy=accuracy,
+                  chunk_size=chunk_size)
+    rows = []
+    with Pool(processes=num_workers) as pool:
+        for row in pool.imap_unordered(_resegment_fast5_worker, [(path, kwargs) for path in fast5_files]):
+            if row["status"] == "failed":
+                print("Failed to resegment {}: {}".format(row["path"], row["error"]), file=sys.stderr)
+            rows.append(row)
+    rows.sort(key=lambda x: x["path"])
+    total_seconds = timer() - start
+    accuracies = [row["accuracy"] for row in rows if row["status"] != "failed" and row["accuracy"] >= 0]
+    summary = {"reads": rows, "total_seconds": total_seconds,
+               "reads_per_second": len(rows) / max(total_seconds, 1e-12),
+               "mean_accuracy": float(np.mean(accuracies)) if accuracies else -1.0}
+    for status in ("resegmented", "skipped", "failed"):
+        summary[status] = sum(row["status"] == status for row in rows)
+    return summary
+
+
+def main(in_opts=None):
+    """Resegment fast5 files from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-d', '--fast5_dir', help='directory of basecalled fast5 files')
+    group.add_argument('-c', '--catalog', help='npz read catalog from read_catalog.py')
+    parser.add_argument('-p', '--preset', required=True, choices=sorted(RESEGMENT_PRESETS.keys()),
+                        help='event detection parameter preset')
+    parser.add_argument('--params', default=None, help='json file of parameters overriding the preset')
+    parser.add_argument('-j', '--num_workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='overwrite the latest resegmented event table instead of adding a new one')
+    parser.add_argument('--no_skip', action='store_true',
+                        help='resegment reads already resegmented with identical parameters')
+    parser.add_argument('--no_accuracy', action='store_true', help='do not compute per read accuracy')
+    parser.add_argument('--chunk_size', type=int, default=None,
+                        help='stream ttest event detection in chunks of this many samples')
+    parser.add_argument('-o', '--output', default=None, help='path to json summary')
+    args = parser.parse_args(in_opts)
+
+    params = get_preset_params(args.preset, overrides=load_json(args.params) if args.params else None)
+    fast5_dir = load_read_catalog(args.catalog) if args.catalog else args.fast5_dir
+    summary = resegment_directory(fast5_dir, params, num_workers=args.num_workers, overwrite=args.overwrite,
+                                  skip_existing=not args.no_skip, accuracy=not args.no_accuracy,
+                                  chunk_size=args.chunk_size)
+    if args.output:
+        save_json(dict(summary, preset=args.preset, params=params), args.output)
+    for row in summary["reads"]:
+        if row["status"] != "failed":
+            print("{}\t{}\t{:.4f}".format(row["path"], row["status"], row["accuracy"]))
+    print("Resegmented {resegmented}, skipped {skipped} and failed {failed} reads in {total_seconds:.2f} seconds: "
+          "{reads_per_second:.2f} reads/sec, mean accuracy {mean_accuracy:.4f}".format(**summary), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
+    raise SystemExit
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""Rank a grid of event detection parameters by resegmentation accuracy without writing to the fast5 files"""
+########################################################################
+# File: resegment_sweep.py
+#  executable: resegment_sweep.py
+#
+# Author: Andrew Bailey
+# History: Created 05/15/18
+########################################################################
+
+from __future__ import print_function
+import sys
+import os
+import json
+import argparse
+import itertools
+import traceback
+from multiprocessing import Pool, shared_memory
+from timeit import default_timer as timer
+import numpy as np
+from py3helpers.utils import list_dir, load_json
+from py3helpers.seq_tools import pairwise_alignment_accuracy
+
+from nanotensor.fast5 import Fast5, RawSignal
+from nanotensor.event_detection import EVENT_DETECTORS, anchor_resegmented_events, get_fastq_sequence
+from nanotensor.read_catalog import load_read_catalog, get_catalog_paths
+from nanotensor.resegment import resegment_directory
+
+# columns of the ranked sweep table
+SWEEP_COLUMNS = ("rank", "params", "mean_accuracy", "median_accuracy", "min_accuracy", "mean_events",
+                 "mean_anchored_events", "mean_bases", "reads", "failed", "seconds")
+# cache of the worker processes
+_SWEEP_CACHE = dict()
+
+
+def expand_param_grid(grid):
+    """Every combination of the values of a parameter grid
+
+    :param grid: dict of parameter name to a list of values, a value which is not a list is the only value.
+                 eg. {"detector": "ttest", "window_lengths": [[5, 10], [6, 12]], "peak_height": [1.0, 1.2]}
+    :return: list of parameter dicts, list values are converted to tuples
+    """
+    names = sorted(grid.keys())
+    values = []
+    for name in names:
+        options = grid[name] if isinstance(grid[name], list) else [grid[name]]
+        values.append([tuple(option) if isinstance(option, list) else option for option in options])
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def load_sweep_cache(fast5_files, section="template"):
+    """Read the raw signal, basecalled events and basecalled sequence of each read once
+
+    Reads which can not be used are left out of the cache.
+
+    :param fast5_files: list of fast5 paths with basecalled events
+    :param section: basecall section of the sequence
+    :return: dict with the concatenated raw signal, the bytes of the concatenated basecalled event tables, per read
+             lists and the paths which failed
+    """
+    reads = {"path": [], "signal_start": [], "signal_length": [], "offset": [], "raw_unit": [],
+             "sampling_freq": [], "start_time": [], "rna": [], "events_start": [], "events_length": [],
+             "events_dtype": [], "sequence": []}
+    signals = []
+    event_tables = []
+    failed = dict()
+    signal_start = 0
+    events_start = 0
+    for fast5_path in fast5_files:
+        try:
+            with Fast5(fast5_path, 'r') as fast5handle:
+                raw_signal = fast5handle.get_raw_signal()
+                old_events = np.ascontiguousarray(fast5handle.get_basecall_data())
+                sequence = get_fastq_sequence(fast5handle, "Basecall_1D", section=section)
+                read = {"path": fast5_path, "signal_start": signal_start, "signal_length": len(raw_signal),
+                        "offset": raw_signal.offset, "raw_unit": raw_signal.raw_unit,
+                        "sampling_freq": fast5handle.sample_rate,
+                        "start_time": fast5handle.raw_attributes['start_time'], "rna": fast5handle.is_read_rna(),
+                        "events_start": events_start, "events_length": len(old_events),
+                        "events_dtype": old_events.dtype, "sequence": sequence}
+        except Exception:
+            failed[fast5_path] = traceback.format_exc()
+            continue
+        for name, value in read.items():
+            reads[name].append(value)
+        signals.append(raw_signal.raw)
+        signal_start += len(raw_signal)
+        # event tables of different reads can have different dtypes so they are kept as bytes
+        event_tables.append(old_events.view(np.uint8))
+        events_start += old_events.nbytes
+    reads["signal"] = np.concatenate(signals) if signals else np.zeros(0, dtype=np.int16)
+    reads["old_events"] = np.concatenate(event_tables) if event_tables else np.zeros(0, dtype=np.uint8)
+    reads["failed"] = failed
+    return reads
+
+
+def _share_array(array):
+    """Copy an array into a new shared memory block
+
+    :param array: 1d numpy array
+    :return: shared memory block and the arguments _attach_array needs to view it
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.dtype, len(array))
+
+
+def _attach_array(name, shared):
+    """View a shared memory block from _share_array as a read only array in a worker"""
+    shm_name, dtype, size = shared
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _SWEEP_CACHE[name + "_shm"] = shm
+    array = np.ndarray(size, dtype=dtype, buffer=shm.buf)
+    array.setflags(write=False)
+    _SWEEP_CACHE[name] = array
+
+
+def _init_sweep_worker(shared_signal, shared_events, reads):
+    """Attach a worker to the shared signal and event tables"""
+    _attach_array("signal", shared_signal)
+    _attach_array("old_events", shared_events)
+    _SWEEP_CACHE["reads"] = reads
+
+
+def get_cached_signal(read_index, detector):
+    """Scaled signal of a cached read in the type the detector needs"""
+    reads = _SWEEP_CACHE["reads"]
+    start = reads["signal_start"][read_index]
+    raw_signal = RawSignal(_SWEEP_CACHE["signal"][start:start + reads["signal_length"][read_index]],
+                           reads["offset"][read_index], reads["raw_unit"][read_index])
+    if detector == "ttest":
+        return raw_signal.scaled
+    # same float64 scaling as Fast5.get_read(raw=True, scale=True)
+    return (raw_signal.raw + raw_signal.offset) * raw_signal.raw_unit
+
+
+def get_cached_events(read_index):
+    """Read only view of the basecalled event table of a cached read"""
+    reads = _SWEEP_CACHE["reads"]
+    return np.ndarray(reads["events_length"][read_index], dtype=reads["events_dtype"][read_index],
+                      buffer=_SWEEP_CACHE["old_events"], offset=reads["events_start"][read_index])
+
+
+def evaluate_params(read_index, params):
+    """Resegment a cached read in memory and compare it to the basecalled sequence
+
+    :param read_index: index of the read in the cache
+    :param params: resegment_reads parameters with a "detector"
+    :return: dict with events, anchored events, bases, accuracy, seconds and error
+    """
+    start = timer()
+    reads = _SWEEP_CACHE["reads"]
+    row = {"events": -1, "anchored_events": -1, "bases": -1, "accuracy": -1.0, "error": ""}
+    try:
+        params = dict(params)
+        detector = params.pop("detector")
+        create_event_table_function, _ = EVENT_DETECTORS[detector]
+        signal = get_cached_signal(read_index, detector)
+        event_table = create_event_table_function(signal, reads["sampling_freq"][read_index],
+                                                  reads["start_time"][read_index], **params)
+        new_event_table, sequence = anchor_resegmented_events(event_table, get_cached_events(read_index),
+                                                              reads["sampling_freq"][read_index],
+                                                              reads["start_time"][read_index],
+                                                              rna=reads["rna"][read_index])
+        row["events"] = len(event_table)
+        row["anchored_events"] = len(new_event_table)
+        row["bases"] = len(sequence)
+        row["accuracy"] = pairwise_alignment_accuracy(reads["sequence"][read_index], sequence, soft_clip=True)
+    except Exception:
+        row["error"] = traceback.format_exc()
+    row["seconds"] = timer() - start
+    return row
+
+
+def _evaluate_params_worker(args):
+    """Pool worker for evaluate_params"""
+    param_index, read_index, params = args
+    return param_index, read_index, evaluate_params(read_index, params)
+
+
+def summarize_sweep(param_grid, rows):
+    """Rank parameter sets by mean accuracy and then by fewest events
+
+    :param param_grid: list of parameter dicts
+    :param rows: list of per read result lists for each parameter set
+    :return: list of summary dicts sorted by rank
+    """
+    summaries = []
+    for params, param_rows in zip(param_grid, rows):
+        good = [row for row in param_rows if not row["error"]]
+        accuracies = np.array([row["accuracy"] for row in good], dtype=float)
+        summary = {"params": params, "reads": len(param_rows), "failed": len(param_rows) - len(good),
+                   "seconds": float(sum(row["seconds"] for row in param_rows))}
+        for name, values in (("accuracy", accuracies),
+                             ("events", [row["events"] for row in good]),
+                             ("anchored_events", [row["anchored_events"] for row in good]),
+                             ("bases", [row["bases"] for row in good])):
+            summary["mean_" + name] = float(np.mean(values)) if len(good) else -1.0
+        summary["median_accuracy"] = float(np.median(accuracies)) if len(good) else -1.0
+        summary["min_accuracy"] = float(np.min(accuracies)) if len(good) else -1.0
+        summaries.append(summary)
+    # failed reads count against a parameter set before accuracy and event counts
+    summaries.sort(key=lambda x: (x["failed"], -x["mean_accuracy"], x["mean_events"]))
+    for rank, summary in enumerate(summaries):
+        summary["rank"] = rank + 1
+    return summaries
+
+
+def run_resegment_sweep(fast5_dir, param_grid, num_workers=1, section="template"):
+    """Evaluate every parameter set on every read with the signals in shared memory
+
+    :param fast5_dir: directory of fast5 files, list of fast5 paths or read catalog
+    :param param_grid: list of parameter dicts with a "detector" or a grid for expand_param_grid
+    :param num_workers: number of worker processes
+    :param section: basecall section of the sequence
+    :return: ranked summaries, per read rows for each parameter set and the reads which could not be loaded
+    """
+    if isinstance(param_grid, dict):
+        param_grid = expand_param_grid(param_grid)
+    assert len(param_grid) > 0, "param_grid is empty"
+    for params in param_grid:
+        assert params.get("detector") in EVENT_DETECTORS, "params need a detector. Options: {}".format(
+            sorted(EVENT_DETECTORS.keys()))
+    if isinstance(fast5_dir, dict):
+        fast5_files = get_catalog_paths(fast5_dir)
+    elif isinstance(fast5_dir, str):
+        assert os.path.isdir(fast5_dir), "fast5_dir must be a directory, list of files or catalog: {}".format(
+            fast5_dir)
+        fast5_files = sorted(list_dir(fast5_dir, ext="fast5"))
+    else:
+        fast5_files = list(fast5_dir)
+
+    start = timer()
+    reads = load_sweep_cache(fast5_files, section=section)
+    signal = reads.pop("signal")
+    old_events = reads.pop("old_events")
+    failed = reads.pop("failed")
+    print("Loaded {} reads in {:.2f} seconds".format(len(reads["path"]), timer() - start), file=sys.stderr)
+    rows = [[None] * len(reads["path"]) for _ in param_grid]
+    # workers read the signal and event tables from shared memory instead of a copy each
+    blocks = []
+    try:
+        shm, shared_signal = _share_array(signal)
+        blocks.append(shm)
+        shm, shared_events = _share_array(old_events)
+        blocks.append(shm)
+        initargs = (shared_signal, shared_events, reads)
+        del signal, old_events
+        jobs = [(param_index, read_index, params) for param_index, params in enumerate(param_grid)
+                for read_index in range(len(reads["path"]))]
+        with Pool(processes=num_workers, initializer=_init_sweep_worker, initargs=initargs) as pool:
+            for param_index, read_index, row in pool.imap_unordered(_evaluate_params_worker, jobs, chunksize=4):
+                row["path"] = reads["path"][read_index]
+                rows[param_index][read_index] = row
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return summarize_sweep(param_grid, rows), rows, failed
+
+
+def save_sweep_table(summaries, output_path):
+    """Write ranked sweep summaries as a tab separated table with json parameters
+
+    :param summaries: list of summary dicts from summarize_sweep
+    :param output_path: path to tsv file
+    """
+    with open(output_path, "w") as fh:
+        fh.write("\t".join(SWEEP_COLUMNS) + "\n")
+        for summary in summaries:
+            values = [json.dumps(summary[name], sort_keys=True) if name == "params" else str(summary[name])
+                      for name in SWEEP_COLUMNS]
+            fh.write("\t".join(values) + "\n")
+    return output_path
+
+
+def main(in_opts=None):
+    """Run a resegmentation parameter sweep from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-d', '--fast5_dir', help='directory of basecalled fast5 files')
+    group.add_argument('-c', '--catalog', help='npz read catalog from read_catalog.py')
+    parser.add_argument('-g', '--grid', required=True,
+                        help='json file of parameter name to list of values, with a "detector" entry')
+    parser.add_argument('-o', '--output', required=True, help='path to tsv table of ranked parameters')
+    parser.add_argument('-j', '--num_workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--apply', action='store_true',
+                        help='resegment the reads with the best parameters after the sweep')
+    args = parser.parse_args(in_opts)
+
+    fast5_dir = load_read_catalog(args.catalog) if args.catalog else args.fast5_dir
+    summaries, _, failed = run_resegment_sweep(fast5_dir, load_json(args.grid), num_workers=args.num_workers)
+    save_sweep_table(summaries, args.output)
+    best = summaries[0]
+    print("Best of {} parameter sets on {} reads ({} not loaded): {} mean accuracy {:.4f}".format(
+        len(summaries), best["reads"], len(failed), best["params"], best["mean_accuracy"]), file=sys.stderr)
+    if args.apply:
+        summary = resegment_directory(fast5_dir, best["params"], num_workers=args.num_workers)
+        print("Resegmented {resegmented}, skipped {skipped} and failed {failed} reads".format(**summary),
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
+    raise SystemExit
@@ -10,6 +10,8 @@
 
 import unittest
 import os
+import shutil
+import tempfile
 import numpy as np
 from nanotensor.alignedsignal import *
 
@@ -108,20 +110,30 @@ class CreateLabelsTest(unittest.TestCase):
         events["model_state"] = ["GATTA", "ATTAC", "TTACA", "TACAG"]
 
         bases, base_raw_starts, base_raw_lengths, probs = index_bases_from_events(events, kmer_index=2)
-        self.assertSequenceEqual(bases, list("GATTACAG"))
-        self.assertSequenceEqual(base_raw_lengths, [1, 1, 1, 1, 1, 1, 1, 1])
-        self.assertSequenceEqual(probs, [1, 1, 1, 1, 1, 1, 1, 1])
-        self.assertSequenceEqual(base_raw_starts, [0, 0, 0, 1, 2, 3, 3, 3])
+        self.assertSequenceEqual(bases.tolist(), list("GATTACAG"))
+        self.assertSequenceEqual(base_raw_lengths.tolist(), [1, 1, 1, 1, 1, 1, 1, 1])
+        self.assertSequenceEqual(probs.tolist(), [1, 1, 1, 1, 1, 1, 1, 1])
+        self.assertSequenceEqual(base_raw_starts.tolist(), [0, 0, 0, 1, 2, 3, 3, 3])
         bases, base_raw_starts, base_raw_lengths, probs = index_bases_from_events(events, kmer_index=3)
-        self.assertSequenceEqual(bases, list("GATTACAG"))
-        self.assertSequenceEqual(base_raw_lengths, [1, 1, 1, 1, 1, 1, 1, 1])
-        self.assertSequenceEqual(probs, [1, 1, 1, 1, 1, 1, 1, 1])
-        self.assertSequenceEqual(base_raw_starts, [0, 0, 0, 0, 1, 2, 3, 3])
+        self.assertSequenceEqual(bases.tolist(), list("GATTACAG"))
+        self.assertSequenceEqual(base_raw_lengths.tolist(), [1, 1, 1, 1, 1, 1, 1, 1])
+        self.assertSequenceEqual(probs.tolist(), [1, 1, 1, 1, 1, 1, 1, 1])
+        self.assertSequenceEqual(base_raw_starts.tolist(), [0, 0, 0, 0, 1, 2, 3, 3])
         bases, base_raw_starts, base_raw_lengths, probs = index_bases_from_events(events, kmer_index=4)
-        self.assertSequenceEqual(bases, list("GATTACAG"))
-        self.assertSequenceEqual(base_raw_lengths, [1, 1, 1, 1, 1, 1, 1, 1])
-        self.assertSequenceEqual(probs, [1, 1, 1, 1, 1, 1, 1, 1])
-        self.assertSequenceEqual(base_raw_starts, [0, 0, 0, 0, 0, 1, 2, 3])
+        self.assertSequenceEqual(bases.tolist(), list("GATTACAG"))
+        self.assertSequenceEqual(base_raw_lengths.tolist(), [1, 1, 1, 1, 1, 1, 1, 1])
+        self.assertSequenceEqual(probs.tolist(), [1, 1, 1, 1, 1, 1, 1, 1])
+        self.assertSequenceEqual(base_raw_starts.tolist(), [0, 0, 0, 0, 0, 1, 2, 3])
+        self.assertIsInstance(base_raw_starts, np.ndarray)
+        # stays add no bases and moves past the end of the kmer can not be indexed
+        events["move"] = [1, 0, 1, 1]
+        events["model_state"] = ["GATTA", "GATTA", "ATTAC", "TTACA"]
+        bases, base_raw_starts, base_raw_lengths, probs = index_bases_from_events(events, kmer_index=2)
+        self.assertSequenceEqual(bases.tolist(), list("GATTACA"))
+        self.assertSequenceEqual(base_raw_starts.tolist(), [0, 0, 0, 2, 3, 3, 3])
+        events["move"] = [1, 0, 2, 1]
+        with self.assertRaises(AssertionError):
+            index_bases_from_events(events, kmer_index=4)
 
 
 class AlignedSignalTest(unittest.TestCase):
@@ -213,6 +225,125 @@ class AlignedSignalTest(unittest.TestCase):
         with self.assertRaises(AssertionError):
             handle.generate_label_mapping(name="test2", scaled=False).__next__()
             handle.generate_label_mapping(name="fake").__next__()
+        # the mapping is made of views of the signal
+        handle.add_raw_signal([1, 2, 3, 4, 5, 6])
+        for i, return_tuple in enumerate(handle.generate_label_mapping(name='test', scaled=False)):
+            self.assertTrue(np.shares_memory(return_tuple[0], handle.raw_signal))
+            self.assertSequenceEqual([i + 1], return_tuple[0].tolist())
+
+    def test_signal_arrays(self):
+        """Test the signal is kept as numpy arrays"""
+        handle = AlignedSignal(scaled_signal=np.array([1.1, 2.2, 1.1, 2.2, 1.1, 2.2]))
+        self.assertEqual(np.dtype(np.float32), handle.scaled_signal.dtype)
+        handle.add_raw_signal(np.array([1, 2, 3, 4, 5, 6]))
+        self.assertEqual(np.dtype(np.int16), handle.raw_signal.dtype)
+        self.assertEqual(6, handle.signal_length)
+
+    def test_label_offsets(self):
+        """Test labels, predictions and guides are views of one array"""
+        label = np.zeros(4, dtype=[('raw_start', int), ('raw_length', int), ('reference_index', int),
+                                   ('posterior_probability', float), ('kmer', 'S5'), ('extra', int)])
+        label["raw_start"] = [0, 1, 2, 3]
+        label["raw_length"] = [1, 1, 1, 1]
+        label["reference_index"] = [0, 1, 2, 3]
+        label["posterior_probability"] = [1, 1, 1, 1]
+        label["kmer"] = ["AAT", "A", "B", "C"]
+        handle = AlignedSignal(scaled_signal=[1.1, 2.2, 1.1, 2.2, 1.1, 2.2])
+        handle.add_label(label, name="test", label_type='label')
+        handle.add_label(label[:2], name="test", label_type='prediction')
+        guide = np.zeros(1, dtype=[('raw_start', int), ('raw_length', int), ('reference_index', int),
+                                   ('posterior_probability', float), ('kmer', 'S6')])
+        guide["kmer"] = "AAAAAT"
+        handle.add_label(guide, name="guide", label_type='guide')
+        self.assertEqual(7, len(handle.labels))
+        self.assertEqual(np.dtype('S6'), handle.labels["kmer"].dtype)
+        self.assertSequenceEqual([("label", "test"), ("prediction", "test"), ("guide", "guide")],
+                                 list(handle.label_offsets.keys()))
+        self.assertEqual((4, 6), handle.label_offsets[("prediction", "test")])
+        for labels in (handle.label, handle.prediction, handle.guide):
+            for name in labels:
+                self.assertTrue(np.shares_memory(labels[name], handle.labels))
+        self.assertSequenceEqual(label["kmer"].tolist(), handle.label["test"]["kmer"].tolist())
+        self.assertSequenceEqual([b"AAAAAT"], handle.guide["guide"]["kmer"].tolist())
+        # replacing a label keeps the others
+        handle.add_label(label[2:], name="test", label_type='label')
+        self.assertEqual(5, len(handle.labels))
+        self.assertSequenceEqual([2, 3], handle.label["test"]["raw_start"].tolist())
+        self.assertSequenceEqual([0, 1], handle.prediction["test"]["raw_start"].tolist())
+        # fields outside LABEL_DTYPE are dropped
+        self.assertNotIn("extra", handle.labels.dtype.names)
+
+    def test_add_labels(self):
+        """Test add_labels stores many labels with one copy of the labels"""
+        label = np.zeros(6, dtype=[('raw_start', int), ('raw_length', int), ('reference_index', int),
+                                   ('posterior_probability', float), ('kmer', 'S5')])
+        label["raw_start"] = np.arange(6)
+        label["raw_length"] = 1
+        label["reference_index"] = np.arange(6)
+        label["posterior_probability"] = 1
+        label["kmer"] = ["A", "C", "G", "T", "AT", "GC"]
+        handle = AlignedSignal(scaled_signal=[1.1, 2.2, 1.1, 2.2, 1.1, 2.2])
+        handle.add_label(label, name="test", label_type='label')
+        blocks = [("guide_alignment{}".format(i), label[i * 2:i * 2 + 2]) for i in range(3)]
+        # count the copies of the labels
+        sets = []
+        set_labels = handle._set_labels
+
+        def count_set_labels(labels, label_offsets):
+            sets.append(len(labels))
+            set_labels(labels, label_offsets)
+        handle._set_labels = count_set_labels
+        handle.add_labels(blocks, label_type='guide')
+        self.assertEqual(1, len(sets))
+        self.assertEqual(12, len(handle.labels))
+        self.assertSequenceEqual([("label", "test")] + [("guide", name) for name, _ in blocks],
+                                 list(handle.label_offsets.keys()))
+        for name, block in blocks:
+            self.assertSequenceEqual(block["kmer"].tolist(), handle.guide[name]["kmer"].tolist())
+            self.assertTrue(np.shares_memory(handle.guide[name], handle.labels))
+        handle.add_labels([], label_type='guide')
+        self.assertEqual(1, len(sets))
+        with self.assertRaises(AssertionError):
+            handle.add_labels(blocks, label_type='fake')
+
+    def test_save_aligned_signal(self):
+        """Test save_aligned_signal and load_aligned_signal with npz and hdf5 files"""
+        label = np.zeros(4, dtype=[('raw_start', int), ('raw_length', int), ('reference_index', int),
+                                   ('posterior_probability', float), ('kmer', 'S5')])
+        label["raw_start"] = [0, 1, 2, 3]
+        label["raw_length"] = [1, 1, 1, 1]
+        label["reference_index"] = [3, 2, 1, 0]
+        label["posterior_probability"] = [1, 0.5, 1, 1]
+        label["kmer"] = ["AAT", "A", "B", "C"]
+        handle = AlignedSignal(scaled_signal=[1.1, 2.2, 1.1, 2.2, 1.1, 2.2])
+        handle.add_raw_signal([1, 2, 3, 4, 5, 6])
+        handle.add_label(label, name="test", label_type='label')
+        handle.add_label(label[1:], name="test", label_type='guide')
+        tempdir = tempfile.mkdtemp()
+        try:
+            for path in (os.path.join(tempdir, "signal.npz"), os.path.join(tempdir, "signal.hdf5")):
+                save_aligned_signal(handle, path)
+                # hdf5 groups are replaced
+                save_aligned_signal(handle, path)
+                loaded = load_aligned_signal(path)
+                self.assertSequenceEqual(handle.scaled_signal.tolist(), loaded.scaled_signal.tolist())
+                self.assertSequenceEqual(handle.raw_signal.tolist(), loaded.raw_signal.tolist())
+                self.assertTrue(np.array_equal(handle.labels, loaded.labels))
+                self.assertEqual(handle.label_offsets, loaded.label_offsets)
+                self.assertTrue(loaded.minus_strand)
+                self.assertSequenceEqual(label["kmer"].tolist(), loaded.label["test"]["kmer"].tolist())
+                self.assertSequenceEqual(label["kmer"][1:].tolist(), loaded.guide["test"]["kmer"].tolist())
+            # an open group of a hdf5 file without raw signal or labels
+            handle = AlignedSignal(scaled_signal=[1.1, 2.2])
+            with h5py.File(os.path.join(tempdir, "signal.hdf5"), 'a') as h5_handle:
+                save_aligned_signal(handle, h5_handle, group_name="empty")
+                loaded = load_aligned_signal(h5_handle, group_name="empty")
+                self.assertIsNone(loaded.raw_signal)
+                self.assertIsNone(loaded.minus_strand)
+                self.assertEqual(0, len(loaded.labels))
+                self.assertIn("AlignedSignal", h5_handle)
+        finally:
+            shutil.rmtree(tempdir)
 
 
 if __name__ == "__main__":
@@ -12,7 +12,10 @@
 ########################################################################
 import unittest
 import os
+import shutil
+import tempfile
 import numpy as np
+import h5py
 import threading
 import time
 from nanotensor.fast5 import Fast5
@@ -395,6 +398,30 @@ class EventDetectTests(unittest.TestCase):
             create_anchor_kmers(new_events=np.array(range(10)), old_events=old)
             create_anchor_kmers(new_events=mean_table, old_events=old)
 
+    def test_create_anchor_kmers_sampling_freq(self):
+        """Test create anchor kmers method with integer sample times"""
+        new = np.zeros(4, dtype=[('start', float), ('length', float), ('mean', float), ('stdv', float),
+                                 ('model_state', 'S5'), ('move', '<i4'), ('p_model_state', float)])
+        old = np.zeros(5, dtype=new.dtype)
+        old["start"] = np.array([10, 20, 30, 40, 50]) / 3012.0
+        old["length"] = 10 / 3012.0
+        old["model_state"] = ["ATATA", "TATAT", "ATATA", "ATATA", "TATAG"]
+        old["move"] = [1, 1, 1, 0, 1]
+        old["p_model_state"] = [0.1, 0.2, 0.3, 0.4, 0.5]
+        new["start"] = np.array([10, 15, 45, 55]) / 3012.0
+        new["length"] = np.array([5, 30, 10, 5]) / 3012.0
+
+        # the second new event has 10 samples of each kmer entry, the last ATATA stay adds to the first ATATA
+        realignment = create_anchor_kmers(new.copy(), old, sampling_freq=3012.0)
+        self.assertSequenceEqual(realignment['model_state'].tolist(), [b"ATATA", b"ATATA", b"ATATA", b"TATAG"])
+        self.assertSequenceEqual(realignment['move'].tolist(), [1, 0, 0, 1])
+        self.assertSequenceEqual(realignment['p_model_state'].tolist(), [0.1, 0.4, 0.4, 0.5])
+        # ticks of seconds break the tie by rounding noise
+        realignment = create_anchor_kmers(new.copy(), old)
+        self.assertSequenceEqual(realignment['model_state'].tolist(), [b"ATATA", b"TATAT", b"ATATA", b"TATAG"])
+        self.assertSequenceEqual(realignment['move'].tolist(), [1, 1, 0, 1])
+        self.assertSequenceEqual(realignment['p_model_state'].tolist(), [0.1, 0.2, 0.4, 0.5])
+
     def test_resegment_reads(self):
         """Test resegment_reads method"""
         minknow_params = dict(window_lengths=(5, 10), thresholds=(2.0, 1.1), peak_height=1.2)
@@ -434,10 +461,12 @@ class EventDetectTests(unittest.TestCase):
         sampling_freq = self.rna_handle.sample_rate
         start_time = self.rna_handle.raw_attributes['start_time']
         event_table = self.rna_handle.get_basecall_data()
-        # run method
-        new_table = index_to_time(event_table, sampling_freq=sampling_freq, start_time=start_time)
         start = event_table["start"] / sampling_freq + (start_time / sampling_freq)
         length = event_table["length"] / float(sampling_freq)
+        # run method, the table is converted in place
+        new_table = index_to_time(event_table, sampling_freq=sampling_freq, start_time=start_time)
+        self.assertTrue(np.shares_memory(event_table, new_table))
+        event_table = self.rna_handle.get_basecall_data()
         # compare elementwise
         self.assertSequenceEqual(new_table["start"].tolist(), start.tolist())
         self.assertSequenceEqual(new_table["length"].tolist(), length.tolist())
@@ -466,9 +495,12 @@ class EventDetectTests(unittest.TestCase):
         length = np.round(event_table["length"] * sampling_freq)
 
         new_table = time_to_index(event_table, sampling_freq=sampling_freq, start_time=start_time)
+        self.assertTrue(np.shares_memory(event_table, new_table))
+        self.assertEqual(np.dtype(np.int64), new_table["start"].dtype)
         # compare elementwise
         self.assertSequenceEqual(new_table["start"][0:100].tolist(), start[0:100].tolist())
         self.assertSequenceEqual(new_table["length"][0:100].tolist(), length[0:100].tolist())
+        event_table = self.dna_handle.get_basecall_data()
 
         with self.assertRaises(AssertionError):
             time_to_index(event_table, start_time=start_time)
@@ -483,6 +515,70 @@ class EventDetectTests(unittest.TestCase):
             time_to_index(event_table, sampling_freq=sampling_freq, start_time=start_time)
 
 
+    def test_event_seconds(self):
+        """test create_event_table derives start and length in seconds from the raw signal indices"""
+        raw_starts = np.array([0, 5, 12])
+        raw_lengths = np.array([5, 7, 3])
+        starts, lengths = event_seconds(raw_starts, raw_lengths, 3012.0, 1000)
+        self.assertTrue(np.allclose((raw_starts + 1000) / 3012.0, starts))
+        self.assertTrue(np.allclose(raw_lengths / 3012.0, lengths))
+        table = create_event_table(raw_starts, raw_lengths, np.ones(3), np.ones(3), 3012.0, 1000)
+        self.assertSequenceEqual(starts.tolist(), table["start"].tolist())
+        self.assertSequenceEqual(lengths.tolist(), table["length"].tolist())
+        self.assertSequenceEqual(raw_starts.tolist(), table["raw_start"].tolist())
+        self.assertSequenceEqual(raw_lengths.tolist(), table["raw_length"].tolist())
+
+    def test_view_field_types(self):
+        """test view_field_types reuses the memory of the table"""
+        table = np.zeros(3, dtype=[('start', np.uint64), ('length', np.uint64), ('model_state', 'S5')])
+        table["start"] = [1, 2, 3]
+        new_table = view_field_types(table, {'start': np.int64})
+        self.assertTrue(np.shares_memory(table, new_table))
+        self.assertEqual(np.dtype(np.int64), new_table["start"].dtype)
+        self.assertEqual(np.dtype(np.uint64), new_table["length"].dtype)
+        self.assertSequenceEqual([1, 2, 3], new_table["start"].tolist())
+        # fields of a sliced table keep their offsets
+        new_table = view_field_types(table[1:], {'length': np.float64})
+        self.assertSequenceEqual([2, 3], new_table["start"].tolist())
+        with self.assertRaises(AssertionError):
+            view_field_types(table, {'start': np.int32})
+        with self.assertRaises(AssertionError):
+            view_field_types(table, {'fake': np.int64})
+        with self.assertRaises(AssertionError):
+            view_field_types(np.zeros(3), {'start': np.int64})
+
+    def test_event_sample_bounds(self):
+        """test event_sample_bounds with events in samples and seconds"""
+        sampling_freq = 3012.0
+        start_time = 1000
+        events = np.zeros(3, dtype=[('start', float), ('length', float), ('raw_start', int), ('raw_length', int)])
+        events["raw_start"] = [0, 7, 15]
+        events["raw_length"] = [7, 8, 4]
+        events["start"] = (events["raw_start"] + start_time) / sampling_freq
+        events["length"] = events["raw_length"] / sampling_freq
+        starts, ends = event_sample_bounds(events, sampling_freq=sampling_freq, start_time=start_time)
+        self.assertEqual(np.dtype(np.int64), starts.dtype)
+        self.assertSequenceEqual([0, 7, 15], starts.tolist())
+        self.assertSequenceEqual([7, 15, 19], ends.tolist())
+        # seconds are rounded to samples without raw fields
+        seconds = events[['start', 'length']]
+        starts, ends = event_sample_bounds(seconds, sampling_freq=sampling_freq, start_time=start_time)
+        self.assertSequenceEqual([0, 7, 15], starts.tolist())
+        self.assertSequenceEqual([7, 15, 19], ends.tolist())
+        # and to ticks without a sampling frequency
+        starts, ends = event_sample_bounds(seconds)
+        self.assertSequenceEqual(np.rint(events["start"] * SECOND_TICKS).tolist(), starts.tolist())
+        with self.assertRaises(AssertionError):
+            event_sample_bounds(seconds, start_time=start_time)
+        samples = np.zeros(3, dtype=[('start', np.uint64), ('length', np.uint64)])
+        samples["start"] = [0, 7, 15]
+        samples["length"] = [7, 8, 4]
+        starts, ends = event_sample_bounds(samples, sampling_freq=sampling_freq, start_time=start_time)
+        self.assertSequenceEqual([0, 7, 15], starts.tolist())
+        self.assertSequenceEqual([7, 15, 19], ends.tolist())
+        with self.assertRaises(AssertionError):
+            event_sample_bounds(samples)
+
     def test_check_event_table_time(self):
         """test check_event_table_time"""
         events = np.empty(3, dtype=[('start', float), ('length', float)])
@@ -507,5 +603,161 @@ class EventDetectTests(unittest.TestCase):
         os.remove("test_dna.fast5")
 
 
+class TtestEventDetectTests(unittest.TestCase):
+    """Test the numpy t-test event detector"""
+
+    @classmethod
+    def setUpClass(cls):
+        super(TtestEventDetectTests, cls).setUpClass()
+        cls.HOME = '/'.join(os.path.abspath(__file__).split("/")[:-1])
+        cls.rna_file = os.path.join(cls.HOME,
+                                    "test_files/minion-reads/rna_reads/DEAMERNANOPORE_20170922_FAH26525_MN16450_sequencing_run_MA_821_R94_NA12878_mRNA_09_22_17_67136_read_36_ch_218_strand.fast5")
+        rng = np.random.RandomState(1)
+        cls.true_starts = np.cumsum(np.r_[0, rng.randint(30, 200, 200)])
+        # alternate low and high levels so every step is at least 20 pA
+        levels = 60 + 40 * (np.arange(len(cls.true_starts)) % 2) + rng.uniform(0, 20, len(cls.true_starts))
+        lengths = np.diff(np.r_[cls.true_starts, cls.true_starts[-1] + 100])
+        cls.signal = np.repeat(levels, lengths) + rng.normal(0, 1.5, lengths.sum())
+
+    def test_compute_tstat(self):
+        """Test compute_tstat matches a t-test on each pair of windows"""
+        signal = self.signal[:500]
+        sums = np.r_[0, np.cumsum(signal)]
+        sumsqs = np.r_[0, np.cumsum(signal ** 2)]
+        tstat = compute_tstat(sums, sumsqs, 10)
+        self.assertEqual(np.float32, tstat.dtype)
+        self.assertTrue(np.all(tstat[:10] == 0))
+        self.assertTrue(np.all(tstat[-9:] == 0))
+        for i in [10, 57, 250, 490]:
+            window1 = signal[i - 10:i]
+            window2 = signal[i:i + 10]
+            expected = abs(window2.mean() - window1.mean()) / np.sqrt((window1.var() + window2.var()) / 10)
+            self.assertAlmostEqual(expected, tstat[i], places=3)
+        self.assertTrue(np.all(compute_tstat(sums[:15], sumsqs[:15], 10) == 0))
+
+    def test_ttest_event_detect(self):
+        """Test ttest_event_detect finds the steps of a synthetic signal"""
+        raw_starts, raw_lengths, means, stdvs = ttest_event_detect(self.signal)
+        self.assertEqual(0, raw_starts[0])
+        self.assertEqual(len(self.signal), raw_starts[-1] + raw_lengths[-1])
+        self.assertTrue(np.all(raw_starts[1:] == raw_starts[:-1] + raw_lengths[:-1]))
+        # every true step has a boundary within a few samples
+        index = np.clip(np.searchsorted(raw_starts, self.true_starts), 1, len(raw_starts) - 1)
+        distance = np.minimum(np.abs(raw_starts[index] - self.true_starts),
+                              np.abs(raw_starts[index - 1] - self.true_starts))
+        self.assertLessEqual(np.max(distance), 3)
+        self.assertLess(len(raw_starts), 1.2 * len(self.true_starts))
+        for i in range(0, len(raw_starts), 17):
+            event_signal = self.signal[raw_starts[i]:raw_starts[i] + raw_lengths[i]].astype(np.float32)
+            self.assertAlmostEqual(np.mean(event_signal, dtype=np.float64), means[i], places=4)
+            self.assertAlmostEqual(np.std(event_signal, dtype=np.float64), stdvs[i], places=3)
+        # float32 signal gives the same boundaries and a flat signal one event
+        starts32 = ttest_event_detect(self.signal.astype(np.float32))[0]
+        self.assertSequenceEqual(raw_starts.tolist(), starts32.tolist())
+        flat_starts, flat_lengths, _, _ = ttest_event_detect(np.full(1000, 100.0))
+        self.assertSequenceEqual([0], flat_starts.tolist())
+        self.assertSequenceEqual([1000], flat_lengths.tolist())
+        with self.assertRaises(AssertionError):
+            ttest_event_detect(self.signal, window_lengths=(16, 40), thresholds=(8.0,))
+
+    def test_create_ttest_event_table(self):
+        """Test create_ttest_event_table gives a table create_anchor_kmers can use"""
+        sampling_freq = 3012.0
+        start_time = 1000
+        events = create_ttest_event_table(self.signal.astype(np.float32), sampling_freq, start_time)
+        self.assertEqual(EVENT_TABLE_DTYPE, events.dtype)
+        self.assertTrue(np.all(events["raw_start"][1:] == events["raw_start"][:-1] + events["raw_length"][:-1]))
+        self.assertTrue(np.allclose(events["start"], (events["raw_start"] + start_time) / sampling_freq))
+        self.assertTrue(np.allclose(events["length"], events["raw_length"] / sampling_freq))
+        with self.assertRaises(AssertionError):
+            create_ttest_event_table(self.signal, sampling_freq, -1)
+        with self.assertRaises(AssertionError):
+            create_ttest_event_table(self.signal.astype(np.int16), sampling_freq, start_time)
+
+    def test_stream_ttest_event_detect(self):
+        """Test stream_ttest_event_detect gives the events of ttest_event_detect for any chunk size"""
+        expected = ttest_event_detect(self.signal)
+        for chunk_size in [50, 333, 4096, len(self.signal) + 1]:
+            chunks = (self.signal[i:i + chunk_size] for i in range(0, len(self.signal), chunk_size))
+            events = list(stream_ttest_event_detect(chunks))
+            if chunk_size < len(self.signal):
+                self.assertGreater(len(events), 1)
+            for expected_column, column in zip(expected, zip(*events)):
+                self.assertTrue(np.allclose(expected_column, np.concatenate(column)))
+        # integer chunks are scaled on the fly
+        raw = np.round(self.signal / 0.5 - 10).astype(np.int16)
+        expected = ttest_event_detect((raw + 10) * np.float32(0.5))
+        events = list(stream_ttest_event_detect((raw[i:i + 1000] for i in range(0, len(raw), 1000)),
+                                                offset=10, raw_unit=0.5))
+        self.assertSequenceEqual(expected[0].tolist(), np.concatenate([x[0] for x in events]).tolist())
+        with self.assertRaises(AssertionError):
+            list(stream_ttest_event_detect([raw]))
+        self.assertEqual(0, len(list(stream_ttest_event_detect([]))))
+
+    def test_create_streaming_event_table(self):
+        """Test create_streaming_event_table reads the raw signal in chunks"""
+        with Fast5(self.rna_file, 'r') as fast5handle:
+            sampling_freq = fast5handle.sample_rate
+            start_time = fast5handle.raw_attributes['start_time']
+            params = dict(window_lengths=(6, 12), thresholds=(2.0, 1.1), peak_height=1.2)
+            expected = create_ttest_event_table(fast5handle.get_raw_signal().scaled, sampling_freq, start_time,
+                                                **params)
+            events = create_streaming_event_table(fast5handle, sampling_freq, start_time, chunk_size=1000, **params)
+            tables = list(stream_ttest_event_table(fast5handle, sampling_freq, start_time, chunk_size=1000,
+                                                   **params))
+        self.assertGreater(len(tables), 1)
+        self.assertEqual(len(expected), sum(len(table) for table in tables))
+        for field in ('start', 'length', 'raw_start', 'raw_length', 'mean', 'stdv'):
+            self.assertTrue(np.allclose(expected[field], events[field]))
+
+    def test_resegment_reads_ttest(self):
+        """Test resegment_reads with the ttest detector selected in params"""
+        tempdir = tempfile.mkdtemp()
+        try:
+            fast5_path = shutil.copy(self.rna_file, tempdir)
+            params = dict(detector="ttest", window_lengths=(6, 12), thresholds=(2.0, 1.1), peak_height=1.2)
+            fast5handle = resegment_reads(fast5_path, params, overwrite=True)
+            self.assertIn("detector", params)
+            attributes = fast5handle[fast5handle.get_analysis_latest("ReSegmentBasecall")].attrs
+            self.assertEqual("ttest_event_detect", attributes["event_detection"])
+            fast5handle.close()
+            fast5handle = resegment_reads(fast5_path, params, overwrite=True, chunk_size=1000)
+            fast5handle.close()
+            with self.assertRaises(AssertionError):
+                resegment_reads(fast5_path, dict(detector="fake"), overwrite=True)
+            with self.assertRaises(AssertionError):
+                resegment_reads(fast5_path, dict(detector="minknow"), overwrite=True, chunk_size=1000)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_resegment_reads_sidecar(self):
+        """Test resegment_reads numbers and overwrites analyses in the side-car file"""
+        tempdir = tempfile.mkdtemp()
+        try:
+            fast5_path = shutil.copy(self.rna_file, tempdir)
+            sidecar_path = os.path.join(tempdir, "sidecar.hdf5")
+            params = dict(detector="ttest", window_lengths=(6, 12), thresholds=(2.0, 1.1), peak_height=1.2)
+            with open(fast5_path, 'rb') as fh:
+                original = fh.read()
+            resegment_reads(fast5_path, params, sidecar_path=sidecar_path).close()
+            resegment_reads(fast5_path, params, sidecar_path=sidecar_path).close()
+            with h5py.File(sidecar_path, 'r') as sidecar:
+                self.assertSequenceEqual(["ReSegmentBasecall_000", "ReSegmentBasecall_001"],
+                                         sorted(sidecar["Analyses"].keys()))
+                for name in sidecar["Analyses"].keys():
+                    self.assertIn("Fastq", sidecar["Analyses"][name]["BaseCalled_template"])
+            params["peak_height"] = 1.0
+            resegment_reads(fast5_path, params, overwrite=True, sidecar_path=sidecar_path).close()
+            with h5py.File(sidecar_path, 'r') as sidecar:
+                self.assertSequenceEqual(["ReSegmentBasecall_000", "ReSegmentBasecall_001"],
+                                         sorted(sidecar["Analyses"].keys()))
+                self.assertEqual(1.2, sidecar["Analyses/ReSegmentBasecall_000"].attrs["peak_height"])
+                self.assertEqual(1.0, sidecar["Analyses/ReSegmentBasecall_001"].attrs["peak_height"])
+            with open(fast5_path, 'rb') as fh:
+                self.assertEqual(original, fh.read())
+        finally:
+            shutil.rmtree(tempdir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+    Place unit tests for event_table_benchmark.py
+"""
+########################################################################
+# File: event_table_benchmark_test.py
+#  executable: event_table_benchmark_test.py
+# Purpose: event_table_benchmark test functions
+#
+# Author: Andrew Bailey
+# History: 05/10/18 Created
+########################################################################
+import os
+import unittest
+from importlib.util import find_spec
+from collections import namedtuple
+import numpy as np
+from py3helpers.utils import list_dir
+from nanotensor.event_table_benchmark import *
+
+
+class EventTableBenchmarkTest(unittest.TestCase):
+    """Test the functions in event_table_benchmark.py"""
+
+    @classmethod
+    def setUpClass(cls):
+        super(EventTableBenchmarkTest, cls).setUpClass()
+        cls.HOME = '/'.join(os.path.abspath(__file__).split("/")[:-1])
+        cls.fast5_files = sorted(list_dir(os.path.join(cls.HOME, "test_files/minion-reads/rna_reads"),
+                                          ext="fast5"))
+
+    def test_event_tables_equal(self):
+        """Test column event tables match the loop implementation"""
+        segment = namedtuple("segment", ["start", "duration", "mean", "std"])
+        rng = np.random.RandomState(1)
+        starts = np.cumsum(rng.randint(5, 80, 1000))
+        speedy_events = [segment(int(start), int(duration), mean, std) for start, duration, mean, std in
+                         zip(starts, rng.randint(5, 80, 1000), rng.uniform(50, 150, 1000), rng.uniform(0, 5, 1000))]
+        minknow_events = np.zeros(1000, dtype=[('start', float), ('length', float), ('mean', float), ('stdv', float)])
+        minknow_events["start"] = starts / 3012.0
+        minknow_events["length"] = rng.randint(5, 80, 1000) / 3012.0
+        minknow_events["mean"] = rng.uniform(50, 150, 1000)
+        minknow_events["stdv"] = rng.uniform(0, 5, 1000)
+        for detector, events in (("speedy", speedy_events), ("minknow", minknow_events)):
+            loop, column = EVENT_TABLE_VARIANTS[detector]
+            self.assertTrue(tables_equal(loop(events, 3012.0, 1000), column(events, 3012.0, 1000)))
+            self.assertEqual(0, len(column(events[:0], 3012.0, 1000)))
+        # minknow times between samples are rounded to the nearest sample
+        minknow_events["start"] += rng.uniform(-0.4, 0.4, 1000) / 3012.0
+        loop_table = loop_minknow_event_table(minknow_events, 3012.0, 1000)
+        column_table = minknow_events_to_table(minknow_events, 3012.0, 1000)
+        self.assertFalse(tables_equal(loop_table, column_table))
+        self.assertTrue(tables_equal(loop_table, column_table, sampling_freq=3012.0))
+        self.assertSequenceEqual(((column_table["start"] - 1000 / 3012.0) * 3012.0).round().tolist(),
+                                 column_table["raw_start"].tolist())
+
+    @unittest.skipUnless(find_spec("PyPore"), "PyPore is not installed")
+    def test_run_event_table_benchmark(self):
+        """Test run_event_table_benchmark on the test reads"""
+        results = run_event_table_benchmark(self.fast5_files[:1], repeats=2, tile=2)
+        self.assertEqual(len(EVENT_TABLE_VARIANTS), len(results))
+        for result in results:
+            self.assertTrue(result["identical"])
+            self.assertEqual(2, len(result["loop_times"]))
+        with self.assertRaises(AssertionError):
+            run_event_table_benchmark(self.fast5_files, detectors=["fake"])
+
+
+    @staticmethod
+    def random_anchor_tables(rng, sampling_freq):
+        """Random old and new event tables in seconds with stays and homopolymers"""
+        kmers = [b"AAAAA", b"ATATA", b"TATAT", b"CCCCC", b"ACGTA"]
+        dtype = [('start', float), ('length', float), ('mean', float), ('stdv', float), ('model_state', 'S5'),
+                 ('move', '<i4'), ('p_model_state', float)]
+        old_lengths = rng.randint(1, 30, 40)
+        old = np.zeros(40, dtype=dtype)
+        old["start"] = (np.cumsum(old_lengths) - old_lengths + rng.randint(0, 50)) / sampling_freq
+        old["length"] = old_lengths / sampling_freq
+        old["model_state"] = [kmers[i] for i in rng.randint(0, len(kmers), 40)]
+        stays = np.flatnonzero(rng.rand(39) < 0.3) + 1
+        old["model_state"][stays] = old["model_state"][stays - 1]
+        old["move"] = rng.randint(0, 4, 40)
+        old["p_model_state"] = rng.rand(40)
+        new_lengths = rng.randint(1, 40, 40)
+        new = np.zeros(40, dtype=dtype)
+        new["start"] = (np.cumsum(new_lengths) - new_lengths + rng.randint(0, 60)) / sampling_freq
+        new["length"] = new_lengths / sampling_freq
+        return new, old
+
+    def test_create_anchor_kmers_equal(self):
+        """Test array create_anchor_kmers matches the loop implementation"""
+        rng = np.random.RandomState(2)
+        # times are exact floats at these sampling frequencies, so the loop has no rounding noise to break ties
+        for sampling_freq in (1.0, 4.0):
+            for _ in range(50):
+                new, old = self.random_anchor_tables(rng, sampling_freq)
+                loop = loop_create_anchor_kmers(new.copy(), old)
+                for kwargs in ({}, {"sampling_freq": sampling_freq}):
+                    array = create_anchor_kmers(new.copy(), old, **kwargs)
+                    self.assertEqual(len(loop), len(array))
+                    for field in ANCHOR_FIELDS:
+                        self.assertSequenceEqual(loop[field].tolist(), array[field].tolist())
+
+    def test_create_anchor_kmers_3012(self):
+        """Test array create_anchor_kmers changes few moves of the loop implementation at 3012 Hz"""
+        rng = np.random.RandomState(3)
+        sampling_freq = 3012.0
+        matched = 0
+        moves_changed = 0
+        for _ in range(50):
+            new, old = self.random_anchor_tables(rng, sampling_freq)
+            loop = loop_create_anchor_kmers(new.copy(), old)
+            for kwargs in ({}, {"sampling_freq": sampling_freq}):
+                array = create_anchor_kmers(new.copy(), old, **kwargs)
+                # float noise in the loop only moves ties and the first and last event
+                self.assertLessEqual(abs(len(loop) - len(array)), 1)
+                _, loop_index, array_index = np.intersect1d(loop["start"], array["start"], return_indices=True)
+                self.assertGreaterEqual(len(loop_index), min(len(loop), len(array)) - 1)
+                matched += len(loop_index)
+                moves_changed += np.sum(loop["move"][loop_index] != array["move"][array_index])
+        self.assertLess(moves_changed, 0.05 * matched)
+
+    def test_run_anchor_kmers_benchmark(self):
+        """Test run_anchor_kmers_benchmark on the test reads"""
+        results = run_anchor_kmers_benchmark(self.fast5_files, repeats=1)
+        self.assertEqual(len(self.fast5_files), len(results))
+        for result in results:
+            for name in ("array", "samples"):
+                self.assertGreater(result[name + "_matched"], 0.99 * result["old_events"])
+                self.assertLess(result[name + "_moves_changed"], 0.01 * result[name + "_matched"])
+            self.assertEqual(1, len(result["loop_times"]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,10 +12,14 @@
 ########################################################################
 import unittest
 import os
+import shutil
+import tempfile
 import numpy as np
 import threading
 import time
-from nanotensor.fast5 import Fast5
+import h5py
+from nanotensor.fast5 import Fast5, Fast5WriteBatch, iterate_fast5, prefetch_fast5, read_fast5_datasets, \
+    _prefetched_bytes
 
 
 class Fast5Test(unittest.TestCase):
@@ -71,5 +75,312 @@ class Fast5Test(unittest.TestCase):
         os.remove("test.fast5")
 
 
+class Fast5MetadataTest(unittest.TestCase):
+    """Test Fast5 metadata caching on a copy of a test read"""
+
+    def setUp(self):
+        home = '/'.join(os.path.abspath(__file__).split("/")[:-1])
+        fast5_file = os.path.join(home, "test_files/minion-reads/methylated/DEAMERNANOPORE_20160805_FNFAD19383_"
+                                        "MN16450_sequencing_run_MA_821_R9_gEcoli_MG1655_08_05_16_89825_"
+                                        "ch100_read5189_strand.fast5")
+        self.tempdir = tempfile.mkdtemp()
+        self.fast5_path = os.path.join(self.tempdir, "test.fast5")
+        shutil.copy(fast5_file, self.fast5_path)
+
+    def test_metadata_cache(self):
+        """Test metadata is read once per handle and refreshed after writes"""
+        with Fast5(self.fast5_path, 'r+') as fast5handle:
+            channel_meta = fast5handle.channel_meta
+            fast5handle.tracking_id
+            fast5handle.raw_attributes
+            fast5handle.event_attributes
+            attr_reads = fast5handle.attr_reads
+            self.assertGreater(attr_reads, 0)
+            for _ in range(10):
+                self.assertEqual(channel_meta, fast5handle.channel_meta)
+                fast5handle.tracking_id
+                fast5handle.raw_attributes
+                fast5handle.event_attributes
+            self.assertEqual(attr_reads, fast5handle.attr_reads)
+            # copies are returned so the cache can not be changed by accident
+            fast5handle.channel_meta['offset'] = 1000
+            self.assertEqual(channel_meta['offset'], fast5handle.channel_meta['offset'])
+            # writing attributes clears the cache
+            fast5handle._add_attrs({'offset': 1000}, fast5handle.__channel_meta_path__)
+            self.assertEqual(1000, fast5handle.channel_meta['offset'])
+            self.assertGreater(fast5handle.attr_reads, attr_reads)
+            raw_read = fast5handle.get_read(group=True, raw=True)
+            fast5handle._add_attrs({'start_time': 1}, raw_read.name)
+            self.assertEqual(1, fast5handle.raw_attributes['start_time'])
+
+    def test_analysis_index(self):
+        """Test analysis lookups list the analysis group once and follow writes and deletes"""
+        with Fast5(self.fast5_path, 'r+') as fast5handle:
+            names = sorted(fast5handle['Analyses'].keys())
+            for _ in range(10):
+                self.assertEqual("/Analyses/" + names[-1], fast5handle.get_analysis_latest(names[-1][:-4]))
+                self.assertEqual("/Analyses/SignalAlign_000",
+                                 fast5handle.check_path(fast5handle.__default_signalalign_events__))
+                self.assertEqual("/Analyses/SignalAlign_000",
+                                 fast5handle.check_path(fast5handle.__default_signalalign_events__, latest=True))
+            self.assertEqual(1, fast5handle.analysis_index_builds)
+            with self.assertRaises(IndexError):
+                fast5handle.get_analysis_latest("SignalAlign")
+            # paths outside of the analysis group are checked in the file
+            self.assertEqual("/UniqueGlobalKey/fake_000", fast5handle.check_path("/UniqueGlobalKey/fake_00{}"))
+
+            fast5handle.create_group("/Analyses/SignalAlign_000")
+            self.assertEqual("/Analyses/SignalAlign_000", fast5handle.get_analysis_latest("SignalAlign"))
+            self.assertEqual("/Analyses/SignalAlign_001",
+                             fast5handle.check_path(fast5handle.__default_signalalign_events__))
+            self.assertEqual("/Analyses/SignalAlign_000",
+                             fast5handle.check_path(fast5handle.__default_signalalign_events__, latest=True))
+            self.assertEqual("/Analyses/SignalAlign_001", fast5handle.get_analysis_new("SignalAlign"))
+            fast5handle["/Analyses/SignalAlign_001/full"] = np.zeros(3)
+            self.assertEqual("/Analyses/SignalAlign_001", fast5handle.get_analysis_latest("SignalAlign"))
+            fast5handle.delete("/Analyses/SignalAlign_001")
+            self.assertEqual("/Analyses/SignalAlign_000", fast5handle.get_analysis_latest("SignalAlign"))
+            fast5handle.strip_analyses()
+            with self.assertRaises(IndexError):
+                fast5handle.get_analysis_latest("SignalAlign")
+            self.assertEqual(5, fast5handle.analysis_index_builds)
+
+    def test_analysis_index_subgroup_writes(self):
+        """Test analysis lookups follow groups written and deleted through a subgroup handle"""
+        with Fast5(self.fast5_path, 'r+') as fast5handle:
+            with self.assertRaises(IndexError):
+                fast5handle.get_analysis_latest("SignalAlign")
+            self.assertEqual("/Analyses/SignalAlign_000",
+                             fast5handle.check_path(fast5handle.__default_signalalign_events__))
+            analyses = fast5handle['Analyses']
+            analyses.create_group("SignalAlign_000")
+            self.assertEqual("/Analyses/SignalAlign_000", fast5handle.get_analysis_latest("SignalAlign"))
+            self.assertEqual("/Analyses/SignalAlign_001",
+                             fast5handle.check_path(fast5handle.__default_signalalign_events__))
+            del analyses["SignalAlign_000"]
+            with self.assertRaises(IndexError):
+                fast5handle.get_analysis_latest("SignalAlign")
+            self.assertEqual(3, fast5handle.analysis_index_builds)
+
+    def test_write_batch(self):
+        """Test write_batch queues writes, sees them in lookups and writes them in one flush"""
+        events = np.zeros(100, dtype=[('start', float), ('length', float), ('mean', float), ('stdv', float)])
+        events['mean'] = np.arange(100)
+        fastq = "@read\nACGT\n+\n!!!!"
+        with Fast5(self.fast5_path, 'r+') as fast5handle:
+            with fast5handle.write_batch(compression='lzf', chunks=(10,)) as batch:
+                fast5handle.set_new_event_table("ReSegmentBasecall_00{}", events, {"test": 1})
+                fast5handle.set_fastq("ReSegmentBasecall_00{}", fastq)
+                self.assertEqual(3, len(batch))
+                # nothing is written before the flush but lookups see the queued writes
+                self.assertNotIn("/Analyses/ReSegmentBasecall_000", set(fast5handle['Analyses'].keys()))
+                self.assertIn("/Analyses/ReSegmentBasecall_000/BaseCalled_template", fast5handle)
+                self.assertEqual("/Analyses/ReSegmentBasecall_000", fast5handle.get_analysis_latest("ReSegment"))
+            self.assertSequenceEqual(events.tolist(), fast5handle.get_resegment_basecall().tolist())
+            self.assertEqual(fastq, fast5handle["/Analyses/ReSegmentBasecall_000/BaseCalled_template/Fastq"][()]
+                             .decode())
+            self.assertEqual(1, fast5handle["/Analyses/ReSegmentBasecall_000"].attrs["test"])
+            table = fast5handle["/Analyses/ReSegmentBasecall_000/BaseCalled_template/Events"]
+            self.assertEqual("lzf", table.compression)
+            self.assertEqual((10,), table.chunks)
+
+            # overwrite deletes and writes in the same flush
+            with fast5handle.write_batch(compression='none'):
+                fast5handle.set_new_event_table("ReSegmentBasecall_00{}", events[:10], {}, overwrite=True)
+                self.assertNotIn("/Analyses/ReSegmentBasecall_000/BaseCalled_template/Fastq", fast5handle)
+            self.assertEqual(10, len(fast5handle.get_resegment_basecall()))
+            self.assertNotIn("/Analyses/ReSegmentBasecall_000/BaseCalled_template/Fastq", fast5handle)
+            self.assertIsNone(fast5handle["/Analyses/ReSegmentBasecall_000/BaseCalled_template/Events"].compression)
+
+            # a failed flush leaves the file as it was
+            with self.assertRaises(ValueError):
+                with fast5handle.write_batch() as batch:
+                    fast5handle.delete("/Analyses/ReSegmentBasecall_000")
+                    fast5handle._add_numpy_table(events, "/Analyses/New_000/Events")
+                    fast5handle._add_attrs({"offset": 1000}, fast5handle.__channel_meta_path__)
+                    # writing the same dataset twice fails in the flush
+                    batch.add_string("/Analyses/New_000/Events", "exists")
+            self.assertEqual(10, len(fast5handle.get_resegment_basecall()))
+            self.assertNotIn("/Analyses/New_000", fast5handle)
+            self.assertNotEqual(1000, fast5handle.channel_meta["offset"])
+            self.assertNotIn(Fast5WriteBatch.__trash_path__, fast5handle)
+            with self.assertRaises(AssertionError):
+                fast5handle.write_batch(compression='fake')
+
+    def test_write_batch_sidecar(self):
+        """Test write_batch writes into a side-car file and leaves the fast5 file untouched"""
+        sidecar_path = os.path.join(self.tempdir, "sidecar.hdf5")
+        events = np.zeros(10, dtype=[('start', float), ('length', float), ('mean', float), ('stdv', float)])
+        with open(self.fast5_path, 'rb') as fh:
+            original = fh.read()
+        with Fast5(self.fast5_path, 'r') as fast5handle:
+            self.assertFalse(fast5handle.writable)
+            with fast5handle.write_batch(sidecar_path=sidecar_path):
+                fast5handle.set_new_event_table("ReSegmentBasecall_00{}", events, {"test": 1})
+            self.assertNotIn("/Analyses/ReSegmentBasecall_000", fast5handle)
+        with open(self.fast5_path, 'rb') as fh:
+            self.assertEqual(original, fh.read())
+        with h5py.File(sidecar_path, 'r') as sidecar:
+            self.assertSequenceEqual(events.tolist(),
+                                     sidecar["/Analyses/ReSegmentBasecall_000/BaseCalled_template/Events"][()].tolist())
+            self.assertEqual(1, sidecar["/Analyses/ReSegmentBasecall_000"].attrs["test"])
+
+    def test_get_raw_signal(self):
+        """Test get_raw_signal reads raw signal once and scales it like get_read"""
+        with Fast5(self.fast5_path, 'r') as fast5handle:
+            raw_read = fast5handle.get_read(group=True, raw=True)
+            file_signal = raw_read['Signal'][()]
+            meta = fast5handle.channel_meta
+            expected = (file_signal + meta['offset']) * (meta['range'] / meta['digitisation'])
+            signal = fast5handle.get_raw_signal()
+            self.assertEqual(file_signal.dtype, signal.raw.dtype)
+            self.assertSequenceEqual(file_signal.tolist(), signal.raw.tolist())
+            self.assertEqual(np.float32, signal.scaled.dtype)
+            self.assertTrue(np.allclose(expected, signal.scaled, rtol=1e-5))
+            # scaled signal is computed once
+            self.assertIs(signal.scaled, signal.scaled)
+            # get_read keeps returning float and int arrays
+            self.assertTrue(np.allclose(expected, fast5handle.get_read(raw=True, scale=True)))
+            self.assertSequenceEqual(file_signal.tolist(), fast5handle.get_read(raw=True, scale=False).tolist())
+            # indices and buffers
+            buffer = np.empty(100, dtype=file_signal.dtype)
+            window = fast5handle.get_raw_signal(indices=(10, 60), buffer=buffer)
+            self.assertEqual(10, window.start)
+            self.assertSequenceEqual(file_signal[10:60].tolist(), window.raw.tolist())
+            self.assertTrue(np.shares_memory(buffer, window.raw))
+            # out of range indices are clipped like slicing
+            window = fast5handle.get_raw_signal(indices=(10, len(file_signal) + 1))
+            self.assertSequenceEqual(file_signal[10:].tolist(), window.raw.tolist())
+            window = fast5handle.get_raw_signal(indices=(-10, None))
+            self.assertEqual(len(file_signal) - 10, window.start)
+            self.assertSequenceEqual(file_signal[-10:].tolist(), window.raw.tolist())
+            self.assertEqual(0, len(fast5handle.get_raw_signal(indices=(len(file_signal) + 5, 10)).raw))
+
+    def test_iterate_raw_signal(self):
+        """Test iterate_raw_signal covers the whole signal in windows"""
+        with Fast5(self.fast5_path, 'r') as fast5handle:
+            signal = fast5handle.get_raw_signal()
+            window_size = 1000
+            raw_windows = []
+            scaled_windows = []
+            starts = []
+            for window in fast5handle.iterate_raw_signal(window_size):
+                self.assertLessEqual(len(window), window_size)
+                starts.append(window.start)
+                raw_windows.append(window.raw.copy())
+                scaled_windows.append(window.scaled)
+            self.assertSequenceEqual(list(range(0, len(signal), window_size)), starts)
+            self.assertSequenceEqual(signal.raw.tolist(), np.concatenate(raw_windows).tolist())
+            self.assertSequenceEqual(signal.scaled.tolist(), np.concatenate(scaled_windows).tolist())
+            with self.assertRaises(AssertionError):
+                next(fast5handle.iterate_raw_signal(0))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+class PrefetchFast5Test(unittest.TestCase):
+    """Test prefetch_fast5"""
+
+    def setUp(self):
+        home = '/'.join(os.path.abspath(__file__).split("/")[:-1])
+        self.fast5_dir = os.path.join(home, "test_files/minion-reads/methylated")
+        self.fast5_files = list(iterate_fast5(self.fast5_dir, paths=True))
+
+    def test_prefetch_fast5(self):
+        """Test prefetch_fast5 reads the same data as opening each file"""
+        reads = list(prefetch_fast5(self.fast5_dir, datasets=("raw", "scaled", "signalalign_events"),
+                                    num_workers=2, readahead=2))
+        self.assertSequenceEqual(self.fast5_files, [data["path"] for data in reads])
+        for data in reads:
+            with Fast5(data["path"], 'r') as fast5handle:
+                signal = fast5handle.get_raw_signal()
+                self.assertSequenceEqual(signal.raw.tolist(), data["raw"].tolist())
+                self.assertSequenceEqual(signal.scaled.tolist(), data["scaled"].tolist())
+            # missing datasets are reported instead of raised
+            self.assertIsNone(data["signalalign_events"])
+            self.assertSequenceEqual(["signalalign_events"], list(data["errors"].keys()))
+
+    def test_read_fast5_datasets(self):
+        """Test raw and scaled signal are derived from one read of the raw signal"""
+        for data in read_fast5_datasets(self.fast5_files[0], datasets=("raw", "scaled", "raw_signal")):
+            self.assertEqual(0, len(data["errors"]))
+            self.assertIs(data["raw_signal"].raw, data["raw"])
+            self.assertIs(data["raw_signal"].scaled, data["scaled"])
+            self.assertEqual(data["raw"].nbytes + data["scaled"].nbytes, _prefetched_bytes([data]))
+
+    def test_prefetch_fast5_options(self):
+        """Test unordered, memory capped and process pool prefetching"""
+        for kwargs in ({"ordered": False}, {"max_bytes": 1, "readahead": 3}, {"processes": True}):
+            reads = list(prefetch_fast5(self.fast5_dir, num_workers=2, **kwargs))
+            self.assertSequenceEqual(sorted(self.fast5_files), sorted(data["path"] for data in reads))
+            self.assertTrue(all(data["raw"] is not None for data in reads))
+        self.assertEqual(2, len(list(prefetch_fast5(self.fast5_dir, limit=2))))
+        with self.assertRaises(AssertionError):
+            next(prefetch_fast5(self.fast5_dir, datasets=("fake",)))
+        with self.assertRaises(AssertionError):
+            next(prefetch_fast5(self.fast5_dir, readahead=0))
+
+
+class Fast5MultiReadTest(unittest.TestCase):
+    """Test Fast5 on a multi-read file made from the rna test reads"""
+
+    def setUp(self):
+        home = '/'.join(os.path.abspath(__file__).split("/")[:-1])
+        rna_dir = os.path.join(home, "test_files/minion-reads/rna_reads")
+        self.read_files = sorted(os.path.join(rna_dir, name) for name in os.listdir(rna_dir))
+        self.tempdir = tempfile.mkdtemp()
+        self.fast5_path = os.path.join(self.tempdir, "multi.fast5")
+        self.read_ids = []
+        with h5py.File(self.fast5_path, 'w') as multi_read:
+            for path in self.read_files:
+                with h5py.File(path, 'r') as single_read:
+                    raw_read = single_read['Raw/Reads'][list(single_read['Raw/Reads'].keys())[0]]
+                    read_id = raw_read.attrs['read_id'].decode()
+                    group = multi_read.create_group("read_" + read_id)
+                    single_read.copy(raw_read, group, name="Raw")
+                    single_read.copy(single_read['Analyses'], group, name="Analyses")
+                    for name in ("channel_id", "context_tags", "tracking_id"):
+                        single_read.copy(single_read['UniqueGlobalKey/' + name], group, name=name)
+                self.read_ids.append(read_id)
+
+    def test_read_index(self):
+        """Test read ids are indexed and getters work on the selected read"""
+        with Fast5(self.fast5_path, 'r') as fast5handle:
+            self.assertTrue(fast5handle.is_multi_read)
+            self.assertSequenceEqual(self.read_ids, fast5handle.get_read_ids())
+            self.assertEqual(self.read_ids[0], fast5handle.read_id)
+            for read_id, path in reversed(list(zip(self.read_ids, self.read_files))):
+                fast5handle.select_read(read_id)
+                with Fast5(path, 'r') as single_read:
+                    self.assertFalse(single_read.is_multi_read)
+                    self.assertSequenceEqual([read_id], single_read.get_read_ids())
+                    self.assertEqual(single_read.channel_meta, fast5handle.channel_meta)
+                    self.assertEqual(single_read.raw_attributes, fast5handle.raw_attributes)
+                    self.assertEqual(single_read.channel_number, fast5handle.channel_number)
+                    self.assertSequenceEqual(single_read.get_raw_signal().raw.tolist(),
+                                             fast5handle.get_raw_signal().raw.tolist())
+                    self.assertSequenceEqual(single_read.get_resegment_basecall().tolist(),
+                                             fast5handle.get_resegment_basecall().tolist())
+                    self.assertEqual(single_read.is_read_rna(), fast5handle.is_read_rna())
+            with self.assertRaises(KeyError):
+                fast5handle.select_read("fake")
+        with Fast5(self.fast5_path, 'r', read_id=self.read_ids[1]) as fast5handle:
+            self.assertEqual(self.read_ids[1], fast5handle.read_id)
+            self.assertEqual(self.read_ids[1], fast5handle.raw_attributes['read_id'].decode())
+
+    def test_iterate_fast5_reads(self):
+        """Test iterate_fast5 yields every read of a multi-read file"""
+        read_ids = [fast5handle.read_id for fast5handle in iterate_fast5(self.fast5_path, reads=True)]
+        self.assertSequenceEqual(self.read_ids, read_ids)
+        paths = list(iterate_fast5(self.tempdir, paths=True, reads=True))
+        self.assertSequenceEqual([(self.fast5_path, read_id) for read_id in self.read_ids], paths)
+        paths = list(iterate_fast5(self.read_files[0], paths=True, reads=True))
+        self.assertEqual(1, len(paths))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,12 +10,26 @@
 
 
 import sys
+import os
+import shutil
+import tempfile
+import h5py
 import numpy as np
 import unittest
 from collections import defaultdict
 from scipy import sparse
 from nanotensor.mea_algorithm import *
 from py3helpers.utils import time_it
+from py3helpers.seq_tools import ReverseComplement
+
+
+def nested_path_indexes(best_path):
+    """Reference and event index of each edge of a nested maximum_expected_accuracy_alignment path"""
+    path = []
+    while best_path is not None:
+        path.append([best_path[0], best_path[1]])
+        best_path = best_path[4]
+    return path[::-1]
 
 
 class Mea(unittest.TestCase):
@@ -120,14 +134,197 @@ class Mea(unittest.TestCase):
             sum_prob += prob
             self.assertAlmostEqual(sum_prob, total_prob)
 
-    def test_get_indexes_from_best_path(self):
-        """test get_get_indexes_from_best_path"""
-        fake_mea = [4, 4, 1, 0.1, [3, 3, 0.9, 0.1, [2, 2, 0.8, 0.1, [1, 1, 0.7, 0.1, [0, 0, 0.6, 0.6, None]]]]]
-        alignment = get_indexes_from_best_path(fake_mea)
-        self.assertEqual(alignment, [[0, 0], [1, 1], [2, 2], [3, 3], [4, 4]])
-        fake_mea = [0.1, [3, 3, 0.9, 0.1, [2, 2, 0.8, 0.1, [1, 1, 0.7, 0.1, [0, 0, 0.6, 0.6, None]]]]]
-        with self.assertRaises(IndexError):
-            get_indexes_from_best_path(fake_mea)
+    def test_mea_edge_arrays(self):
+        """Test mea_edge_arrays and mea_vectorized against the other implementations"""
+        max_size = 40
+        for j in range(20):
+            row, col = np.random.randint(int(max_size/2), max_size, 2)
+            posterior_matrix, shortest_ref_per_event = create_random_prob_matrix(row=row, col=col, gaps=bool(j % 2))
+            all_edges = maximum_expected_accuracy_alignment(posterior_matrix, shortest_ref_per_event, return_all=True)
+            most_probable_edge = mea_slow(posterior_matrix, shortest_ref_per_event)
+            another_probable_edge = mea_slower(posterior_matrix, shortest_ref_per_event)
+            # force every event through the scalar and the numpy batch code
+            for batch_width in (0, 8, max_size + 1):
+                vectorized_edges = mea_vectorized(posterior_matrix, shortest_ref_per_event, return_all=True,
+                                                  batch_width=batch_width)
+                self.assertEqual(len(all_edges), len(vectorized_edges))
+                for edge, vectorized_edge in zip(all_edges, vectorized_edges):
+                    while edge is not None:
+                        self.assertSequenceEqual(edge[:2], vectorized_edge[:2])
+                        self.assertAlmostEqual(edge[3], vectorized_edge[3])
+                        edge = edge[4]
+                        vectorized_edge = vectorized_edge[4]
+                    self.assertIsNone(vectorized_edge)
+                best_edge = mea_vectorized(posterior_matrix, shortest_ref_per_event, batch_width=batch_width)
+                self.assertAlmostEqual(most_probable_edge[3], best_edge[3])
+                self.assertAlmostEqual(another_probable_edge[3], best_edge[3])
+
+        edges, forward_edges = mea_edge_arrays(sparse.coo_matrix(np.zeros([3, 3])), [0, 0, 0])
+        self.assertEqual(0, len(edges))
+        self.assertEqual(0, len(forward_edges))
+        # edges point back to the edge they came from
+        posterior_matrix = np.asanyarray([[0.2, 0.3, 0.2, 0.2, 0.1],
+                                          [0.2, 0.5, 0.3, 0.0, 0.0],
+                                          [0.3, 0.1, 0.0, 0.3, 0.3],
+                                          [0.0, 0.0, 0.0, 0.4, 0.1],
+                                          [0.0, 0.0, 0.0, 0.2, 0.5]])
+        edges, forward_edges = mea_edge_arrays(posterior_matrix, [0, 0, 0, 3, 3])
+        best_edge = forward_edges[np.argmax(edges["sum_prob"][forward_edges])]
+        self.assertAlmostEqual(1.6, edges["sum_prob"][best_edge])
+        path = []
+        while best_edge != -1:
+            path.append([edges["ref_index"][best_edge], edges["event_index"][best_edge]])
+            best_edge = edges["prev_edge"][best_edge]
+        self.assertEqual([[0, 0], [1, 1], [1, 2], [3, 3], [4, 4]], path[::-1])
+
+    def test_get_edge_path(self):
+        """Test get_edge_path"""
+        for _ in range(10):
+            posterior_matrix, shortest_ref_per_event = create_random_prob_matrix(row=20, col=20)
+            most_probable_edge = maximum_expected_accuracy_alignment(posterior_matrix, shortest_ref_per_event)
+            edges, forward_edges = mea_edge_arrays(posterior_matrix, shortest_ref_per_event)
+            best_edge = forward_edges[np.argmax(edges["sum_prob"][forward_edges])]
+            path = get_edge_path(edges, best_edge)
+            self.assertSequenceEqual(nested_path_indexes(most_probable_edge),
+                                     [list(pair) for pair in edges[["ref_index", "event_index"]][path].tolist()])
+            # cell index points back into the coo data of the posterior matrix
+            coo_matrix = sparse.coo_matrix(posterior_matrix)
+            self.assertSequenceEqual(coo_matrix.row[edges["cell_index"][path]].tolist(),
+                                     edges["event_index"][path].tolist())
+            self.assertSequenceEqual(coo_matrix.col[edges["cell_index"][path]].tolist(),
+                                     edges["ref_index"][path].tolist())
+
+    def test_mea_alignment_from_signal_align(self):
+        """Test mea_alignment_from_signal_align"""
+        for _ in range(10):
+            posterior_matrix, shortest_ref_per_event = create_random_prob_matrix(row=20, col=20, gaps=False)
+            events, event_matrix = generate_events_from_probability_matrix(posterior_matrix)
+            # shuffle the events table to make sure event rows are tracked
+            events = events[np.random.permutation(len(events))]
+            most_probable_edge = maximum_expected_accuracy_alignment(posterior_matrix, shortest_ref_per_event)
+            true_events = get_events_from_path(event_matrix, nested_path_indexes(most_probable_edge))
+            mea_events = mea_alignment_from_signal_align(None, events=events)
+            self.assertSequenceEqual(true_events.tolist(), mea_events.tolist())
+
+    def test_band_posterior_matrix(self):
+        """Test band_posterior_matrix"""
+        posterior_matrix, shortest_ref_per_event = create_random_prob_matrix(row=20, col=30, gaps=False)
+        band_centers = get_diagonal_band_centers(20, 30)
+        self.assertEqual(0, band_centers[0])
+        self.assertEqual(29, band_centers[-1])
+        banded_matrix, banded_shortest_ref, in_band = band_posterior_matrix(posterior_matrix, band_centers, 3)
+        self.assertTrue(np.all(np.abs(banded_matrix.col - band_centers[banded_matrix.row]) <= 3))
+        self.assertEqual(np.count_nonzero(in_band), banded_matrix.nnz)
+        # a band covering the whole matrix keeps every cell
+        banded_matrix, banded_shortest_ref, in_band = band_posterior_matrix(posterior_matrix, band_centers, 30)
+        self.assertTrue(np.all(in_band))
+        self.assertSequenceEqual(banded_matrix.toarray().tolist(), posterior_matrix.tolist())
+        self.assertSequenceEqual(banded_shortest_ref.tolist(), shortest_ref_per_event.tolist())
+        with self.assertRaises(AssertionError):
+            band_posterior_matrix(posterior_matrix, band_centers[1:], 3)
+
+    def test_banded_mea_alignment_from_signal_align(self):
+        """Test banded_mea_alignment_from_signal_align"""
+        for _ in range(10):
+            posterior_matrix, shortest_ref_per_event = create_random_prob_matrix(row=20, col=20, gaps=False)
+            events, event_matrix = generate_events_from_probability_matrix(posterior_matrix)
+            mea_events = mea_alignment_from_signal_align(None, events=events)
+            banded_events, band_edge_touches = banded_mea_alignment_from_signal_align(None, events=events,
+                                                                                      band_width=20,
+                                                                                      guide_alignment=False)
+            self.assertSequenceEqual(mea_events.tolist(), banded_events.tolist())
+            self.assertEqual(0, band_edge_touches)
+            # guide alignment covering the reference
+            ref_start = events["reference_index"].min()
+            sam_string = "read\t0\tref\t{}\t60\t20M\t*\t0\t0\t{}\t*".format(ref_start + 1, "A" * 20)
+            self.assertSequenceEqual(get_guide_band_centers(sam_string, events).tolist(), list(range(20)))
+            banded_events, band_edge_touches = banded_mea_alignment_from_signal_align(None, events=events,
+                                                                                      band_width=1,
+                                                                                      sam_string=sam_string)
+            self.assertTrue(np.all(np.abs(banded_events["reference_index"] - ref_start -
+                                          banded_events["event_index"] + events["event_index"].min()) <= 1))
+            self.assertEqual(band_edge_touches,
+                             np.count_nonzero(np.abs(banded_events["reference_index"] - ref_start -
+                                                     banded_events["event_index"] +
+                                                     events["event_index"].min()) == 1))
+
+    def test_batch_mea_alignment(self):
+        """Test batch_mea_alignment"""
+        home = '/'.join(os.path.abspath(__file__).split("/")[:-1])
+        fast5_file = os.path.join(home, "test_files/minion-reads/methylated/DEAMERNANOPORE_20160805_FNFAD19383_"
+                                        "MN16450_sequencing_run_MA_821_R9_gEcoli_MG1655_08_05_16_89825_"
+                                        "ch100_read5189_strand.fast5")
+        tempdir = tempfile.mkdtemp()
+        try:
+            true_events = []
+            for i in range(3):
+                new_file = os.path.join(tempdir, "read{}.fast5".format(i))
+                shutil.copy(fast5_file, new_file)
+                posterior_matrix, _ = create_random_prob_matrix(row=20, col=20, gaps=False)
+                events, _ = generate_events_from_probability_matrix(posterior_matrix)
+                with h5py.File(new_file, 'r+') as fh:
+                    fh.create_dataset("Analyses/SignalAlign_000/full", data=events)
+                true_events.append(mea_alignment_from_signal_align(None, events=events))
+            # no signalAlign data
+            shutil.copy(fast5_file, os.path.join(tempdir, "read3.fast5"))
+
+            summary = batch_mea_alignment(tempdir, num_workers=2, max_in_flight=1)
+            self.assertEqual(3, summary["success"])
+            self.assertEqual(1, summary["failed"])
+            self.assertIn(os.path.join(tempdir, "read3.fast5"), summary["failures"])
+            self.assertEqual(4, len(summary["read_seconds"]))
+            for i in range(3):
+                with Fast5(os.path.join(tempdir, "read{}.fast5".format(i)), 'r') as fileh:
+                    self.assertSequenceEqual(true_events[i].tolist(),
+                                             fileh.get_signalalign_events(mea=True).tolist())
+            # tables are not overwritten by default
+            summary = batch_mea_alignment(tempdir, num_workers=2)
+            self.assertEqual(4, summary["failed"])
+
+            output_path = os.path.join(tempdir, "mea.hdf5")
+            summary = batch_mea_alignment([os.path.join(tempdir, "read{}.fast5".format(i)) for i in range(3)],
+                                          num_workers=2, output_path=output_path, band_width=20,
+                                          guide_alignment=False)
+            self.assertEqual(3, summary["success"])
+            with h5py.File(output_path, 'r') as fh:
+                for i in range(3):
+                    self.assertSequenceEqual(true_events[i].tolist(), fh["read{}".format(i)][()].tolist())
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_mea_cache(self):
+        """Test MeaCache and cached_mea_alignment_from_signal_align"""
+        tempdir = tempfile.mkdtemp()
+        try:
+            all_events = []
+            for _ in range(3):
+                posterior_matrix, _ = create_random_prob_matrix(row=20, col=20, gaps=False)
+                events, _ = generate_events_from_probability_matrix(posterior_matrix)
+                all_events.append(events)
+            cache = MeaCache(tempdir)
+            mea_events = cached_mea_alignment_from_signal_align(None, cache, events=all_events[0])
+            self.assertEqual(1, cache.misses)
+            cached_events = cached_mea_alignment_from_signal_align(None, cache, events=all_events[0])
+            self.assertEqual(1, cache.hits)
+            self.assertSequenceEqual(mea_events.tolist(), cached_events.tolist())
+            self.assertEqual(mea_events.dtype, cached_events.dtype)
+            self.assertNotEqual(cache.key(all_events[0]), cache.key(all_events[1]))
+            # cache is reloaded from disk
+            cache = MeaCache(tempdir, max_bytes=int(cache.size * 2.5))
+            self.assertEqual(1, len(cache.entries))
+            cached_mea_alignment_from_signal_align(None, cache, events=all_events[0])
+            self.assertEqual(1, cache.hits)
+            # least recently used alignment is evicted
+            cached_mea_alignment_from_signal_align(None, cache, events=all_events[1])
+            cached_mea_alignment_from_signal_align(None, cache, events=all_events[0])
+            cached_mea_alignment_from_signal_align(None, cache, events=all_events[2])
+            self.assertEqual(1, cache.evictions)
+            self.assertLessEqual(cache.size, cache.max_bytes)
+            self.assertIn(cache.key(all_events[0]), cache.entries)
+            self.assertNotIn(cache.key(all_events[1]), cache.entries)
+            self.assertEqual(2, len(os.listdir(tempdir)))
+        finally:
+            shutil.rmtree(tempdir)
 
     def test_get_events_from_path(self):
         """Test get_events_from_path"""
@@ -173,6 +370,16 @@ class Mea(unittest.TestCase):
             self.assertSequenceEqual(posterior_matrix.tolist(), true_posterior_matrix.tolist())
             self.assertSequenceEqual(shortest_ref, true_shortest_ref_per_event.tolist())
             self.assertSequenceEqual(event_matrix, true_event_matrix)
+            # sparse output keeps row indexes into events instead of copies
+            sparse_matrix, sparse_shortest_ref, event_rows = get_mea_params_from_events(events, sparse_output=True)
+            self.assertSequenceEqual(sparse_matrix.toarray().tolist(), true_posterior_matrix.tolist())
+            self.assertSequenceEqual(sparse_shortest_ref.tolist(), true_shortest_ref_per_event.tolist())
+            for event_row, event_indx, ref_indx in zip(event_rows, sparse_matrix.row, sparse_matrix.col):
+                self.assertEqual(events[event_row], event_matrix[event_indx][ref_indx])
+            dense_edge = maximum_expected_accuracy_alignment(posterior_matrix, shortest_ref)
+            sparse_edge = maximum_expected_accuracy_alignment(sparse_matrix, sparse_shortest_ref,
+                                                              sparse_posterior_matrix=True)
+            self.assertAlmostEqual(dense_edge[3], sparse_edge[3])
         with self.assertRaises(KeyError):
             events = np.zeros(4, dtype=[('reference_index', '<i8'), ('reference_kmer', 'S5'),
                                         ('strand', 'S1'),
@@ -183,6 +390,24 @@ class Mea(unittest.TestCase):
                                         ('ont_model_mean', '<f8'), ('path_kmer', 'S5')])
             get_mea_params_from_events(events)
 
+    def test_transform_kmers(self):
+        """Test transform_kmers matches ReverseComplement"""
+        flip = ReverseComplement()
+        kmers = np.asarray(["AAGGC", "acgtn", "GGCT", "A", ""], dtype='S5')
+        str_kmers = [bytes.decode(x) for x in kmers]
+        self.assertSequenceEqual([bytes.decode(x) for x in transform_kmers(kmers)], [x.upper() for x in str_kmers])
+        self.assertSequenceEqual([bytes.decode(x) for x in transform_kmers(kmers, complement=True)],
+                                 [flip.complement(x) for x in str_kmers])
+        self.assertSequenceEqual([bytes.decode(x) for x in transform_kmers(kmers, reverse=True)],
+                                 [flip.reverse(x) for x in str_kmers])
+        self.assertSequenceEqual([bytes.decode(x) for x in transform_kmers(kmers, reverse=True, complement=True)],
+                                 [flip.reverse_complement(x) for x in str_kmers])
+        self.assertEqual(np.dtype('S5'), transform_kmers(kmers).dtype)
+        # str input
+        self.assertSequenceEqual([bytes.decode(x) for x in transform_kmers(np.asarray(str_kmers), reverse=True)],
+                                 [flip.reverse(x) for x in str_kmers])
+        self.assertEqual(0, len(transform_kmers(np.zeros(0, dtype='S6'), reverse=True)))
+
     def test_match_events_with_signalalign(self):
         """Test match_events_with_signalalign"""
         # RNA is sequenced 3'-5'
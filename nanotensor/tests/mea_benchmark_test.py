@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+    Place unit tests for mea_benchmark.py
+"""
+########################################################################
+# File: mea_benchmark_test.py
+#  executable: mea_benchmark_test.py
+# Purpose: mea_benchmark test functions
+#
+# Author: Andrew Bailey
+# History: 05/02/18 Created
+########################################################################
+import os
+import shutil
+import tempfile
+import unittest
+from py3helpers.utils import load_json
+from nanotensor.mea_benchmark import *
+
+
+class MeaBenchmarkTest(unittest.TestCase):
+    """Test the functions in mea_benchmark.py"""
+
+    def test_get_workloads(self):
+        """Test get_workloads"""
+        workloads = get_workloads(max_events=1000, events=(1000, 10000), cells_per_row=(2, 5), band_widths=(10,),
+                                  dense_sizes=(50,), seed=10)
+        self.assertEqual(3, len(workloads))
+        self.assertEqual("dense", workloads[0]["type"])
+        self.assertSequenceEqual([10, 11, 12], [workload["seed"] for workload in workloads])
+        self.assertTrue(all(workload["events"] <= 1000 for workload in workloads))
+
+    def test_create_workload(self):
+        """Test create_workload is reproducible"""
+        for workload in get_workloads(max_events=1000, events=(1000,), cells_per_row=(3,), band_widths=(5,),
+                                      dense_sizes=(20,)):
+            posterior_matrix, shortest_ref_per_event = create_workload(workload)
+            same_matrix, same_shortest_ref = create_workload(workload)
+            self.assertSequenceEqual(posterior_matrix.toarray().tolist(), same_matrix.toarray().tolist())
+            self.assertSequenceEqual(list(shortest_ref_per_event), list(same_shortest_ref))
+            self.assertEqual((workload["events"], workload["refs"]), posterior_matrix.shape)
+            if workload["type"] == "banded":
+                centers = get_diagonal_band_centers(*posterior_matrix.shape)
+                self.assertTrue(np.all(np.abs(posterior_matrix.col - centers[posterior_matrix.row]) <= 5))
+            # probabilities of each event sum to one
+            row_sums = np.asarray(posterior_matrix.sum(axis=1)).ravel()
+            self.assertTrue(np.allclose(row_sums[row_sums > 0], 1))
+
+    def test_run_mea_benchmark(self):
+        """Test run_mea_benchmark and save_mea_benchmark"""
+        workloads = get_workloads(max_events=200, events=(200,), cells_per_row=(2,), band_widths=(5,),
+                                  dense_sizes=(10,))
+        results = run_mea_benchmark(workloads, repeats=2, max_slow_area=100)
+        # slow variants only run on the small dense workload
+        self.assertEqual(len(MEA_VARIANTS) + len(MEA_VARIANTS) - len(SLOW_VARIANTS), len(results))
+        for result in results:
+            self.assertEqual(2, len(result["times"]))
+            self.assertGreater(result["peak_memory"], 0)
+            self.assertEqual(min(result["times"]), result["min_time"])
+        with self.assertRaises(AssertionError):
+            run_mea_benchmark(workloads, variants=["fake"])
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            output_path = os.path.join(tempdir, "benchmark.json")
+            save_mea_benchmark(results, output_path)
+            benchmark = load_json(output_path)
+            self.assertEqual(len(results), len(benchmark["results"]))
+            self.assertEqual(np.__version__, benchmark["numpy"])
+        finally:
+            shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
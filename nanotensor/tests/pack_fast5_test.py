@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+    Place unit tests for pack_fast5.py
+"""
+########################################################################
+# File: pack_fast5_test.py
+#  executable: pack_fast5_test.py
+# Purpose: pack_fast5 test functions
+#
+# Author: Andrew Bailey
+# History: 05/07/18 Created
+########################################################################
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from py3helpers.utils import list_dir, load_json
+from nanotensor.fast5 import Fast5
+from nanotensor.pack_fast5 import *
+
+
+class PackFast5Test(unittest.TestCase):
+    """Test the functions in pack_fast5.py"""
+
+    def setUp(self):
+        home = '/'.join(os.path.abspath(__file__).split("/")[:-1])
+        self.tempdir = tempfile.mkdtemp()
+        self.fast5_dir = os.path.join(self.tempdir, "reads")
+        os.makedirs(self.fast5_dir)
+        for read_dir in ("methylated", "rna_reads"):
+            for path in list_dir(os.path.join(home, "test_files/minion-reads", read_dir), ext="fast5"):
+                shutil.copy(path, self.fast5_dir)
+        self.fast5_files = list_dir(self.fast5_dir, ext="fast5")
+        self.output_dir = os.path.join(self.tempdir, "bundles")
+
+    def test_assign_bundles(self):
+        """Test assign_bundles"""
+        files = [str(i) for i in range(10)]
+        bundles = assign_bundles(files, num_bundles=3)
+        self.assertEqual(3, len(bundles))
+        self.assertSequenceEqual(sorted(files), [path for bundle in bundles for path in bundle])
+        self.assertEqual(4, len(assign_bundles(files, reads_per_bundle=3)))
+        self.assertEqual(10, len(assign_bundles(files, num_bundles=20)))
+        with self.assertRaises(AssertionError):
+            assign_bundles(files, num_bundles=0)
+
+    def test_pack_fast5_directory(self):
+        """Test pack_fast5_directory packs every read and resumes unfinished bundles"""
+        summary = pack_fast5_directory(self.fast5_dir, self.output_dir, num_bundles=3, num_workers=2,
+                                       keep=("ReSegmentBasecall_000",))
+        self.assertEqual(3, summary["bundles"])
+        self.assertEqual(3, summary["packed_bundles"])
+        self.assertEqual(len(self.fast5_files), summary["reads"])
+        self.assertEqual(0, len(summary["failures"]))
+        index = load_json(os.path.join(self.output_dir, INDEX_NAME))
+        self.assertEqual(len(self.fast5_files), len(index))
+        for read_id, location in index.items():
+            with Fast5(os.path.join(self.output_dir, location["bundle"]), 'r', read_id=read_id) as bundle, \
+                    Fast5(location["source"], 'r') as single_read:
+                self.assertEqual(location["offset"], list(bundle.read_index).index(read_id))
+                self.assertEqual(location["group"], bundle.read_group)
+                self.assertEqual(single_read.channel_meta, bundle.channel_meta)
+                self.assertEqual(single_read.raw_attributes, bundle.raw_attributes)
+                self.assertSequenceEqual(single_read.get_raw_signal().raw.tolist(),
+                                         bundle.get_raw_signal().raw.tolist())
+                signal = bundle.get_read(group=True, raw=True)['Signal']
+                self.assertEqual("gzip", signal.compression)
+                self.assertIsNotNone(signal.chunks)
+                # only whitelisted analyses are packed
+                self.assertSequenceEqual([name for name in single_read['Analyses'] if name == "ReSegmentBasecall_000"],
+                                         list(bundle[bundle.__base_analysis__].keys()))
+                if "ReSegmentBasecall_000" in single_read['Analyses']:
+                    self.assertSequenceEqual(single_read.get_resegment_basecall().tolist(),
+                                             bundle.get_resegment_basecall().tolist())
+
+        # interrupted bundle is packed again
+        bundle_path = os.path.join(self.output_dir, get_bundle_name(1))
+        os.rename(bundle_path, bundle_path + ".tmp")
+        summary = pack_fast5_directory(self.fast5_dir, self.output_dir, num_bundles=3,
+                                       keep=("ReSegmentBasecall_000",))
+        self.assertEqual(1, summary["packed_bundles"])
+        self.assertTrue(is_bundle_finished(bundle_path))
+        self.assertFalse(os.path.exists(bundle_path + ".tmp"))
+        self.assertEqual(index, load_json(os.path.join(self.output_dir, INDEX_NAME)))
+        summary = pack_fast5_directory(self.fast5_dir, self.output_dir, num_bundles=3,
+                                       keep=("ReSegmentBasecall_000",))
+        self.assertEqual(0, summary["packed_bundles"])
+        # arguments which do not match the manifest
+        with self.assertRaises(AssertionError):
+            pack_fast5_directory(self.fast5_dir, self.output_dir, num_bundles=3)
+        with self.assertRaises(AssertionError):
+            pack_fast5_directory(self.fast5_files[1:], self.output_dir, num_bundles=3,
+                                 keep=("ReSegmentBasecall_000",))
+
+    def test_pack_fast5_directory_duplicates(self):
+        """Test a read_id packed in two bundles is reported and indexed once"""
+        duplicate_file = os.path.join(self.fast5_dir, "zz_duplicate.fast5")
+        shutil.copy(sorted(self.fast5_files)[0], duplicate_file)
+        summary = pack_fast5_directory(self.fast5_dir, self.output_dir, num_bundles=len(self.fast5_files) + 1)
+        self.assertEqual(len(self.fast5_files), summary["reads"])
+        self.assertSequenceEqual([duplicate_file], list(summary["failures"].keys()))
+        index = load_json(os.path.join(self.output_dir, INDEX_NAME))
+        self.assertIn(sorted(self.fast5_files)[0], [location["source"] for location in index.values()])
+
+    def test_pack_fast5_directory_failures(self):
+        """Test unreadable files are reported and skipped"""
+        bad_file = os.path.join(self.fast5_dir, "bad.fast5")
+        with open(bad_file, "w") as fh:
+            fh.write("not a fast5 file")
+        summary = pack_fast5_directory(self.fast5_dir, self.output_dir, num_bundles=1)
+        self.assertEqual(len(self.fast5_files), summary["reads"])
+        self.assertSequenceEqual([bad_file], list(summary["failures"].keys()))
+
+    def test_pack_bundle_corrupt_read(self):
+        """Test a read which fails part way through packing leaves no group in the bundle"""
+        # the corrupt read sorts first so a left over group would shift the offsets of every other read
+        corrupt_file = os.path.join(self.fast5_dir, "a_corrupt.fast5")
+        shutil.copy(sorted(self.fast5_files)[0], corrupt_file)
+        with Fast5(corrupt_file, 'r+') as fast5handle:
+            raw_group = fast5handle.get_read(group=True, raw=True)
+            raw_group.attrs["read_id"] = b"corrupt-read"
+            raw_group["broken"] = h5py.SoftLink("/does/not/exist")
+        bundle_path = os.path.join(self.tempdir, get_bundle_name(0))
+        index, failures = pack_bundle(sorted(self.fast5_files + [corrupt_file]), bundle_path)
+        self.assertSequenceEqual([corrupt_file], list(failures.keys()))
+        self.assertEqual(len(self.fast5_files), len(index))
+        with h5py.File(bundle_path, 'r') as bundle:
+            read_groups = list(bundle.keys())
+        self.assertEqual(len(self.fast5_files), len(read_groups))
+        for read_id, location in index.items():
+            self.assertEqual(location["group"], read_groups[location["offset"]])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
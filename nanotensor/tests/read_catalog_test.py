@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+    Place unit tests for read_catalog.py
+"""
+########################################################################
+# File: read_catalog_test.py
+#  executable: read_catalog_test.py
+# Purpose: read_catalog test functions
+#
+# Author: Andrew Bailey
+# History: 05/08/18 Created
+########################################################################
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from py3helpers.utils import list_dir
+from nanotensor.fast5 import Fast5, iterate_fast5
+from nanotensor.read_catalog import *
+
+
+class ReadCatalogTest(unittest.TestCase):
+    """Test the functions in read_catalog.py"""
+
+    def setUp(self):
+        home = '/'.join(os.path.abspath(__file__).split("/")[:-1])
+        self.tempdir = tempfile.mkdtemp()
+        self.fast5_dir = os.path.join(self.tempdir, "reads")
+        os.makedirs(self.fast5_dir)
+        for read_dir in ("methylated", "rna_reads"):
+            for path in list_dir(os.path.join(home, "test_files/minion-reads", read_dir), ext="fast5"):
+                shutil.copy(path, self.fast5_dir)
+        self.fast5_files = sorted(list_dir(self.fast5_dir, ext="fast5"))
+        self.catalog_path = os.path.join(self.tempdir, "catalog.npz")
+
+    def test_scan_fast5(self):
+        """Test scan_fast5 matches the Fast5 getters"""
+        for path in self.fast5_files:
+            rows = scan_fast5(path)
+            self.assertEqual(1, len(rows))
+            row = rows[0]
+            self.assertEqual("", row["error"])
+            with Fast5(path, 'r') as fast5handle:
+                self.assertEqual(fast5handle.get_read_ids()[0], row["read_id"])
+                self.assertEqual(fast5handle.is_read_rna(), row["is_rna"])
+                self.assertEqual(len(fast5handle.get_read(raw=True, scale=False)), row["signal_length"])
+                self.assertEqual(fast5handle.raw_attributes["duration"], row["duration"])
+                self.assertSequenceEqual(list(fast5handle["Analyses"].keys()), row["analyses"].split(ANALYSES_SEP))
+                if "EventDetection_000" in fast5handle["Analyses"]:
+                    self.assertEqual(len(fast5handle.get_read()), row["event_length"])
+
+    def test_build_read_catalog(self):
+        """Test build_read_catalog saves the catalog and only scans changed files"""
+        catalog = build_read_catalog(self.fast5_dir, catalog_path=self.catalog_path, num_workers=2)
+        self.assertSequenceEqual(self.fast5_files, catalog["path"].tolist())
+        self.assertTrue(np.all(catalog["error"] == ""))
+        loaded = load_read_catalog(self.catalog_path)
+        for name in CATALOG_COLUMNS:
+            self.assertSequenceEqual(catalog[name].tolist(), loaded[name].tolist())
+        # changed, removed and new files are scanned again
+        bad_file = os.path.join(self.fast5_dir, "bad.fast5")
+        with open(bad_file, "w") as fh:
+            fh.write("not a fast5 file")
+        os.remove(self.fast5_files[0])
+        os.utime(self.fast5_files[1], (1, 1))
+        catalog = build_read_catalog(self.fast5_dir, catalog_path=self.catalog_path)
+        self.assertSequenceEqual(sorted(self.fast5_files[1:] + [bad_file]), catalog["path"].tolist())
+        self.assertEqual(1, catalog["mtime"][catalog["path"] == self.fast5_files[1]][0])
+        self.assertNotEqual("", catalog["error"][catalog["path"] == bad_file][0])
+
+    def test_query_read_catalog(self):
+        """Test query_read_catalog filters and sorts reads"""
+        catalog = build_read_catalog(self.fast5_dir)
+        rna = query_read_catalog(catalog, mask=lambda x: x["is_rna"])
+        self.assertEqual(2, len(rna["path"]))
+        resegmented = query_read_catalog(catalog, analysis="ReSegmentBasecall_000")
+        self.assertSequenceEqual(rna["path"].tolist(), resegmented["path"].tolist())
+        self.assertEqual(0, len(query_read_catalog(catalog, analysis="ReSegmentBasecall")["path"]))
+        longest = query_read_catalog(catalog, sort_by="signal_length", reverse=True)
+        self.assertSequenceEqual(sorted(catalog["signal_length"].tolist(), reverse=True),
+                                 longest["signal_length"].tolist())
+        self.assertSequenceEqual(longest["path"].tolist(), get_catalog_paths(longest))
+        with self.assertRaises(AssertionError):
+            query_read_catalog(catalog, sort_by="fake")
+        # iterate_fast5 uses the catalog files
+        self.assertSequenceEqual(longest["path"].tolist(), list(iterate_fast5(None, paths=True, catalog=longest)))
+        by_size = list(iterate_fast5(None, paths=True, catalog=catalog, sort_by_size='asc'))
+        self.assertSequenceEqual(sorted(self.fast5_files, key=os.path.getsize), by_size)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
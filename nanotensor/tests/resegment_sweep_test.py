@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+    Place unit tests for resegment_sweep.py
+"""
+########################################################################
+# File: resegment_sweep_test.py
+#  executable: resegment_sweep_test.py
+# Purpose: resegment_sweep test functions
+#
+# Author: Andrew Bailey
+# History: 05/15/18 Created
+########################################################################
+import os
+import shutil
+import tempfile
+import unittest
+from py3helpers.utils import list_dir, save_json
+from nanotensor.fast5 import Fast5
+from nanotensor.resegment_sweep import *
+
+
+class ResegmentSweepTest(unittest.TestCase):
+    """Test the functions in resegment_sweep.py"""
+
+    def setUp(self):
+        home = '/'.join(os.path.abspath(__file__).split("/")[:-1])
+        self.tempdir = tempfile.mkdtemp()
+        self.fast5_dir = os.path.join(self.tempdir, "reads")
+        os.makedirs(self.fast5_dir)
+        for path in list_dir(os.path.join(home, "test_files/minion-reads/rna_reads"), ext="fast5"):
+            shutil.copy(path, self.fast5_dir)
+        self.fast5_files = sorted(list_dir(self.fast5_dir, ext="fast5"))
+        self.grid = {"detector": "ttest", "window_lengths": [[5, 10], [6, 12]], "thresholds": [[1.9, 1.0]],
+                     "peak_height": [1.0, 1.2]}
+
+    def test_expand_param_grid(self):
+        """Test expand_param_grid makes every combination"""
+        param_grid = expand_param_grid(self.grid)
+        self.assertEqual(4, len(param_grid))
+        self.assertIn({"detector": "ttest", "window_lengths": (6, 12), "thresholds": (1.9, 1.0),
+                       "peak_height": 1.2}, param_grid)
+        self.assertEqual([{"detector": "ttest"}], expand_param_grid({"detector": "ttest"}))
+
+    def test_load_sweep_cache(self):
+        """Test load_sweep_cache concatenates the raw signals and reports bad reads"""
+        bad_file = os.path.join(self.fast5_dir, "bad.fast5")
+        with open(bad_file, "w") as fh:
+            fh.write("not a fast5 file")
+        reads = load_sweep_cache(self.fast5_files + [bad_file])
+        self.assertSequenceEqual(self.fast5_files, reads["path"])
+        self.assertSequenceEqual([bad_file], list(reads["failed"].keys()))
+        self.assertEqual(sum(reads["signal_length"]), len(reads["signal"]))
+        for index, fast5_path in enumerate(self.fast5_files):
+            with Fast5(fast5_path, 'r') as fast5handle:
+                raw = fast5handle.get_raw_signal().raw
+                start = reads["signal_start"][index]
+                self.assertSequenceEqual(raw.tolist(), reads["signal"][start:start + len(raw)].tolist())
+                old_events = fast5handle.get_basecall_data()
+                start = reads["events_start"][index]
+                cached = reads["old_events"][start:start + old_events.nbytes].view(reads["events_dtype"][index])
+                self.assertEqual(len(old_events), reads["events_length"][index])
+                self.assertSequenceEqual(old_events.tolist(), cached.tolist())
+            self.assertTrue(reads["rna"][index])
+            self.assertGreater(len(reads["sequence"][index]), 0)
+
+    def test_run_resegment_sweep(self):
+        """Test run_resegment_sweep ranks parameters without writing to the reads"""
+        with Fast5(self.fast5_files[0], 'r') as fast5handle:
+            analyses = sorted(fast5handle["Analyses"].keys())
+        summaries, rows, failed = run_resegment_sweep(self.fast5_dir, self.grid, num_workers=2)
+        self.assertEqual(0, len(failed))
+        self.assertEqual(4, len(summaries))
+        self.assertSequenceEqual([1, 2, 3, 4], [summary["rank"] for summary in summaries])
+        accuracies = [summary["mean_accuracy"] for summary in summaries]
+        self.assertSequenceEqual(sorted(accuracies, reverse=True), accuracies)
+        for summary, param_rows in zip(summaries, rows):
+            self.assertEqual(2, summary["reads"])
+            self.assertEqual(0, summary["failed"])
+            self.assertGreater(summary["mean_accuracy"], 0.9)
+        for param_rows in rows:
+            self.assertSequenceEqual(self.fast5_files, [row["path"] for row in param_rows])
+        with Fast5(self.fast5_files[0], 'r') as fast5handle:
+            self.assertSequenceEqual(analyses, sorted(fast5handle["Analyses"].keys()))
+        # same result in one process
+        single, _, _ = run_resegment_sweep(self.fast5_files, expand_param_grid(self.grid))
+        self.assertSequenceEqual([summary["params"] for summary in summaries],
+                                 [summary["params"] for summary in single])
+        with self.assertRaises(AssertionError):
+            run_resegment_sweep(self.fast5_dir, {"peak_height": [1.0]})
+
+    def test_main(self):
+        """Test main writes the ranked table"""
+        grid_path = save_json(self.grid, os.path.join(self.tempdir, "grid.json"))
+        output = os.path.join(self.tempdir, "sweep.tsv")
+        main(["-d", self.fast5_dir, "-g", grid_path, "-o", output])
+        with open(output) as fh:
+            lines = fh.readlines()
+        self.assertEqual(5, len(lines))
+        self.assertSequenceEqual(SWEEP_COLUMNS, lines[0].rstrip("\n").split("\t"))
+        self.assertEqual("1", lines[1].split("\t")[0])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
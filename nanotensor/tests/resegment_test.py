@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+    Place unit tests for resegment.py
+"""
+########################################################################
+# File: resegment_test.py
+#  executable: resegment_test.py
+# Purpose: resegment test functions
+#
+# Author: Andrew Bailey
+# History: 05/14/18 Created
+########################################################################
+import os
+import shutil
+import tempfile
+import unittest
+from py3helpers.utils import list_dir, load_json
+from nanotensor.fast5 import Fast5
+from nanotensor.read_catalog import build_read_catalog
+from nanotensor.resegment import *
+
+
+class ResegmentTest(unittest.TestCase):
+    """Test the functions in resegment.py"""
+
+    def setUp(self):
+        home = '/'.join(os.path.abspath(__file__).split("/")[:-1])
+        self.tempdir = tempfile.mkdtemp()
+        self.fast5_dir = os.path.join(self.tempdir, "reads")
+        os.makedirs(self.fast5_dir)
+        for path in list_dir(os.path.join(home, "test_files/minion-reads/rna_reads"), ext="fast5"):
+            shutil.copy(path, self.fast5_dir)
+        self.fast5_files = sorted(list_dir(self.fast5_dir, ext="fast5"))
+
+    def test_get_preset_params(self):
+        """Test get_preset_params copies presets"""
+        params = get_preset_params("rna_minknow", overrides={"peak_height": 2.0})
+        self.assertEqual(2.0, params["peak_height"])
+        self.assertEqual(1.2, RESEGMENT_PRESETS["rna_minknow"]["peak_height"])
+        for params in RESEGMENT_PRESETS.values():
+            self.assertIn(params["detector"], EVENT_DETECTORS)
+        with self.assertRaises(AssertionError):
+            get_preset_params("fake")
+
+    def test_is_resegmented(self):
+        """Test is_resegmented compares the stored attributes"""
+        # the test reads were resegmented with the rna minknow parameters
+        with Fast5(self.fast5_files[0], 'r') as fast5handle:
+            self.assertTrue(is_resegmented(fast5handle, RESEGMENT_PRESETS["rna_minknow"]))
+            self.assertFalse(is_resegmented(fast5handle, RESEGMENT_PRESETS["dna_minknow"]))
+            self.assertFalse(is_resegmented(fast5handle, RESEGMENT_PRESETS["rna_ttest"]))
+            self.assertFalse(is_resegmented(fast5handle, get_preset_params("rna_minknow", {"fake": 1})))
+        with Fast5(self.fast5_files[0], 'r+') as fast5handle:
+            fast5handle.delete(fast5handle.get_analysis_latest(RESEGMENT_NAME))
+        with Fast5(self.fast5_files[0], 'r') as fast5handle:
+            self.assertFalse(is_resegmented(fast5handle, RESEGMENT_PRESETS["rna_minknow"]))
+
+    def test_resegment_directory(self):
+        """Test resegment_directory skips resegmented reads and reports failures"""
+        bad_file = os.path.join(self.fast5_dir, "bad.fast5")
+        with open(bad_file, "w") as fh:
+            fh.write("not a fast5 file")
+        summary = resegment_directory(self.fast5_dir, RESEGMENT_PRESETS["rna_minknow"], num_workers=2,
+                                      accuracy=False)
+        self.assertEqual(2, summary["skipped"])
+        self.assertEqual(1, summary["failed"])
+        self.assertSequenceEqual(sorted(self.fast5_files + [bad_file]), [row["path"] for row in summary["reads"]])
+        self.assertGreater(summary["reads_per_second"], 0)
+        self.assertEqual(-1.0, summary["mean_accuracy"])
+        # catalog and command line
+        catalog = build_read_catalog(self.fast5_files)
+        summary = resegment_directory(catalog, RESEGMENT_PRESETS["rna_minknow"])
+        self.assertEqual(2, summary["skipped"])
+        for row in summary["reads"]:
+            self.assertGreater(row["accuracy"], 0.9)
+        output = os.path.join(self.tempdir, "summary.json")
+        main(["-d", self.fast5_dir, "-p", "rna_minknow", "--no_accuracy", "-o", output])
+        self.assertEqual("rna_minknow", load_json(output)["preset"])
+        with self.assertRaises(AssertionError):
+            resegment_directory(self.fast5_dir, {"window_lengths": (5, 10)})
+
+    def test_resegment_directory_ttest(self):
+        """Test resegment_directory resegments the reads with the rna_ttest preset and skips them on a re-run"""
+        summary = resegment_directory(self.fast5_dir, RESEGMENT_PRESETS["rna_ttest"], num_workers=2)
+        self.assertEqual(2, summary["resegmented"])
+        self.assertEqual(0, summary["failed"])
+        for row in summary["reads"]:
+            self.assertGreater(row["accuracy"], 0.9)
+        self.assertGreater(summary["mean_accuracy"], 0.9)
+        for fast5_path in self.fast5_files:
+            with Fast5(fast5_path, 'r') as fast5handle:
+                self.assertTrue(is_resegmented(fast5handle, RESEGMENT_PRESETS["rna_ttest"]))
+        summary = resegment_directory(self.fast5_dir, RESEGMENT_PRESETS["rna_ttest"], num_workers=2)
+        self.assertEqual(2, summary["skipped"])
+        self.assertEqual(0, summary["resegmented"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+if __name__ == '__main__':
+    unittest.main()